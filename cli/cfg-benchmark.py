@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+classifier-free guidance overhead benchmark
+measures per-step cost of cfg input assembly and composable cfg combination outside of unet
+compares original per-image python loops with vectorized implementation in modules/sd_samplers_cfg for different batch sizes and AND-term counts
+"""
+import os
+import sys
+import time
+import argparse
+import torch
+from util import log
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from modules.sd_samplers_cfg import CFGPlan # pylint: disable=wrong-import-position
+
+
+def conds_layout(batch, terms):
+    conds_list = []
+    for i in range(batch):
+        conds_list.append([(i * terms + j, 1.0 / terms) for j in range(terms)])
+    return conds_list
+
+
+def loop_step(x, sigma, image_cond, x_out, conds_list, cond_scale):
+    repeats = [len(conds_list[i]) for i in range(len(conds_list))]
+    x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x])
+    sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma])
+    image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_cond])
+    denoised_uncond = x_out[-x.shape[0]:]
+    denoised = torch.clone(denoised_uncond)
+    for i, conds in enumerate(conds_list):
+        for cond_index, weight in conds:
+            denoised[i] += (x_out[cond_index] - denoised_uncond[i]) * (weight * cond_scale)
+    return x_in, sigma_in, image_cond_in, denoised
+
+
+def vectorized_step(x, sigma, image_cond, x_out, plan, cond_scale):
+    x_in = torch.cat([plan.expand(x), x])
+    sigma_in = torch.cat([plan.expand(sigma), sigma])
+    image_cond_in = torch.cat([plan.expand(image_cond), image_cond])
+    denoised = plan.combine(x_out, x.shape[0], cond_scale)
+    return x_in, sigma_in, image_cond_in, denoised
+
+
+def measure(fn, steps, warmup=3):
+    for _ in range(warmup):
+        fn()
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return (time.perf_counter() - t0) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'SD.Next CFG overhead benchmark')
+    parser.add_argument('--batch', type=str, default='1,2,4,8,16', help='batch sizes, default: %(default)s')
+    parser.add_argument('--terms', type=str, default='1,2,4,8', help='AND-terms per prompt, default: %(default)s')
+    parser.add_argument('--size', type=int, default=64, help='latent size, default: %(default)s')
+    parser.add_argument('--steps', type=int, default=50, help='measured steps per mode, default: %(default)s')
+    parser.add_argument('--threads', type=int, default=0, help='torch cpu threads, default: torch default')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    log.info({ 'benchmark': 'cfg', 'device': 'cpu', 'threads': torch.get_num_threads(), 'latent': args.size, 'steps': args.steps })
+    torch.manual_seed(0)
+    for batch in [int(b) for b in args.batch.split(',')]:
+        for terms in [int(t) for t in args.terms.split(',')]:
+            conds_list = conds_layout(batch, terms)
+            x = torch.randn((batch, 4, args.size, args.size))
+            sigma = torch.rand((batch, ))
+            image_cond = torch.randn((batch, 5, args.size, args.size))
+            x_out = torch.randn((batch * terms + batch, 4, args.size, args.size))
+            plan = CFGPlan(conds_list, x.device)
+            with torch.inference_mode():
+                reference = loop_step(x, sigma, image_cond, x_out, conds_list, 7.0)
+                result = vectorized_step(x, sigma, image_cond, x_out, plan, 7.0)
+                error = max((a - b).abs().max().item() for a, b in zip(reference, result))
+                t_loop = measure(lambda: loop_step(x, sigma, image_cond, x_out, conds_list, 7.0), args.steps) # pylint: disable=cell-var-from-loop
+                t_vec = measure(lambda: vectorized_step(x, sigma, image_cond, x_out, plan, 7.0), args.steps) # pylint: disable=cell-var-from-loop
+            log.info({ 'batch': batch, 'terms': terms, 'loop': f'{1000 * t_loop:.3f}ms', 'vectorized': f'{1000 * t_vec:.3f}ms', 'speedup': round(t_loop / t_vec, 2), 'error': f'{error:.2e}' })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+image encoding benchmark
+reports ms/image and bytes/image of every encoding profile for each output format on sample images
+and compares serial encoding with process pool encoding used by modules/image_encoder
+"""
+import os
+import sys
+import time
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from util import log
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from modules.image_encoder import profiles, defaults, encode # pylint: disable=wrong-import-position
+
+
+formats = { 'png': 'PNG', 'jpg': 'JPEG', 'webp': 'WEBP' }
+
+
+def synthetic(count, size):
+    """smooth gradients with noise approximate entropy of generated images"""
+    samples = []
+    for i in range(count):
+        gradient = Image.linear_gradient('L').resize((size, size)).rotate(37 * i)
+        noise = Image.effect_noise((size, size), 24 + 8 * i)
+        radial = Image.radial_gradient('L').resize((size, size))
+        samples.append(Image.merge('RGB', (gradient, noise, radial)))
+    return samples
+
+
+def load(folder, count):
+    samples = []
+    for f in sorted(os.listdir(folder)):
+        if os.path.splitext(f)[1].lower() in ['.png', '.jpg', '.jpeg', '.webp']:
+            samples.append(Image.open(os.path.join(folder, f)).convert('RGB'))
+        if len(samples) >= count:
+            break
+    return samples
+
+
+def save_args(profile, image_format, quality):
+    args = dict(defaults['samples'].get(image_format, {})) if profile == 'default' else dict(profiles[profile].get(image_format, {}))
+    if image_format != 'PNG':
+        args['quality'] = quality
+    return args
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'SD.Next image encoding benchmark')
+    parser.add_argument('--input', type=str, default=None, help='folder with sample images, default: synthetic images')
+    parser.add_argument('--count', type=int, default=8, help='number of sample images, default: %(default)s')
+    parser.add_argument('--size', type=int, default=1024, help='synthetic image size, default: %(default)s')
+    parser.add_argument('--formats', type=str, default='png,jpg,webp', help='formats, default: %(default)s')
+    parser.add_argument('--quality', type=int, default=90, help='jpeg/webp quality, default: %(default)s')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='process pool workers, default: %(default)s')
+    parser.add_argument('--output', type=str, default=None, help='save results as json')
+    args = parser.parse_args()
+    samples = load(args.input, args.count) if args.input else synthetic(args.count, args.size)
+    if len(samples) == 0:
+        log.error({ 'benchmark': 'image', 'error': 'no samples' })
+        return
+    log.info({ 'benchmark': 'image', 'samples': len(samples), 'size': f'{samples[0].width}x{samples[0].height}', 'workers': args.workers })
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(encode, samples[:1], ['PNG'], [{}])) # warmup workers
+        for ext in args.formats.split(','):
+            image_format = formats[ext.strip().lower()]
+            for profile in ['default'] + list(profiles):
+                kwargs = save_args(profile, image_format, args.quality)
+                t0 = time.perf_counter()
+                encoded = [encode(image, image_format, kwargs) for image in samples]
+                t_serial = time.perf_counter() - t0
+                t0 = time.perf_counter()
+                list(executor.map(encode, samples, [image_format] * len(samples), [kwargs] * len(samples)))
+                t_pool = time.perf_counter() - t0
+                result = {
+                    'format': ext,
+                    'profile': profile,
+                    'ms': round(1000 * t_serial / len(samples), 1),
+                    'bytes': sum(len(e) for e in encoded) // len(samples),
+                    'pool_ms': round(1000 * t_pool / len(samples), 1),
+                    'speedup': round(t_serial / t_pool, 2),
+                }
+                results.append(result)
+                log.info(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+model load benchmark and regression check
+generates synthetic checkpoints and loads them through sd_models.load_model or load_diffuser in every supported mode
+each mode runs in a separate process so that cold loads and peak rss are not affected by previous runs
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+from util import log
+
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sizes = { # channels, depth and text conditioning width of synthetic models
+    'tiny': { 'unet': 32, 'mult': [1, 2], 'attention': [1, 2], 'vae': 32, 'context': 64 },
+    'mid': { 'unet': 128, 'mult': [1, 2, 4, 4], 'attention': [4, 2, 1], 'vae': 64, 'context': 256 },
+}
+dtypes = ['fp16', 'bf16', 'fp32']
+formats = ['safetensors', 'ckpt']
+loads = ['default', 'stream', 'lazy'] # default: mmap, stream: stream_load buffered read, lazy: sd_stream_weights tensor-by-tensor
+caches = ['cold', 'cached']
+marker = 'BENCHMARK:'
+
+
+class PeakRSS:
+    """samples process rss in background thread while active"""
+    def __init__(self, interval=0.01):
+        import psutil
+        self.process = psutil.Process(os.getpid())
+        self.interval = interval
+        self.base = 0
+        self.peak = 0
+        self.running = False
+        self.thread = None
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.base = self.process.memory_info().rss
+        self.peak = self.base
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def init_webui(backend, workdir):
+    sys.argv = [sys.argv[0], '--use-cpu', 'all', '--data-dir', workdir, '--no-download', '--backend', backend]
+    sys.path.insert(0, root)
+    os.chdir(root)
+    import modules.loader # pylint: disable=unused-import
+    import ldm.modules.encoders.modules # pylint: disable=unused-import
+    from modules import shared, sd_samplers, sd_vae
+    shared.opts.data['sd_checkpoint_cache'] = 0
+    shared.opts.data['sd_hash_background'] = False
+    sd_samplers.list_samplers()
+    sd_vae.refresh_vae_list()
+    return shared
+
+
+def model_name(size, fmt, dtype):
+    return f'synthetic-{size}-{dtype}.{fmt}'
+
+
+def worker_generate(params):
+    """create checkpoint with random weights and matching config next to it
+    text encoder is replaced by small class embedder so that generation and loading do not need network access"""
+    init_webui('original', params['workdir'])
+    import torch
+    import safetensors.torch
+    from omegaconf import OmegaConf
+    from ldm.util import instantiate_from_config
+    size = sizes[params['size']]
+    config = OmegaConf.load(os.path.join(root, 'configs', 'v1-inference.yaml'))
+    unet = config.model.params.unet_config.params
+    unet.model_channels = size['unet']
+    unet.channel_mult = size['mult']
+    unet.attention_resolutions = size['attention']
+    unet.num_res_blocks = 1
+    unet.use_checkpoint = False
+    unet.context_dim = size['context']
+    vae = config.model.params.first_stage_config.params.ddconfig
+    vae.ch = size['vae']
+    vae.num_res_blocks = 1
+    config.model.params.cond_stage_config = OmegaConf.create({ 'target': 'ldm.modules.encoders.modules.ClassEmbedder', 'params': { 'embed_dim': size['context'], 'n_classes': 16 } })
+    model = instantiate_from_config(config.model)
+    dtype = { 'fp16': torch.float16, 'bf16': torch.bfloat16, 'fp32': torch.float32 }[params['dtype']]
+    state_dict = { k: v.to(dtype) if v.is_floating_point() else v for k, v in model.state_dict().items() }
+    for fmt in formats:
+        filename = os.path.join(params['workdir'], 'models', model_name(params['size'], fmt, params['dtype']))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if fmt == 'safetensors':
+            safetensors.torch.save_file({ k: v.contiguous() for k, v in state_dict.items() }, filename)
+        else:
+            torch.save({ 'state_dict': state_dict }, filename)
+        OmegaConf.save(config, os.path.splitext(filename)[0] + '.yaml')
+    return { 'size': params['size'], 'dtype': params['dtype'], 'params': sum(v.numel() for v in state_dict.values()) }
+
+
+def worker_load(params):
+    """load single checkpoint in given mode and return per-phase timings and peak rss"""
+    shared = init_webui(params['backend'], params['workdir'])
+    from modules import sd_models
+    from modules.timer import Timer
+    shared.opts.data['stream_load'] = params['load'] == 'stream'
+    shared.opts.data['sd_stream_weights'] = params['load'] == 'lazy'
+    shared.opts.data['sd_checkpoint_cache'] = 1 if params['cache'] == 'cached' else 0
+    checkpoint_info = sd_models.CheckpointInfo(params['filename'])
+    checkpoint_info.register()
+    load = sd_models.load_diffuser if shared.backend == shared.Backend.DIFFUSERS else sd_models.load_model
+    if params['cache'] == 'cached': # warm up cache, then unload model so that next load is served from ram cache
+        load(checkpoint_info, timer=Timer())
+        sd_models.unload_model_weights()
+    timer = Timer()
+    t0 = time.time()
+    with PeakRSS() as rss:
+        load(checkpoint_info, timer=timer)
+    t1 = time.time()
+    ok = sd_models.model_data.sd_model is not None
+    return {
+        **{ k: params[k] for k in ['size', 'format', 'load', 'cache', 'dtype', 'backend'] },
+        'ok': ok,
+        'time': round(t1 - t0, 3),
+        'phases': { k: round(v, 3) for k, v in timer.records.items() },
+        'rss_base': rss.base,
+        'rss_peak': rss.peak,
+        'rss_overhead': rss.peak - rss.base,
+        'file_size': os.path.getsize(params['filename']) if os.path.isfile(params['filename']) else None,
+    }
+
+
+def run_worker(worker, params):
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', worker, '--params', json.dumps(params)]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=False)
+    for line in reversed(res.stdout.splitlines()):
+        if line.startswith(marker):
+            return json.loads(line[len(marker):])
+    log.error({ 'worker': worker, 'params': params, 'code': res.returncode, 'error': res.stderr.strip().splitlines()[-5:] })
+    return None
+
+
+def compare(results, baseline, threshold):
+    """returns list of modes where time or peak rss regressed more than threshold compared to baseline"""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get('results', {}).get(key, None)
+        if previous is None or not current.get('ok', False) or not previous.get('ok', False):
+            continue
+        for metric in ['time', 'rss_overhead']:
+            if previous[metric] > 0 and current[metric] > previous[metric] * (1 + threshold):
+                regressions.append({ 'mode': key, 'metric': metric, 'baseline': previous[metric], 'current': current[metric], 'change': round(current[metric] / previous[metric] - 1, 3) })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'SD.Next model load benchmark')
+    parser.add_argument('--sizes', type=str, default='tiny,mid', help='synthetic model sizes, default: %(default)s')
+    parser.add_argument('--formats', type=str, default=','.join(formats), help='checkpoint formats, default: %(default)s')
+    parser.add_argument('--loads', type=str, default=','.join(loads), help='load modes, default: %(default)s')
+    parser.add_argument('--caches', type=str, default=','.join(caches), help='cache modes, default: %(default)s')
+    parser.add_argument('--dtypes', type=str, default=','.join(dtypes), help='checkpoint dtypes, default: %(default)s')
+    parser.add_argument('--model', type=str, action='append', default=[], help='additional existing checkpoint to benchmark, can be repeated')
+    parser.add_argument('--backend', type=str, choices=['original', 'diffusers'], default='original', help='model backend, synthetic checkpoints are only generated for original backend, default: %(default)s')
+    parser.add_argument('--dir', type=str, default=None, help='work directory for synthetic checkpoints and data, default: temporary')
+    parser.add_argument('--output', type=str, default=None, help='save results to json file')
+    parser.add_argument('--baseline', type=str, default=None, help='compare results with baseline json file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change considered a regression, default: %(default)s')
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--params', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        fn = worker_generate if args.worker == 'generate' else worker_load
+        print(marker + json.dumps(fn(json.loads(args.params))), flush=True)
+        return
+
+    workdir = os.path.abspath(args.dir) if args.dir else tempfile.mkdtemp(prefix='sdnext-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    log.info({ 'benchmark': 'load', 'workdir': workdir, 'backend': args.backend })
+    models = []
+    if args.backend == 'original':
+        for size in args.sizes.split(','):
+            for dtype in args.dtypes.split(','):
+                if not all(os.path.isfile(os.path.join(workdir, 'models', model_name(size, fmt, dtype))) for fmt in formats):
+                    t0 = time.time()
+                    res = run_worker('generate', { 'workdir': workdir, 'size': size, 'dtype': dtype })
+                    log.info({ 'generate': res, 'time': round(time.time() - t0, 2) })
+                for fmt in args.formats.split(','):
+                    models.append({ 'size': size, 'format': fmt, 'dtype': dtype, 'filename': os.path.join(workdir, 'models', model_name(size, fmt, dtype)) })
+    for filename in args.model:
+        models.append({ 'size': os.path.basename(filename), 'format': os.path.splitext(filename)[1][1:], 'dtype': 'native', 'filename': os.path.abspath(filename) })
+
+    results = {}
+    for model in models:
+        for load in args.loads.split(','):
+            if load == 'lazy' and model['format'] != 'safetensors':
+                continue
+            for cache in args.caches.split(','):
+                key = f"{model['size']}-{model['format']}-{model['dtype']}-{load}-{cache}"
+                res = run_worker('load', { **model, 'workdir': workdir, 'backend': args.backend, 'load': load, 'cache': cache })
+                if res is None:
+                    results[key] = { 'ok': False }
+                    continue
+                results[key] = res
+                log.info({ 'mode': key, 'time': res['time'], 'overhead': round(res['rss_overhead'] / 1024 / 1024), 'phases': res['phases'] })
+
+    import platform
+    report = { 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'system': { 'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count() }, 'results': results }
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+        log.info({ 'output': args.output, 'modes': len(results) })
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            log.warning({ 'regression': regression })
+        log.info({ 'baseline': args.baseline, 'compared': len(results), 'regressions': len(regressions) })
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+tiled vae accuracy check
+decodes latents and optionally encodes image with and without tiling using modules/sd_vae_tiled and reports mean and max absolute difference
+exits with non-zero status when mean difference exceeds sd_vae_tiled.tolerance
+"""
+import os
+import sys
+import argparse
+from util import log
+
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def init_webui(cpu):
+    sys.argv = [sys.argv[0], '--no-download'] + (['--use-cpu', 'all'] if cpu else [])
+    sys.path.insert(0, root)
+    os.chdir(root)
+    import modules.loader # pylint: disable=unused-import
+    from modules import shared, devices, sd_vae_tiled
+    return shared, devices, sd_vae_tiled
+
+
+def load_image(fn, size):
+    import numpy as np
+    import torch
+    from PIL import Image
+    image = Image.open(fn).convert('RGB')
+    scale = size / max(image.width, image.height)
+    image = image.resize((int(image.width * scale) // 8 * 8, int(image.height * scale) // 8 * 8), Image.Resampling.LANCZOS)
+    x = torch.from_numpy(np.array(image)).permute(2, 0, 1).float() / 127.5 - 1.0
+    return x.unsqueeze(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'SD.Next tiled VAE accuracy check')
+    parser.add_argument('--vae', type=str, default='stabilityai/sd-vae-ft-mse', help='diffusers vae folder or huggingface repo, default: %(default)s')
+    parser.add_argument('--size', type=int, default=1536, help='image size in pixels, default: %(default)s')
+    parser.add_argument('--tile', type=int, default=512, help='tile size in pixels, default: %(default)s')
+    parser.add_argument('--image', type=str, default=None, help='image used for encode check and as source of latents, default: random latents and decode only')
+    parser.add_argument('--cpu', default=False, action='store_true', help='run on cpu')
+    args = parser.parse_args()
+
+    shared, devices, sd_vae_tiled = init_webui(args.cpu)
+    import torch
+    import diffusers
+    shared.opts.data['sd_vae_tile_size'] = args.tile
+    vae = diffusers.AutoencoderKL.from_pretrained(args.vae, torch_dtype=devices.dtype_vae).to(devices.device)
+    scale = vae.config.scaling_factor
+    log.info({ 'check': 'vae tiled', 'vae': args.vae, 'device': str(devices.device), 'dtype': str(devices.dtype_vae), 'size': args.size, 'tile': args.tile, 'tolerance': sd_vae_tiled.tolerance })
+
+    results = {}
+    torch.manual_seed(0)
+    if args.image is not None:
+        image = load_image(args.image, args.size).to(devices.device, devices.dtype_vae)
+        encode_fn = lambda tile: vae.quant_conv(vae.encoder(tile)) # pylint: disable=unnecessary-lambda-assignment
+        results['encode'] = sd_vae_tiled.verify(encode_fn, image, vae.encoder, tiled_fn=sd_vae_tiled.encode)
+        with devices.inference_context():
+            latents = vae.encode(image).latent_dist.mean * scale
+    else:
+        latents = torch.randn((1, 4, args.size // 8, args.size // 8), device=devices.device, dtype=devices.dtype_vae)
+    decode_fn = lambda tile: vae.decode(tile / scale, return_dict=False)[0] # pylint: disable=unnecessary-lambda-assignment
+    results['decode'] = sd_vae_tiled.verify(decode_fn, latents, vae.decoder, tiled_fn=sd_vae_tiled.decode)
+
+    failed = False
+    for op, (mean, peak) in results.items():
+        ok = mean <= sd_vae_tiled.tolerance
+        failed = failed or not ok
+        log.info({ 'op': op, 'mean': round(mean, 4), 'max': round(peak, 4), 'ok': ok })
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
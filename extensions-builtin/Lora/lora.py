@@ -456,7 +456,9 @@ def list_available_loras():
     available_lora_hash_lookup.clear()
     forbidden_lora_aliases.update({"none": 1, "Addams": 1})
     os.makedirs(shared.cmd_opts.lora_dir, exist_ok=True)
-    for filename in sorted([*filter(extension_filter(['.PT', '.CKPT', '.SAFETENSORS']), directory_files(shared.cmd_opts.lora_dir))], key=str.lower):
+    candidates = sorted([*filter(extension_filter(['.PT', '.CKPT', '.SAFETENSORS']), directory_files(shared.cmd_opts.lora_dir))], key=str.lower)
+    sd_models.prefetch_safetensors_headers(candidates)
+    for filename in candidates:
         name = os.path.splitext(os.path.basename(filename))[0]
         entry = LoraOnDisk(name, filename)
         available_loras[name] = entry
@@ -464,6 +466,7 @@ def list_available_loras():
             forbidden_lora_aliases[entry.alias.lower()] = 1
         available_lora_aliases[name] = entry
         available_lora_aliases[entry.alias] = entry
+    hashes.queue_unhashed([(entry.filename, "lora/" + entry.name, entry.is_safetensors, entry.set_hash) for entry in available_loras.values() if not entry.hash])
 
 
 re_lora_name = re.compile(r"(.*)\s*\([0-9a-fA-F]+\)")
@@ -1,21 +1,23 @@
-import io
-import time
 import base64
 from io import BytesIO
 from typing import List, Dict, Any, Optional
 from threading import Lock
 from secrets import compare_digest
-from fastapi import FastAPI, APIRouter, Depends
+from fastapi import FastAPI, APIRouter, Depends, Request
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from PIL import PngImagePlugin,Image
 
 import piexif
 import piexif.helper
 import gradio as gr
-from modules import errors, shared, sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing
+from modules import errors, shared, sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, sd_models_cache, stream, image_encoder
 from modules.sd_vae import vae_dict
-from modules.api import models
+from modules.api import models, coalesce, jobs, binary
+from modules.progress import current_progress
+from modules.scheduler import scheduler, priorities, current_client, current_priority, current_job_id, INTERACTIVE
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
 from modules.textual_inversion.textual_inversion import create_embedding, train_embedding
 from modules.textual_inversion.preprocess import preprocess
@@ -53,6 +55,8 @@ def setUpscalers(req: dict):
     return reqDict
 
 def decode_base64_to_image(encoding):
+    if isinstance(encoding, Image.Image): # already decoded binary upload
+        return encoding
     if encoding.startswith("data:image/"):
         encoding = encoding.split(";")[1].split(",")[1]
     try:
@@ -63,15 +67,16 @@ def decode_base64_to_image(encoding):
         raise HTTPException(status_code=500, detail="Invalid encoded image") from e
 
 
-def save_image(image, fn, ext):
-    # actual save
+def encode_args(image, ext):
+    """prepare image, format and encoder arguments of api response image"""
     parameters = image.info.get('parameters', None)
     image_format = Image.registered_extensions()[f'.{ext}']
+    save_args = image_encoder.profile_args('api', image_format)
     if image_format == 'PNG':
         pnginfo_data = PngImagePlugin.PngInfo()
         for k, v in image.info.items():
             pnginfo_data.add_text(k, str(v))
-        image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, pnginfo=pnginfo_data)
+        save_args.update({ 'quality': shared.opts.jpeg_quality, 'pnginfo': pnginfo_data })
     elif image_format == 'JPEG':
         if image.mode == 'RGBA':
             shared.log.warning('Saving RGBA image as JPEG: Alpha channel will be lost')
@@ -79,22 +84,34 @@ def save_image(image, fn, ext):
         elif image.mode == 'I;16':
             image = image.point(lambda p: p * 0.0038910505836576).convert("L")
         exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters or "", encoding="unicode") } })
-        image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, exif=exif_bytes)
+        save_args.update({ 'quality': shared.opts.jpeg_quality, 'exif': exif_bytes })
     elif image_format == 'WEBP':
         if image.mode == 'I;16':
             image = image.point(lambda p: p * 0.0038910505836576).convert("RGB")
         exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters or "", encoding="unicode") } })
-        image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, lossless=shared.opts.webp_lossless, exif=exif_bytes)
+        save_args.update({ 'quality': shared.opts.jpeg_quality, 'lossless': shared.opts.webp_lossless, 'exif': exif_bytes })
     else:
         # shared.log.warning(f'Unrecognized image format: {extension} attempting save as {image_format}')
-        image.save(fn, format=image_format, quality=shared.opts.jpeg_quality)
+        save_args = { 'quality': shared.opts.jpeg_quality }
+    return image, image_format, save_args
+
+
+def save_image(image, fn, ext):
+    image, image_format, save_args = encode_args(image, ext)
+    image.save(fn, format=image_format, **save_args)
 
 
 def encode_pil_to_base64(image):
-    with io.BytesIO() as output_bytes:
-        save_image(image, output_bytes, shared.opts.samples_format)
-        bytes_data = output_bytes.getvalue()
-    return base64.b64encode(bytes_data)
+    return encode_images_to_base64([image])[0]
+
+
+def encode_images(images_list):
+    """encode all response images in parallel using encoder pool"""
+    return image_encoder.pool.encode_all([encode_args(image, shared.opts.samples_format) for image in images_list])
+
+
+def encode_images_to_base64(images_list):
+    return [base64.b64encode(data) for data in encode_images(images_list)]
 
 
 class Api:
@@ -119,6 +136,7 @@ class Api:
         self.add_api_route("/sdapi/v1/extra-batch-images", self.extras_batch_images_api, methods=["POST"], response_model=models.ExtrasBatchImagesResponse)
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
         self.add_api_route("/sdapi/v1/progress", self.progressapi, methods=["GET"], response_model=models.ProgressResponse)
+        self.add_api_route("/sdapi/v1/stream", self.streamapi, methods=["GET"])
         self.add_api_route("/sdapi/v1/interrogate", self.interrogateapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/interrupt", self.interruptapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/skip", self.skip, methods=["POST"])
@@ -143,19 +161,38 @@ class Api:
         self.add_api_route("/sdapi/v1/train/hypernetwork", self.train_hypernetwork, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/shutdown", self.shutdown, methods=["POST"])
         self.add_api_route("/sdapi/v1/memory", self.get_memory, methods=["GET"], response_model=models.MemoryResponse)
+        self.add_api_route("/sdapi/v1/coalesce", self.get_coalesce, methods=["GET"], response_model=models.CoalesceResponse)
+        self.add_api_route("/sdapi/v1/queue", self.get_queue, methods=["GET"], response_model=models.QueueResponse)
+        self.add_api_route("/sdapi/v1/queue/cancel", self.cancel_job, methods=["POST"])
+        self.add_api_route("/sdapi/v1/img2img/upload", self.img2imgapi_upload, methods=["POST"], response_model=models.ImageToImageResponse)
+        self.add_api_route("/sdapi/v1/extra-single-image/upload", self.extras_single_image_upload, methods=["POST"], response_model=models.ExtrasSingleImageResponse)
+        self.add_api_route("/sdapi/v1/extra-batch-images/upload", self.extras_batch_images_upload, methods=["POST"], response_model=models.ExtrasBatchImagesResponse)
+        self.add_api_route("/sdapi/v1/txt2img/async", self.text2imgapi_async, methods=["POST"], response_model=models.JobSubmitResponse)
+        self.add_api_route("/sdapi/v1/img2img/async", self.img2imgapi_async, methods=["POST"], response_model=models.JobSubmitResponse)
+        self.add_api_route("/sdapi/v1/jobs/{id_job}", self.get_async_job, methods=["GET"], response_model=models.JobStatusResponse)
+        self.add_api_route("/sdapi/v1/jobs/{id_job}", self.delete_async_job, methods=["DELETE"])
+        self.add_api_route("/sdapi/v1/jobs/{id_job}/images/{index}", self.get_async_job_image, methods=["GET"])
         self.add_api_route("/sdapi/v1/unload-checkpoint", self.unloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/reload-checkpoint", self.reloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
         self.add_api_route("/sdapi/v1/script-info", self.get_script_info, methods=["GET"], response_model=List[models.ScriptInfo])
         self.add_api_route("/sdapi/v1/log", self.get_log_buffer, methods=["GET"], response_model=List) # bypass auth
+        self.add_api_route("/sdapi/v1/history", self.get_history, methods=["GET"], response_model=List)
         self.add_api_route("/sdapi/v1/extra-networks", self.get_extra_networks, methods=["GET"], response_model=List[models.ExtraNetworkItem])
         self.default_script_arg_txt2img = []
         self.default_script_arg_img2img = []
 
     def add_api_route(self, path: str, endpoint, **kwargs):
         if shared.cmd_opts.auth or shared.cmd_opts.auth_file:
-            return self.app.add_api_route(path, endpoint, dependencies=[Depends(self.auth)], **kwargs)
-        return self.app.add_api_route(path, endpoint, **kwargs)
+            return self.app.add_api_route(path, endpoint, dependencies=[Depends(self.auth), Depends(self.job_context)], **kwargs)
+        return self.app.add_api_route(path, endpoint, dependencies=[Depends(self.job_context)], **kwargs)
+
+    async def job_context(self, request: Request):
+        # async so context variables are visible to endpoint which runs in threadpool with copy of this context
+        current_client.set(request.headers.get('x-client-id', None) or (request.client.host if request.client else 'api'))
+        current_priority.set(priorities.get(request.headers.get('x-priority', '').lower(), INTERACTIVE))
+        current_job_id.set(request.headers.get('x-job-id', None))
+        binary.set_requested(request)
 
     def auth(self, credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
         if credentials.username in self.credentials:
@@ -169,6 +206,13 @@ class Api:
             shared.log.buffer.clear()
         return lines
 
+    def get_history(self, req: models.HistoryRequest = Depends()):
+        from modules.generation_log import log
+        try:
+            return log.query(since=req.since, until=req.until, model=req.model, seed=req.seed, limit=req.limit)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid date: {e}") from e
+
     def get_selectable_script(self, script_name, script_runner):
         if script_name is None or script_name == "":
             return None, None
@@ -261,7 +305,28 @@ class Api:
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
 
-        with self.queue_lock:
+        sd_models_cache.prefetch_override(args.get('override_settings', None)) # start reading requested model while waiting for queue
+        if coalesce.coalescer.enabled() and selectable_scripts is None and not txt2imgreq.alwayson_scripts and args.get('n_iter', 1) == 1:
+            def run(members):
+                with scheduler.job('api-txt2img'):
+                    members = coalesce.live(members) # drop requests cancelled while group was queued
+                    if len(members) == 0:
+                        return
+                    p = StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **coalesce.merge(members))
+                    p.scripts = script_runner
+                    p.outpath_grids = shared.opts.outdir_grids or shared.opts.outdir_txt2img_grids
+                    p.outpath_samples = shared.opts.outdir_samples or shared.opts.outdir_txt2img_samples
+                    shared.state.begin('api-txt2img')
+                    p.script_args = tuple(self.init_script_args(p, txt2imgreq, self.default_script_arg_txt2img, None, None, script_runner))
+                    processed = process_images(p)
+                    shared.state.end()
+                coalesce.split(processed, members)
+            images, info = coalesce.coalescer.submit(coalesce.request_key(args), coalesce.Member(args), run)
+            if binary.requested.get():
+                return binary.multipart({ 'parameters': vars(txt2imgreq), 'info': info }, encode_images(images) if send_images else [], shared.opts.samples_format)
+            b64images = encode_images_to_base64(images) if send_images else []
+            return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=info)
+        with scheduler.job('api-txt2img'):
             p = StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)
             p.scripts = script_runner
             p.outpath_grids = shared.opts.outdir_grids or shared.opts.outdir_txt2img_grids
@@ -275,7 +340,9 @@ class Api:
                 processed = process_images(p)
             shared.state.end()
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
+        if binary.requested.get():
+            return binary.multipart({ 'parameters': vars(txt2imgreq), 'info': processed.js() }, encode_images(processed.images) if send_images else [], shared.opts.samples_format)
+        b64images = encode_images_to_base64(processed.images) if send_images else []
         return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
 
     def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
@@ -308,7 +375,8 @@ class Api:
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
 
-        with self.queue_lock:
+        sd_models_cache.prefetch_override(args.get('override_settings', None)) # start reading requested model while waiting for queue
+        with scheduler.job('api-img2img'):
             p = StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)
             p.init_images = [decode_base64_to_image(x) for x in init_images]
             p.scripts = script_runner
@@ -323,17 +391,24 @@ class Api:
                 processed = process_images(p)
             shared.state.end()
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
         if not img2imgreq.include_init_images:
             img2imgreq.init_images = None
             img2imgreq.mask = None
+        else: # binary uploads are returned by name
+            img2imgreq.init_images = binary.upload_name(img2imgreq.init_images)
+            img2imgreq.mask = binary.upload_name(img2imgreq.mask)
+        if binary.requested.get():
+            return binary.multipart({ 'parameters': vars(img2imgreq), 'info': processed.js() }, encode_images(processed.images) if send_images else [], shared.opts.samples_format)
+        b64images = encode_images_to_base64(processed.images) if send_images else []
         return models.ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
 
     def extras_single_image_api(self, req: models.ExtrasSingleImageRequest):
         reqDict = setUpscalers(req)
         reqDict['image'] = decode_base64_to_image(reqDict['image'])
-        with self.queue_lock:
+        with scheduler.job('api-extras'):
             result = postprocessing.run_extras(extras_mode=0, image_folder="", input_dir="", output_dir="", save_output=False, **reqDict)
+        if binary.requested.get():
+            return binary.multipart({ 'html_info': result[1] }, encode_images(result[0][:1]), shared.opts.samples_format)
         return models.ExtrasSingleImageResponse(image=encode_pil_to_base64(result[0][0]), html_info=result[1])
 
     def extras_batch_images_api(self, req: models.ExtrasBatchImagesRequest):
@@ -342,10 +417,41 @@ class Api:
         image_list = reqDict.pop('imageList', [])
         image_folder = [decode_base64_to_image(x.data) for x in image_list]
 
-        with self.queue_lock:
+        with scheduler.job('api-extras'):
             result = postprocessing.run_extras(extras_mode=1, image_folder=image_folder, image="", input_dir="", output_dir="", save_output=False, **reqDict)
-
-        return models.ExtrasBatchImagesResponse(images=list(map(encode_pil_to_base64, result[0])), html_info=result[1])
+        if binary.requested.get():
+            return binary.multipart({ 'html_info': result[1] }, encode_images(result[0]), shared.opts.samples_format)
+        return models.ExtrasBatchImagesResponse(images=encode_images_to_base64(result[0]), html_info=result[1])
+
+    async def img2imgapi_upload(self, request: Request):
+        # multipart/form-data with json request in 'request' field and images in 'init_images' and 'mask' file fields
+        req, files = await binary.read_upload(request)
+        img2imgreq = binary.parse(models.StableDiffusionImg2ImgProcessingAPI, req)
+        if 'init_images' in files:
+            img2imgreq.init_images = files['init_images']
+        elif not img2imgreq.init_images:
+            raise HTTPException(status_code=422, detail="Init image not found in upload")
+        if 'mask' in files:
+            img2imgreq.mask = files['mask'][0]
+        return await run_in_threadpool(self.img2imgapi, img2imgreq)
+
+    async def extras_single_image_upload(self, request: Request):
+        # multipart/form-data with json request in 'request' field and image in 'image' file field
+        req, files = await binary.read_upload(request)
+        if 'image' not in files:
+            raise HTTPException(status_code=422, detail="Image not found in upload")
+        extrasreq = binary.parse(models.ExtrasSingleImageRequest, { **req, 'image': '' })
+        extrasreq.image = files['image'][0]
+        return await run_in_threadpool(self.extras_single_image_api, extrasreq)
+
+    async def extras_batch_images_upload(self, request: Request):
+        # multipart/form-data with json request in 'request' field and images in 'images' file fields
+        req, files = await binary.read_upload(request)
+        if 'images' not in files:
+            raise HTTPException(status_code=422, detail="Images not found in upload")
+        extrasreq = binary.parse(models.ExtrasBatchImagesRequest, { **req, 'imageList': [] })
+        extrasreq.imageList = [models.FileData.construct(data=image, name=image.upload_name or f'{i:05}') for i, image in enumerate(files['images'])]
+        return await run_in_threadpool(self.extras_batch_images_api, extrasreq)
 
     def pnginfoapi(self, req: models.PNGInfoRequest):
         if not req.image.strip():
@@ -364,25 +470,10 @@ class Api:
         return models.PNGInfoResponse(info=geninfo, items=items)
 
     def progressapi(self, req: models.ProgressRequest = Depends()):
-        # copy from check_progress_call of ui.py
-
         if shared.state.job_count == 0:
             return models.ProgressResponse(progress=0, eta_relative=0, state=shared.state.dict(), textinfo=shared.state.textinfo)
-
-        # avoid dividing zero
-        progress = 0.01
-
-        if shared.state.job_count > 0:
-            progress += shared.state.job_no / shared.state.job_count
-        if shared.state.sampling_steps > 0:
-            progress += 1 / shared.state.job_count * shared.state.sampling_step / shared.state.sampling_steps
-
-        time_since_start = time.time() - shared.state.time_start
-        eta = time_since_start / progress
-        eta_relative = eta-time_since_start
-
-        progress = min(progress, 1)
-
+        progress, eta = current_progress()
+        eta_relative = eta if eta is not None else 0
         shared.state.set_current_image()
 
         current_image = None
@@ -391,6 +482,11 @@ class Api:
 
         return models.ProgressResponse(progress=progress, eta_relative=eta_relative, state=shared.state.dict(), current_image=current_image, textinfo=shared.state.textinfo)
 
+    async def streamapi(self, request: Request, job: str = None):
+        # server-sent events: begin, progress, preview, image and end of jobs, optionally limited to single job id
+        headers = { 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'Content-Encoding': 'identity' } # identity encoding prevents gzip middleware from buffering events
+        return StreamingResponse(stream.events(request, job), media_type='text/event-stream', headers=headers)
+
     def interrogateapi(self, interrogatereq: models.InterrogateRequest):
         image_b64 = interrogatereq.image
         if image_b64 is None:
@@ -400,7 +496,7 @@ class Api:
         img = img.convert('RGB')
 
         # Override object param
-        with self.queue_lock:
+        with scheduler.job('api-interrogate'):
             if interrogatereq.model == "clip":
                 processed = shared.interrogator.interrogate(img)
             elif interrogatereq.model == "deepdanbooru":
@@ -656,7 +752,87 @@ class Api:
                 cuda = { 'error': 'unavailable' }
         except Exception as err:
             cuda = { 'error': f'{err}' }
-        return models.MemoryResponse(ram = ram, cuda = cuda)
+        try:
+            from modules.sd_models import checkpoints_loaded
+            checkpoints = checkpoints_loaded.stats()
+        except Exception as err:
+            checkpoints = { 'error': f'{err}' }
+        try:
+            from modules.prompt_cache import cache
+            prompts = cache.stats()
+        except Exception as err:
+            prompts = { 'error': f'{err}' }
+        try:
+            prefetch = sd_models_cache.prefetcher.stats()
+        except Exception as err:
+            prefetch = { 'error': f'{err}' }
+        return models.MemoryResponse(ram = ram, cuda = cuda, checkpoints = checkpoints, prompts = prompts, prefetch = prefetch)
+
+    def get_coalesce(self):
+        return models.CoalesceResponse(**coalesce.coalescer.stats())
+
+    def text2imgapi_async(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+        txt2imgreq.send_images = True # results are kept in job store
+        binary.requested.set(False) # job store keeps regular response, binary results are downloaded per image
+        job = jobs.store.submit('txt2img', self.text2imgapi, txt2imgreq)
+        return models.JobSubmitResponse(id=job.id)
+
+    def img2imgapi_async(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
+        img2imgreq.send_images = True
+        binary.requested.set(False)
+        job = jobs.store.submit('img2img', self.img2imgapi, img2imgreq)
+        return models.JobSubmitResponse(id=job.id)
+
+    def get_async_job(self, id_job: str, preview: bool = False):
+        job = jobs.store.get(id_job)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job not found: {id_job}")
+        status = job.state()
+        progress, eta, position, current_image = None, None, None, None
+        if status == 'running':
+            progress, eta = current_progress()
+            if preview:
+                shared.state.set_current_image()
+                if shared.state.current_image is not None:
+                    current_image = encode_pil_to_base64(shared.state.current_image)
+        elif status == 'queued':
+            position = scheduler.position(id_job)
+        elif status == 'done':
+            progress = 1
+        images = len(job.response.images) if job.response is not None else 0
+        info = job.response.info if job.response is not None else None
+        return models.JobStatusResponse(id=job.id, name=job.name, status=status, progress=progress, eta=eta, queue_position=position, images=images, info=info, error=job.error, current_image=current_image)
+
+    def get_async_job_image(self, id_job: str, index: int):
+        """download result image of async job, images are available only after job is done and not while it is still running"""
+        job = jobs.store.get(id_job)
+        if job is None or job.response is None:
+            raise HTTPException(status_code=404, detail=f"Job results not found: {id_job}")
+        if index < 0 or index >= len(job.response.images):
+            raise HTTPException(status_code=404, detail=f"Image not found: {id_job} index={index}")
+        fmt = shared.opts.samples_format.lower()
+        return Response(content=base64.b64decode(job.response.images[index]), media_type='image/jpeg' if fmt in ['jpg', 'jpeg'] else f'image/{fmt}')
+
+    def delete_async_job(self, id_job: str):
+        job = jobs.store.get(id_job)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job not found: {id_job}")
+        if job.finished is None:
+            return { 'id': id_job, 'cancelled': jobs.store.cancel(id_job) }
+        jobs.store.remove(id_job)
+        return { 'id': id_job, 'removed': True }
+
+    def get_queue(self):
+        return models.QueueResponse(stats=scheduler.stats(), jobs=scheduler.history())
+
+    def cancel_job(self, req: models.CancelJobRequest):
+        if jobs.store.get(req.id) is not None: # async job may not have reached scheduler yet
+            return { 'id': req.id, 'cancelled': jobs.store.cancel(req.id) }
+        if coalesce.coalescer.cancel(req.id):
+            return { 'id': req.id, 'cancelled': True }
+        if scheduler.get(req.id) is None:
+            raise HTTPException(status_code=404, detail=f"Job not found: {req.id}")
+        return { 'id': req.id, 'cancelled': scheduler.cancel(req.id) }
 
     def launch(self):
         config = {
@@ -0,0 +1,79 @@
+import io
+import json
+import uuid
+import contextvars
+from PIL import Image
+from pydantic import ValidationError
+from fastapi import Request
+from fastapi.responses import Response
+from fastapi.exceptions import HTTPException
+
+
+media_type = 'multipart/mixed'
+requested = contextvars.ContextVar('api_binary', default=False) # set per request from accept header
+
+
+def mime(ext):
+    ext = ext.lower().lstrip('.')
+    return 'image/jpeg' if ext in ['jpg', 'jpeg'] else f'image/{ext}'
+
+
+def set_requested(request: Request):
+    requested.set(media_type in request.headers.get('accept', '').lower())
+
+
+def part(content_type, content, filename=None):
+    headers = f'Content-Type: {content_type}\r\nContent-Length: {len(content)}\r\n'
+    if filename is not None:
+        headers += f'Content-Disposition: attachment; filename="{filename}"\r\n'
+    return headers.encode('ascii') + b'\r\n' + content
+
+
+def multipart(info: dict, images: list, ext: str):
+    """multipart/mixed response with json info as first part followed by raw encoded images"""
+    boundary = uuid.uuid4().hex
+    parts = [part('application/json', json.dumps(info, default=str).encode('utf-8'), 'info.json')]
+    parts += [part(mime(ext), data, f'{i:05}.{ext}') for i, data in enumerate(images)]
+    delimiter = f'--{boundary}\r\n'.encode('ascii')
+    body = b''.join(delimiter + p + b'\r\n' for p in parts) + f'--{boundary}--\r\n'.encode('ascii')
+    return Response(content=body, media_type=f'{media_type}; boundary={boundary}')
+
+
+def parse(model, req: dict):
+    """build request model from uploaded json, validation errors are reported same as for json requests"""
+    try:
+        return model(**req)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors()) from e
+
+
+def upload_name(value):
+    """uploaded images are reported in response parameters by their upload filename"""
+    if isinstance(value, list):
+        return [upload_name(v) for v in value]
+    return getattr(value, 'upload_name', '') if isinstance(value, Image.Image) else value
+
+
+async def read_upload(request: Request):
+    """parse multipart/form-data upload: json request in 'request' field and images as file fields
+    returns request dict and dict of field name to list of decoded images"""
+    try:
+        form = await request.form()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid upload: {e}") from e
+    try:
+        req = json.loads(form.get('request', None) or '{}')
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Invalid request field: {e}") from e
+    files = {}
+    for name, value in form.multi_items():
+        if name == 'request' or isinstance(value, str):
+            continue
+        try:
+            image = Image.open(io.BytesIO(await value.read()))
+            image.load()
+            image.upload_name = value.filename
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Invalid image: field={name} file={value.filename} {e}") from e
+        files.setdefault(name, []).append(image)
+    return req, files
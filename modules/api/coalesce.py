@@ -0,0 +1,215 @@
+import json
+import time
+import uuid
+import threading
+from modules import shared
+from modules.scheduler import JobCancelled, current_job_id, current_cancel
+
+
+per_request = ['prompt', 'negative_prompt', 'seed', 'subseed', 'batch_size'] # fields that may differ between merged requests
+
+
+def request_key(args):
+    """requests with same key can be served by single batched run: same model, resolution, sampler, steps, cfg, settings and scripts"""
+    fields = { k: v for k, v in args.items() if k not in per_request }
+    fields['model'] = shared.opts.sd_model_checkpoint
+    return json.dumps(fields, sort_keys=True, default=str)
+
+
+class Member:
+    """single caller waiting in a group, holds its own prompts and seeds and receives its own slice of results"""
+    def __init__(self, args):
+        from modules.processing import get_fixed_seed
+        self.args = args
+        self.count = max(1, int(args.get('batch_size', 1) or 1))
+        seed = int(get_fixed_seed(args.get('seed', -1)))
+        subseed = int(get_fixed_seed(args.get('subseed', -1)))
+        variation = (args.get('subseed_strength', 0) or 0) != 0
+        self.seeds = [seed + (0 if variation else i) for i in range(self.count)]
+        self.subseeds = [subseed + i for i in range(self.count)]
+        self.submitted = time.time()
+        self.started = None
+        self.result = None
+        self.id = current_job_id.get()
+        self.cancel = current_cancel.get()
+        self.cancelled = False
+        self.done = threading.Event()
+
+
+class Group:
+    def __init__(self):
+        self.id = f'job({uuid.uuid4().hex})' # scheduler job of whole group so that cancelling one member does not interrupt others
+        self.members = []
+        self.full = threading.Event()
+        self.started = False
+        self.error = None
+
+    def images(self):
+        return sum(m.count for m in self.members)
+
+
+def live(members):
+    """members that were not cancelled while group was waiting for scheduler"""
+    return [m for m in members if not m.cancelled]
+
+
+def merge(members):
+    """single processing args for all members of a group, prompts and seeds are passed as per-image lists"""
+    args = dict(members[0].args)
+    args['prompt'] = [m.args.get('prompt', '') for m in members for _i in range(m.count)]
+    args['negative_prompt'] = [m.args.get('negative_prompt', '') for m in members for _i in range(m.count)]
+    args['seed'] = [s for m in members for s in m.seeds]
+    args['subseed'] = [s for m in members for s in m.subseeds]
+    args['batch_size'] = sum(m.count for m in members)
+    args['n_iter'] = 1
+    args['do_not_save_grid'] = True # grid of unrelated requests is meaningless
+    return args
+
+
+def split(processed, members):
+    """assign each member its images and info with its own prompts and seeds"""
+    images = processed.images[processed.index_of_first_image:]
+    info = json.loads(processed.js())
+    offset = 0
+    for m in members:
+        n = m.count
+        own = slice(offset, offset + n)
+        member_info = dict(info)
+        for field in ['all_prompts', 'all_negative_prompts', 'all_seeds', 'all_subseeds', 'infotexts']:
+            if isinstance(info.get(field, None), list):
+                member_info[field] = info[field][own]
+        member_info['prompt'] = m.args.get('prompt', '')
+        member_info['negative_prompt'] = m.args.get('negative_prompt', '')
+        member_info['seed'] = m.seeds[0]
+        member_info['subseed'] = m.subseeds[0]
+        member_info['batch_size'] = n
+        member_info['index_of_first_image'] = 0
+        m.result = (images[own], json.dumps(member_info))
+        offset += n
+
+
+class Coalescer:
+    """merges compatible concurrent api requests into single batched generation
+    first request of a group becomes leader: it waits for coalescing window or until group is full and then runs whole group
+    other requests wait for leader and receive their own slice of results"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {} # key -> group still accepting members
+        self.active = set() # groups that have not finished yet
+        self.requests = 0
+        self.runs = 0
+        self.coalesced = 0
+        self.images = 0
+        self.served = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.run_time = 0.0
+
+    def enabled(self):
+        return shared.opts.api_coalesce
+
+    def close(self, key, group):
+        if self.groups.get(key, None) is group:
+            del self.groups[key]
+        group.full.set()
+
+    def submit(self, key, member, run):
+        """run(members) must fill result of every member, returns result of this member"""
+        max_batch = max(1, shared.opts.api_coalesce_max_batch)
+        with self.lock:
+            if member.cancelled or (member.cancel is not None and member.cancel.is_set()): # checked under lock so cancel either sees member in group or member sees cancel
+                raise JobCancelled(f'Job cancelled: id={member.id}')
+            self.requests += 1
+            group = self.groups.get(key, None)
+            if group is not None and group.images() + member.count > max_batch:
+                self.close(key, group)
+                group = None
+            leader = group is None
+            if leader:
+                group = Group()
+                self.groups[key] = group
+                self.active.add(group)
+            group.members.append(member)
+            if group.images() >= max_batch:
+                self.close(key, group)
+        if leader:
+            group.full.wait(timeout=shared.opts.api_coalesce_window / 1000)
+            with self.lock:
+                self.close(key, group)
+            self.execute(group, run) # leader runs group even if its own request was cancelled
+        else:
+            member.done.wait()
+        if member.cancelled:
+            raise JobCancelled(f'Job cancelled: id={member.id}')
+        if group.error is not None:
+            raise group.error
+        return member.result
+
+    def cancel(self, id_job):
+        """cancel member of waiting or running group, waiting member is removed from its group and released immediately
+        running group is interrupted only if all of its members are cancelled"""
+        from modules.scheduler import scheduler
+        with self.lock:
+            for group in self.active:
+                member = next((m for m in group.members if m.id == id_job), None)
+                if member is None:
+                    continue
+                member.cancelled = True
+                if not group.started:
+                    group.members.remove(member)
+                    member.done.set()
+                elif len(live(group.members)) == 0:
+                    scheduler.cancel(group.id)
+                shared.log.info(f'API coalesce: cancelled id={id_job} started={group.started}')
+                return True
+        return False
+
+    def execute(self, group, run):
+        t0 = time.time()
+        with self.lock:
+            group.started = True
+            members = live(group.members)
+            group.members = members
+        for m in members:
+            m.started = t0
+        token_id, token_cancel = current_job_id.set(group.id), current_cancel.set(None) # group job is not owned by leader request
+        try:
+            if len(members) > 1:
+                shared.log.debug(f'API coalesce: requests={len(members)} images={group.images()}')
+            if len(members) > 0:
+                run(members)
+        except Exception as e:
+            group.error = e
+        finally:
+            current_job_id.reset(token_id)
+            current_cancel.reset(token_cancel)
+            t1 = time.time()
+            with self.lock:
+                self.runs += 1
+                self.coalesced += len(group.members) if len(group.members) > 1 else 0
+                self.images += group.images()
+                self.run_time += t1 - t0
+                self.served += len(group.members)
+                for m in group.members:
+                    self.latency_total += m.started - m.submitted
+                    self.latency_max = max(self.latency_max, m.started - m.submitted)
+                self.active.discard(group)
+            for m in group.members:
+                m.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled(),
+                'requests': self.requests,
+                'runs': self.runs,
+                'coalesced': self.coalesced,
+                'images': self.images,
+                'batch_avg': round(self.images / self.runs, 2) if self.runs > 0 else 0,
+                'latency_avg': round(self.latency_total / self.served, 3) if self.served > 0 else 0,
+                'latency_max': round(self.latency_max, 3),
+                'throughput': round(self.images / self.run_time, 3) if self.run_time > 0 else 0,
+            }
+
+
+coalescer = Coalescer()
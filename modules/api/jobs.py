@@ -0,0 +1,100 @@
+import time
+import uuid
+import threading
+import contextvars
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from modules import shared
+from modules.api import coalesce
+from modules.scheduler import scheduler, current_job_id, current_cancel
+
+
+class AsyncJob:
+    def __init__(self, name):
+        self.id = f'job({uuid.uuid4().hex})'
+        self.name = name
+        self.status = 'pending' # pending, queued, running, done, failed, cancelled
+        self.cancelled = threading.Event() # seen by scheduler and coalescer through context before job reaches them
+        self.submitted = time.time()
+        self.finished = None
+        self.response = None
+        self.error = None
+
+    def state(self):
+        """status of unfinished job is taken from scheduler once job reaches it"""
+        if self.status in ['done', 'failed', 'cancelled']:
+            return self.status
+        job = scheduler.get(self.id)
+        return job.status if job is not None and job.status in ['queued', 'running'] else self.status
+
+
+class JobStore:
+    """asynchronous api jobs and their results
+    each job runs normal blocking api handler in worker thread with scheduler job id set to its own id
+    finished jobs are kept until ttl expires or store limit is reached, oldest finished jobs are evicted first"""
+    def __init__(self):
+        self.jobs = collections.OrderedDict() # id -> job
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def evict(self):
+        now = time.time()
+        with self.lock:
+            for job in [j for j in self.jobs.values() if j.finished is not None and now - j.finished > shared.opts.api_jobs_ttl]:
+                del self.jobs[job.id]
+            finished = [j for j in self.jobs.values() if j.finished is not None]
+            while len(self.jobs) > shared.opts.api_jobs_limit and len(finished) > 0:
+                del self.jobs[finished.pop(0).id]
+
+    def submit(self, name, fn, *args):
+        """start fn(*args) in background and return job immediately"""
+        self.evict()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='api-job') # workers mostly wait for scheduler, this bounds waiting threads
+        job = AsyncJob(name)
+        with self.lock:
+            self.jobs[job.id] = job
+        current_job_id.set(job.id)
+        current_cancel.set(job.cancelled)
+        context = contextvars.copy_context() # carries job id, cancel event, client and priority into worker
+        self.executor.submit(context.run, self.run, job, fn, *args)
+        return job
+
+    def run(self, job, fn, *args):
+        if job.cancelled.is_set():
+            return
+        job.status = 'queued'
+        try:
+            job.response = fn(*args)
+            job.status = 'cancelled' if job.cancelled.is_set() else 'done'
+        except Exception as e:
+            job.error = f'{type(e).__name__}: {e}'
+            job.status = 'cancelled' if job.cancelled.is_set() else 'failed'
+            if not job.cancelled.is_set():
+                shared.log.error(f'API job failed: id={job.id} name={job.name} {job.error}')
+        finally:
+            job.finished = time.time()
+
+    def get(self, id_job):
+        self.evict()
+        with self.lock:
+            return self.jobs.get(id_job, None)
+
+    def cancel(self, id_job):
+        job = self.get(id_job)
+        if job is None or job.finished is not None:
+            return False
+        job.cancelled.set()
+        scheduler.cancel(id_job)
+        coalesce.coalescer.cancel(id_job)
+        if job.status == 'pending': # never started so it will not finish by itself
+            job.status = 'cancelled'
+            job.finished = time.time()
+        return True
+
+    def remove(self, id_job):
+        with self.lock:
+            return self.jobs.pop(id_job, None)
+
+
+store = JobStore()
@@ -176,6 +176,13 @@ class LogRequest(BaseModel):
     lines: int = Field(default=100, title="Lines", description="How many lines to return")
     clear: bool = Field(default=False, title="Clear", description="Should the log be cleared after returning the lines?")
 
+class HistoryRequest(BaseModel):
+    since: Optional[str] = Field(default=None, title="Since", description="Only entries at or after this ISO date or unix timestamp")
+    until: Optional[str] = Field(default=None, title="Until", description="Only entries at or before this ISO date or unix timestamp, date without time includes whole day")
+    model: Optional[str] = Field(default=None, title="Model", description="Only entries whose model name contains this text or whose model hash matches")
+    seed: Optional[int] = Field(default=None, title="Seed", description="Only entries with this seed")
+    limit: int = Field(default=100, title="Limit", description="Maximum number of newest entries to return, 0 for all")
+
 class ProgressRequest(BaseModel):
     skip_current_image: bool = Field(default=False, title="Skip current image", description="Skip current image serialization")
 
@@ -305,6 +312,42 @@ class EmbeddingsResponse(BaseModel):
 class MemoryResponse(BaseModel):
     ram: dict = Field(title="RAM", description="System memory stats")
     cuda: dict = Field(title="CUDA", description="nVidia CUDA memory stats")
+    checkpoints: dict = Field(default=None, title="Checkpoints", description="Model RAM cache stats")
+    prompts: dict = Field(default=None, title="Prompts", description="Encoded prompt cache stats")
+    prefetch: dict = Field(default=None, title="Prefetch", description="Checkpoint prefetch stats")
+
+class QueueResponse(BaseModel):
+    stats: dict = Field(title="Stats", description="Queue depth, job counts and wait time metrics")
+    jobs: List[dict] = Field(title="Jobs", description="Queued, running and recently finished jobs")
+
+class CancelJobRequest(BaseModel):
+    id: str = Field(title="ID", description="Job id as returned by queue or passed in X-Job-ID header")
+
+class JobSubmitResponse(BaseModel):
+    id: str = Field(title="ID", description="Job id used to query status, download results or cancel job")
+
+class JobStatusResponse(BaseModel):
+    id: str = Field(title="ID", description="Job id")
+    name: str = Field(title="Name", description="Job type")
+    status: str = Field(title="Status", description="One of pending, queued, running, done, failed, cancelled")
+    progress: Optional[float] = Field(default=None, title="Progress", description="The progress with a range of 0 to 1")
+    eta: Optional[float] = Field(default=None, title="ETA", description="Estimated seconds until job completes")
+    queue_position: Optional[int] = Field(default=None, title="Queue position", description="Number of jobs that will run before this one")
+    images: int = Field(default=0, title="Images", description="Number of result images available for download, images become available only once job is done and partial results of running job are not exposed")
+    info: Optional[str] = Field(default=None, title="Info", description="Generation info of completed job")
+    error: Optional[str] = Field(default=None, title="Error", description="Error of failed job")
+    current_image: Optional[str] = Field(default=None, title="Current image", description="Live preview of running job in base64 format, only when requested with preview=true")
+
+class CoalesceResponse(BaseModel):
+    enabled: bool = Field(title="Enabled", description="Request coalescing is enabled")
+    requests: int = Field(title="Requests", description="Requests submitted to coalescing scheduler")
+    runs: int = Field(title="Runs", description="Batched generations executed")
+    coalesced: int = Field(title="Coalesced", description="Requests served as part of a merged batch")
+    images: int = Field(title="Images", description="Images generated")
+    batch_avg: float = Field(title="Batch", description="Average images per run")
+    latency_avg: float = Field(title="Latency", description="Average seconds a request waited for its batch to start")
+    latency_max: float = Field(title="Max latency", description="Maximum seconds a request waited for its batch to start")
+    throughput: float = Field(title="Throughput", description="Images per second of generation time")
 
 class ScriptsList(BaseModel):
     txt2img: list = Field(default=None, title="Txt2img", description="Titles of scripts (txt2img)")
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import threading
+from modules import shared
+from modules.paths import data_path
+
+
+db_filename = os.path.join(data_path, "cache.db")
+stores = {}
+stores_lock = threading.Lock()
+sqlite_failed = False
+commit_every = 256 # auto-commit batch size for pending upserts
+commit_interval = 2.0 # or when oldest pending upsert is older than this many seconds
+
+
+def file_stat(filename):
+    """returns (size, mtime, inode) used to validate cached entries or None if file does not exist"""
+    try:
+        stat = os.stat(filename)
+        return stat.st_size, stat.st_mtime, stat.st_ino
+    except OSError:
+        return None
+
+
+class JSONStore:
+    """legacy store that keeps everything in memory and rewrites whole json file on commit"""
+    def __init__(self, filename, flat=None):
+        self.filename = filename
+        self.flat = flat # file holds a single section with this name instead of dict of sections
+        self.lock = threading.RLock()
+        self.pending = 0
+        data = shared.readfile(filename) if os.path.isfile(filename) else {}
+        self.data = { flat: data } if flat is not None else data
+
+    def section(self, section):
+        with self.lock:
+            return self.data.setdefault(section, {})
+
+    def get(self, section, key, filename=None): # pylint: disable=unused-argument
+        with self.lock:
+            return self.data.get(section, {}).get(key, None)
+
+    def set(self, section, key, value, filename=None): # pylint: disable=unused-argument
+        with self.lock:
+            self.data.setdefault(section, {})[key] = value
+            self.pending += 1
+
+    def commit(self):
+        with self.lock:
+            if self.pending == 0:
+                return
+            shared.writefile(self.data[self.flat] if self.flat is not None else self.data, self.filename, silent=True)
+            self.pending = 0
+
+
+class SQLiteStore:
+    """sqlite store in wal mode with point reads, point upserts and batched commits
+    entries are keyed by section and key and validated against file size, mtime and inode
+    upserts are buffered in memory and written in a single short transaction so write lock is never held between calls"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.pending = {} # (section, key) -> row waiting for commit
+        self.pending_since = 0
+        self.imported = set()
+        self.conn = sqlite3.connect(filename, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries (section TEXT NOT NULL, key TEXT NOT NULL, size INTEGER, mtime REAL, inode INTEGER, value TEXT, PRIMARY KEY (section, key))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS imported (filename TEXT PRIMARY KEY, time REAL)')
+
+    def import_json(self, json_filename, flat=None):
+        """one-time transparent import of legacy json cache file"""
+        if json_filename in self.imported:
+            return
+        with self.lock:
+            self.imported.add(json_filename)
+            if self.conn.execute('SELECT 1 FROM imported WHERE filename=?', (json_filename,)).fetchone() is not None:
+                return
+            self.commit()
+            t0 = time.time()
+            data = shared.readfile(json_filename, silent=True) if os.path.isfile(json_filename) else {}
+            sections = { flat: data } if flat is not None else data
+            n = 0
+            self.conn.execute('BEGIN')
+            for section, entries in sections.items():
+                if not isinstance(entries, dict):
+                    continue
+                for key, value in entries.items():
+                    mtime = value.get('mtime', None) if isinstance(value, dict) else None
+                    self.conn.execute('INSERT OR IGNORE INTO entries (section, key, size, mtime, inode, value) VALUES (?, ?, NULL, ?, NULL, ?)', (section, key, mtime, json.dumps(value)))
+                    n += 1
+            self.conn.execute('INSERT OR REPLACE INTO imported (filename, time) VALUES (?, ?)', (json_filename, time.time()))
+            self.conn.execute('COMMIT')
+            if n > 0:
+                shared.log.info(f'Cache import: {json_filename} items={n} time={time.time()-t0:.2f}s')
+
+    def section(self, section):
+        with self.lock:
+            rows = self.conn.execute('SELECT key, value FROM entries WHERE section=?', (section,)).fetchall()
+            rows += [(row[1], row[5]) for row in self.pending.values() if row[0] == section]
+        return { k: json.loads(v) for k, v in rows }
+
+    def get(self, section, key, filename=None):
+        with self.lock:
+            row = self.pending.get((section, key), None)
+            if row is not None:
+                row = row[2:]
+            else:
+                row = self.conn.execute('SELECT size, mtime, inode, value FROM entries WHERE section=? AND key=?', (section, key)).fetchone()
+        if row is None:
+            return None
+        size, mtime, inode, value = row
+        if filename is not None and size is not None: # imported legacy entries have no stat and are validated by caller
+            stat = file_stat(filename)
+            if stat is None or stat != (size, mtime, inode):
+                return None
+        return json.loads(value)
+
+    def set(self, section, key, value, filename=None):
+        stat = file_stat(filename) if filename is not None else None
+        size, mtime, inode = stat if stat is not None else (None, None, None)
+        with self.lock:
+            if len(self.pending) == 0:
+                self.pending_since = time.time()
+            self.pending[(section, key)] = (section, key, size, mtime, inode, json.dumps(value, default=str))
+            if len(self.pending) >= commit_every or time.time() - self.pending_since > commit_interval:
+                self.commit()
+
+    def commit(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany('INSERT OR REPLACE INTO entries (section, key, size, mtime, inode, value) VALUES (?, ?, ?, ?, ?, ?)', list(self.pending.values()))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.pending.clear()
+
+
+def commit_all():
+    """flush buffered entries of every open store, registered to run on exit"""
+    with stores_lock:
+        open_stores = list(stores.values())
+    for store in open_stores:
+        try:
+            store.commit()
+        except Exception as e:
+            shared.log.error(f'Cache commit failed: {store.filename} {e}')
+
+
+atexit.register(commit_all)
+
+
+def get_store(json_filename, flat=None):
+    """returns store for given legacy json file using configured backend"""
+    global sqlite_failed # pylint: disable=global-statement
+    backend = shared.opts.data.get('sd_cache_backend', 'sqlite')
+    with stores_lock:
+        if backend == 'sqlite' and not sqlite_failed:
+            try:
+                if db_filename not in stores:
+                    stores[db_filename] = SQLiteStore(db_filename)
+                store = stores[db_filename]
+                store.import_json(json_filename, flat)
+                return store
+            except Exception as e:
+                sqlite_failed = True
+                shared.log.error(f'Cache database failed, using json: {db_filename} {e}')
+        if json_filename not in stores:
+            stores[json_filename] = JSONStore(json_filename, flat)
+        return stores[json_filename]
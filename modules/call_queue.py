@@ -1,33 +1,48 @@
 import html
-import threading
 import time
 import cProfile
 import pstats
 import io
+import gradio as gr
 from rich import print # pylint: disable=redefined-builtin
 from modules import shared, progress, errors
+from modules.scheduler import scheduler, current_client
 
-queue_lock = threading.Lock()
+queue_lock = scheduler # kept for compatibility, entering it submits anonymous job to scheduler
 
 
 def wrap_queued_call(func):
     def f(*args, **kwargs):
-        with queue_lock:
+        with scheduler.job(func.__name__):
             res = func(*args, **kwargs)
         return res
     return f
 
 
+def request_client(request):
+    """scheduler client of gradio request: authenticated user, browser session or client address"""
+    if request is None:
+        return 'ui'
+    for attr in ['username', 'session_hash']:
+        try:
+            value = getattr(request, attr, None)
+        except Exception:
+            value = None
+        if value:
+            return f'ui:{value}'
+    client = getattr(request, 'client', None)
+    return f'ui:{client.host}' if getattr(client, 'host', None) else 'ui'
+
+
 def wrap_gradio_gpu_call(func, extra_outputs=None):
     name = func.__name__
     def f(*args, **kwargs):
         # if the first argument is a string that says "task(...)", it is treated as a job id
         if len(args) > 0 and type(args[0]) == str and args[0][0:5] == "task(" and args[0][-1] == ")":
             id_task = args[0]
-            progress.add_task_to_queue(id_task)
         else:
             id_task = None
-        with queue_lock:
+        with scheduler.job(name, id_job=id_task): # client is set from gradio request
             progress.start_task(id_task)
             res = [None, '', '', '']
             try:
@@ -42,7 +57,17 @@ def wrap_gradio_gpu_call(func, extra_outputs=None):
                 progress.finish_task(id_task)
             shared.state.end()
         return res
-    return wrap_gradio_call(f, extra_outputs=extra_outputs, add_stats=True, name=name)
+    wrapped = wrap_gradio_call(f, extra_outputs=extra_outputs, add_stats=True, name=name)
+
+    def gradio_fn(request: gr.Request = None, *args, **kwargs): # pylint: disable=keyword-arg-before-vararg # gradio injects request into first argument based on type hint
+        if not isinstance(request, gr.Request): # called directly instead of from gradio event
+            args, request = (request, *args), None
+        token = current_client.set(request_client(request))
+        try:
+            return wrapped(*args, **kwargs)
+        finally:
+            current_client.reset(token)
+    return gradio_fn
 
 
 def wrap_gradio_call(func, extra_outputs=None, add_stats=False, name=None):
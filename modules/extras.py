@@ -9,7 +9,7 @@ import tqdm
 import gradio as gr
 import safetensors.torch
 
-from modules import shared, images, sd_models, sd_vae, sd_models_config
+from modules import shared, images, sd_models, sd_vae, sd_models_config, sd_models_delta
 
 
 checkpoint_dict_skip_on_merge = ["cond_stage_model.transformer.text_model.embeddings.position_ids"]
@@ -53,7 +53,7 @@ def to_half(tensor, enable):
     return tensor
 
 
-def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_model_name, interp_method, multiplier, save_as_half, custom_name, checkpoint_format, config_source, bake_in_vae, discard_weights, save_metadata): # pylint: disable=unused-argument
+def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_model_name, interp_method, multiplier, save_as_half, custom_name, checkpoint_format, config_source, bake_in_vae, discard_weights, save_metadata, delta_format='None', delta_error=0.01): # pylint: disable=unused-argument
     shared.state.begin('model-merge')
     save_as_half = save_as_half == 0
 
@@ -62,6 +62,10 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         shared.state.end()
         return [*[gr.update() for _ in range(4)], message]
 
+    def read_state_dict(filename):
+        state_dict = sd_models.read_state_dict(filename)
+        return dict(state_dict) if state_dict is not None else None # delta checkpoints are read-only mappings
+
     def weighted_sum(theta0, theta1, alpha):
         return ((1 - alpha) * theta0) + (alpha * theta1)
 
@@ -104,18 +108,25 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
     if theta_func1 and (not tertiary_model_name or tertiary_model_name == 'None'):
         return fail(f"Failed: Interpolation method ({interp_method}) requires a tertiary model.")
     tertiary_model_info = sd_models.checkpoints_list[tertiary_model_name] if theta_func1 else None
+    delta_base_info = None
+    if delta_format != 'None':
+        if checkpoint_format != 'safetensors':
+            return fail("Failed: Delta checkpoint requires safetensors format.")
+        delta_base_info = sd_models_delta.find_base(primary_model_info.delta_base) if primary_model_info.delta_base is not None else primary_model_info
+        if delta_base_info is None:
+            return fail("Failed: Base model of primary delta checkpoint not found.")
     result_is_inpainting_model = False
     result_is_instruct_pix2pix_model = False
     if theta_func2:
         shared.state.textinfo = "Loading B"
         shared.log.info(f"Model merge loading secondary model: {secondary_model_info.filename}")
-        theta_1 = sd_models.read_state_dict(secondary_model_info.filename)
+        theta_1 = read_state_dict(secondary_model_info.filename)
     else:
         theta_1 = None
     if theta_func1:
         shared.state.textinfo = "Loading C"
         shared.log.info(f"Model merge loading tertiary model: {tertiary_model_info.filename}")
-        theta_2 = sd_models.read_state_dict(tertiary_model_info.filename)
+        theta_2 = read_state_dict(tertiary_model_info.filename)
         shared.state.textinfo = 'Merging B and C'
         shared.state.sampling_steps = len(theta_1.keys())
         for key in tqdm.tqdm(theta_1.keys()):
@@ -132,7 +143,7 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         shared.state.nextjob()
     shared.state.textinfo = f"Loading {primary_model_info.filename}..."
     shared.log.info(f"Model merge loading primary model: {primary_model_info.filename}")
-    theta_0 = sd_models.read_state_dict(primary_model_info.filename)
+    theta_0 = read_state_dict(primary_model_info.filename)
     shared.log.info("Model merge: running")
     shared.state.textinfo = 'Merging A and B'
     shared.state.sampling_steps = len(theta_0.keys())
@@ -203,6 +214,7 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
             "config_source": config_source,
             "bake_in_vae": bake_in_vae,
             "discard_weights": discard_weights,
+            "delta_format": delta_format,
             "is_inpainting": result_is_inpainting_model,
             "is_instruct_pix2pix": result_is_instruct_pix2pix_model
         }
@@ -225,7 +237,10 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         metadata["sd_merge_models"] = json.dumps(metadata["sd_merge_models"])
 
     _, extension = os.path.splitext(output_modelname)
-    if extension.lower() == ".safetensors":
+    if delta_base_info is not None:
+        shared.state.textinfo = f"Saving delta from {delta_base_info.name}"
+        sd_models_delta.save_delta(output_modelname, theta_0, delta_base_info, lowrank=delta_format == 'Low-rank', max_error=delta_error, metadata=metadata)
+    elif extension.lower() == ".safetensors":
         safetensors.torch.save_file(theta_0, output_modelname, metadata=metadata)
     else:
         torch.save(theta_0, output_modelname)
@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import time
+import atexit
+import datetime
+import threading
+import collections
+from modules import shared, paths
+
+
+fsync_entries = 16 # fsync after this many appends
+fsync_interval = 5.0 # or when this many seconds passed since last fsync
+re_seed = re.compile(r'Seed: (-?\d+)')
+re_model = re.compile(r'Model: ([^,]+)')
+re_model_hash = re.compile(r'Model hash: ([^,]+)')
+
+
+def log_filename():
+    """journal is always jsonl next to configured log file"""
+    fn = shared.opts.save_log_fn
+    if fn is None or fn == '':
+        return None
+    fn = os.path.join(paths.data_path, fn)
+    base, ext = os.path.splitext(fn)
+    return fn if ext.lower() == '.jsonl' else f'{base}.jsonl'
+
+
+def parse_entry(info):
+    """fields used for queries extracted from infotext"""
+    seed = re_seed.search(info)
+    model = re_model.search(info)
+    model_hash = re_model_hash.search(info)
+    return {
+        'seed': int(seed.group(1)) if seed else None,
+        'model': model.group(1).strip() if model else None,
+        'model_hash': model_hash.group(1).strip() if model_hash else None,
+    }
+
+
+def parse_time(value, end=False):
+    """local naive datetime from iso date or unix timestamp, date without time is start of day or end of day if end is set"""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, (int, float)) or re.fullmatch(r'\s*-?\d+(\.\d*)?\s*', str(value)):
+        return datetime.datetime.fromtimestamp(float(value))
+    value = str(value).strip()
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    dt = datetime.datetime.fromisoformat(value) # raises valueerror for unknown formats
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    if end and len(value) == 10: # date only
+        dt = dt + datetime.timedelta(days=1) - datetime.timedelta(microseconds=1)
+    return dt
+
+
+class GenerationLog:
+    """append-only journal of saved images with one json entry per line
+    appends are flushed immediately and fsynced in batches, legacy json log is migrated on first use"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.filename = None
+        self.file = None
+        self.next_id = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.timer = None # syncs tail of a burst of appends
+
+    def open(self, fn):
+        self.close()
+        legacy = os.path.join(paths.data_path, shared.opts.save_log_fn) # configured name was previously used for json log
+        if legacy != fn and not os.path.exists(fn) and os.path.isfile(legacy):
+            self.migrate(legacy, fn)
+        self.next_id = 0
+        if os.path.exists(fn):
+            with open(fn, 'rb') as f:
+                self.next_id = sum(1 for _line in f) # single scan on open, appends only increment
+        self.file = open(fn, 'a', encoding='utf8') # pylint: disable=consider-using-with
+        self.filename = fn
+
+    def migrate(self, legacy, fn):
+        entries = shared.readfile(legacy, silent=True)
+        if not isinstance(entries, list):
+            entries = []
+        with open(f'{fn}.tmp', 'w', encoding='utf8') as f:
+            for i, entry in enumerate(entries):
+                entry = { 'id': i, **entry }
+                entry.update(parse_entry(entry.get('info', '')))
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{fn}.tmp', fn)
+        shared.log.info(f'Generation log: migrated legacy="{legacy}" entries={len(entries)} log="{fn}"')
+
+    def append(self, filename, info):
+        fn = log_filename()
+        if fn is None:
+            return None
+        with self.lock:
+            if fn != self.filename:
+                self.open(fn)
+            entry = { 'id': self.next_id, 'filename': filename, 'time': datetime.datetime.now().isoformat(), 'info': info }
+            entry.update(parse_entry(info))
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.next_id += 1
+            self.unsynced += 1
+            if self.unsynced >= fsync_entries or time.time() - self.last_sync > fsync_interval:
+                self.sync()
+            if self.unsynced > 0 and self.timer is None:
+                self.timer = threading.Timer(fsync_interval, self.sync_timer)
+                self.timer.daemon = True
+                self.timer.start()
+        return entry
+
+    def sync_timer(self):
+        with self.lock:
+            self.timer = None
+            self.sync()
+
+    def sync(self):
+        if self.file is not None and self.unsynced > 0:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+            self.last_sync = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.file is not None:
+                self.sync()
+                self.file.close()
+                self.file = None
+                self.filename = None
+
+    def query(self, since=None, until=None, model=None, seed=None, limit=100):
+        """newest entries matching all given filters, since and until are inclusive iso dates or unix timestamps"""
+        since, until = parse_time(since), parse_time(until, end=True)
+        fn = log_filename()
+        if fn is None:
+            return []
+        with self.lock:
+            if fn != self.filename: # opening log runs migration if it was not written in this session
+                self.open(fn)
+            self.file.flush()
+        model = model.lower() if model else None
+        matches = collections.deque(maxlen=limit if limit > 0 else None)
+        with open(fn, 'r', encoding='utf8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except Exception:
+                    continue
+                if since is not None or until is not None:
+                    try:
+                        t = parse_time(entry.get('time', None))
+                    except ValueError:
+                        continue
+                    if t is None or (since is not None and t < since) or (until is not None and t > until):
+                        continue
+                if seed is not None and entry.get('seed', None) != seed:
+                    continue
+                if model is not None and model not in (entry.get('model', None) or '').lower() and model != (entry.get('model_hash', None) or '').lower():
+                    continue
+                matches.append(entry)
+        return list(reversed(matches))
+
+
+log = GenerationLog()
+atexit.register(log.close)
@@ -1,46 +1,62 @@
-import hashlib
 import os.path
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from rich import progress
-from modules import shared
+from modules import shared, cachedb
 from modules.paths import data_path
 
 cache_filename = os.path.join(data_path, "cache.json")
-cache_data = None
+cache_lock = threading.RLock()
+blksize = 16 * 1024 * 1024 # large aligned reads, hashlib releases gil for updates so multiple readers scale
+hash_executor = None
+hash_pending = {} # (title, use_addnet_hash) -> future
+hash_devices = {} # st_dev -> semaphore limiting concurrent readers per device
+
+
+def store():
+    return cachedb.get_store(cache_filename)
 
 
 def dump_cache():
-    shared.writefile(cache_data, cache_filename)
+    store().commit()
 
 
 def cache(subsection):
-    global cache_data # pylint: disable=global-statement
-    if cache_data is None:
-        cache_data = {} if not os.path.isfile(cache_filename) else shared.readfile(cache_filename)
-    s = cache_data.get(subsection, {})
-    cache_data[subsection] = s
-    return s
+    """read-only view of cache subsection, kept for compatibility"""
+    return store().section(subsection)
+
+
+def read_chunks(f, offset=0):
+    buffer = bytearray(blksize)
+    view = memoryview(buffer)
+    f.seek(offset)
+    while True:
+        n = f.readinto(view)
+        if not n:
+            break
+        yield view[:n]
 
 
 def calculate_sha256(filename, quiet=False):
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
     if not quiet:
         with progress.open(filename, 'rb', description=f'Calculating model hash: [cyan]{filename}', auto_refresh=True, console=shared.console) as f:
             for chunk in iter(lambda: f.read(blksize), b""):
                 hash_sha256.update(chunk)
     else:
-        with open(filename, 'rb') as f:
-            for chunk in iter(lambda: f.read(blksize), b""):
+        with open(filename, 'rb', buffering=0) as f:
+            for chunk in read_chunks(f):
                 hash_sha256.update(chunk)
     return hash_sha256.hexdigest()
 
 
 def sha256_from_cache(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
-    if title not in hashes:
+    entry = store().get("hashes-addnet" if use_addnet_hash else "hashes", title, filename)
+    if entry is None:
         return None
-    cached_sha256 = hashes[title].get("sha256", None)
-    cached_mtime = hashes[title].get("mtime", 0)
+    cached_sha256 = entry.get("sha256", None)
+    cached_mtime = entry.get("mtime", 0)
     ondisk_mtime = os.path.getmtime(filename) if os.path.isfile(filename) else 0
     if ondisk_mtime > cached_mtime or cached_sha256 is None:
         return None
@@ -48,7 +64,6 @@ def sha256_from_cache(filename, title, use_addnet_hash=False):
 
 
 def sha256(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
     sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
     if sha256_value is not None:
         return sha256_value
@@ -56,23 +71,26 @@ def sha256(filename, title, use_addnet_hash=False):
         return None
     if not os.path.isfile(filename):
         return None
+    future = hash_pending.get((title, use_addnet_hash), None)
+    if future is not None: # already queued or running in background, wait for it instead of hashing again
+        return future.result()
     if use_addnet_hash:
         with progress.open(filename, 'rb', description=f'Calculating model hash: [cyan]{filename}', auto_refresh=True, console=shared.console) as f:
             sha256_value = addnet_hash_safetensors(f)
     else:
         sha256_value = calculate_sha256(filename)
-    hashes[title] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value
-    }
-    dump_cache()
+    with cache_lock:
+        store().set("hashes-addnet" if use_addnet_hash else "hashes", title, {
+            "mtime": os.path.getmtime(filename),
+            "sha256": sha256_value
+        }, filename)
+        dump_cache()
     return sha256_value
 
 
 def addnet_hash_safetensors(b):
     """kohya-ss hash for safetensors from https://github.com/kohya-ss/sd-scripts/blob/main/library/train_util.py"""
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
     b.seek(0)
     header = b.read(8)
     n = int.from_bytes(header, "little")
@@ -81,3 +99,77 @@ def addnet_hash_safetensors(b):
     for chunk in iter(lambda: b.read(blksize), b""):
         hash_sha256.update(chunk)
     return hash_sha256.hexdigest()
+
+
+def device_semaphore(filename):
+    try:
+        dev = os.stat(filename).st_dev
+    except OSError:
+        dev = None
+    with cache_lock:
+        if dev not in hash_devices:
+            hash_devices[dev] = threading.BoundedSemaphore(max(1, shared.opts.data.get('sd_hash_readers', 1)))
+        return hash_devices[dev]
+
+
+def hash_worker(filename, title, use_addnet_hash):
+    try:
+        with device_semaphore(filename):
+            mtime = os.path.getmtime(filename)
+            if use_addnet_hash:
+                with open(filename, 'rb', buffering=0) as f:
+                    hash_sha256 = hashlib.sha256()
+                    n = int.from_bytes(f.read(8), "little")
+                    for chunk in read_chunks(f, offset=n + 8):
+                        hash_sha256.update(chunk)
+                    sha256_value = hash_sha256.hexdigest()
+            else:
+                sha256_value = calculate_sha256(filename, quiet=True)
+        with cache_lock:
+            store().set("hashes-addnet" if use_addnet_hash else "hashes", title, { "mtime": mtime, "sha256": sha256_value }, filename)
+            hash_pending.pop((title, use_addnet_hash), None)
+            if len(hash_pending) == 0: # commit once queue is drained instead of after every file
+                dump_cache()
+        shared.log.debug(f'Hash calculated: {title} sha256={sha256_value[0:10]} pending={len(hash_pending)}')
+        return sha256_value
+    except Exception as e:
+        with cache_lock:
+            hash_pending.pop((title, use_addnet_hash), None)
+        shared.log.error(f'Hash calculation failed: {filename} {e}')
+        return None
+
+
+def queue(filename, title, use_addnet_hash=False, callback=None):
+    """queue file for background hashing and return future with resulting sha256 value
+    optional callback(sha256) is called from worker thread once hash is calculated so owner can update its info"""
+    global hash_executor # pylint: disable=global-statement
+    with cache_lock:
+        future = hash_pending.get((title, use_addnet_hash), None)
+        if future is None:
+            if hash_executor is None:
+                hash_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='hash')
+            future = hash_executor.submit(hash_worker, filename, title, use_addnet_hash)
+            hash_pending[(title, use_addnet_hash)] = future
+    if callback is not None:
+        def done(f):
+            try:
+                if f.result() is not None:
+                    callback(f.result())
+            except Exception as e:
+                shared.log.error(f'Hash callback failed: {title} {e}')
+        future.add_done_callback(done)
+    return future
+
+
+def queue_unhashed(items):
+    """items is list of (filename, title, use_addnet_hash, callback) tuples, only files that are not already in cache are queued"""
+    if shared.cmd_opts.no_hashing or not shared.opts.data.get('sd_hash_background', True):
+        return []
+    futures = []
+    for filename, title, use_addnet_hash, callback in items:
+        if not os.path.isfile(filename) or sha256_from_cache(filename, title, use_addnet_hash) is not None:
+            continue
+        futures.append(queue(filename, title, use_addnet_hash, callback))
+    if len(futures) > 0:
+        shared.log.info(f'Hash queue: added={len(futures)} pending={len(hash_pending)}')
+    return futures
@@ -0,0 +1,96 @@
+"""
+image encoding profiles and process pool encoder
+module is imported by encoder worker processes so it must not import anything heavy at module level
+"""
+import io
+import sys
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+profile_names = ['default', 'fastest', 'balanced', 'smallest']
+profiles = {
+    'fastest': { 'PNG': { 'compress_level': 1 }, 'JPEG': {}, 'WEBP': { 'method': 0 } },
+    'balanced': { 'PNG': { 'compress_level': 6 }, 'JPEG': { 'optimize': True }, 'WEBP': { 'method': 4 } },
+    'smallest': { 'PNG': { 'optimize': True, 'compress_level': 9 }, 'JPEG': { 'optimize': True, 'progressive': True }, 'WEBP': { 'method': 6 } },
+}
+defaults = { # settings used before profiles were introduced, output is byte-identical
+    'samples': { 'PNG': { 'optimize': True, 'compress_level': 9 }, 'JPEG': { 'optimize': True } },
+    'grids': { 'PNG': { 'optimize': True, 'compress_level': 9 }, 'JPEG': { 'optimize': True } },
+    'api': {},
+}
+
+
+def profile_args(target, image_format, profile=None):
+    """encoder arguments for output target (samples, grids, api) using configured or given profile"""
+    if profile is None:
+        from modules import shared
+        profile = getattr(shared.opts, f'image_profile_{target}', 'default')
+    if profile == 'default' or profile not in profiles:
+        return dict(defaults.get(target, {}).get(image_format, {}))
+    return dict(profiles[profile].get(image_format, {}))
+
+
+def encode(image, image_format, save_args):
+    """encode image to bytes, runs in worker process"""
+    with io.BytesIO() as buffer:
+        image.save(buffer, format=image_format, **save_args)
+        return buffer.getvalue()
+
+
+class EncoderPool:
+    """process pool used to encode images in parallel across cores
+    zero workers encodes in calling thread, pool failures fall back to local encoding"""
+    def __init__(self):
+        self.executor = None
+        self.workers = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        from modules import shared
+        workers = shared.opts.image_encode_workers
+        with self.lock:
+            if workers != self.workers and self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+            self.workers = workers
+            if workers > 0 and self.executor is None:
+                if sys.platform != 'win32' and 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver') # clean workers without importing main module or torch
+                    context.set_forkserver_preload([__name__])
+                else: # spawned workers re-import main module so they are disabled by default on windows
+                    shared.log.warning(f'Image encoder: workers={workers} method=spawn each worker imports main module')
+                    context = multiprocessing.get_context('spawn')
+                self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+                shared.log.debug(f'Image encoder: workers={workers}')
+            return self.executor
+
+    def reset(self, e):
+        from modules import shared
+        shared.log.error(f'Image encoder: pool failed, encoding locally: {e}')
+        with self.lock:
+            self.executor = None
+
+    def encode(self, image, image_format, save_args):
+        return self.encode_all([(image, image_format, save_args)])[0]
+
+    def encode_all(self, items):
+        """encode list of (image, format, args) in parallel and return list of bytes in same order"""
+        executor = self.get()
+        if executor is None:
+            return [encode(*item) for item in items]
+        try:
+            futures = [executor.submit(encode, *item) for item in items]
+            return [future.result() for future in futures]
+        except BrokenProcessPool as e:
+            self.reset(e)
+            return [encode(*item) for item in items]
+        except Exception as e: # e.g. image info or save args that cannot be pickled, pool itself is still usable
+            from modules import shared
+            shared.log.debug(f'Image encoder: encoding locally: {e}')
+            return [encode(*item) for item in items]
+
+
+pool = EncoderPool()
@@ -7,15 +7,16 @@ import json
 import uuid
 import string
 import hashlib
-import queue
+import atexit
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from collections import namedtuple
 import pytz
 import numpy as np
 import piexif
 import piexif.helper
 from PIL import Image, ImageFont, ImageDraw, PngImagePlugin, ExifTags
-from modules import sd_samplers, shared, script_callbacks, errors, paths
+from modules import sd_samplers, shared, script_callbacks, errors, paths, generation_log, image_encoder
 
 LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
 
@@ -440,75 +441,218 @@ def get_next_sequence_number(path, basename):
     return result + 1
 
 
-def atomically_save_image():
+params_written = None
+
+
+def write_params(text):
+    """params.txt holds parameters of last generation, it is rewritten only when they change"""
+    global params_written # pylint: disable=global-statement
+    with saver.log_lock:
+        if text == params_written:
+            return
+        with open(os.path.join(paths.data_path, "params.txt"), "w", encoding="utf8") as file:
+            file.write(text)
+        params_written = text
+
+
+def remove_placeholder(filename):
+    """remove empty file created when filename was claimed but image was never written"""
+    try:
+        if filename is not None and os.path.isfile(filename) and os.path.getsize(filename) == 0:
+            os.remove(filename)
+    except OSError:
+        pass
+
+
+class SequenceAllocator:
+    """allocates sequence numbers of saved images per output folder
+    folder is scanned once and then counter is incremented in memory, it is rescanned only when claimed name already exists
+    filenames are claimed by exclusive create of empty file so concurrent save workers and other processes never reuse a name"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {} # (path, basename) -> next number
+
+    def claim(self, path, basename, filename_for):
+        """returns first free filename_for(number) which is created as empty placeholder"""
+        key = (os.path.abspath(path), basename)
+        with self.lock:
+            number = self.counters.get(key, None)
+            rescanned = number is None
+            if number is None:
+                number = get_next_sequence_number(path, basename)
+            fullfn = None
+            for _i in range(9999):
+                fullfn = filename_for(number)
+                try:
+                    os.close(os.open(fullfn, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                except FileExistsError:
+                    if not rescanned: # something else wrote to folder since it was scanned so skip all numbers it used at once
+                        rescanned = True
+                        number = max(number + 1, get_next_sequence_number(path, basename))
+                    else:
+                        number += 1
+                    continue
+                self.counters[key] = number + 1
+                return fullfn, True
+            return fullfn, False
+
+
+sequence = SequenceAllocator()
+
+
+def write_encoded(fn, image, image_format, save_args):
+    """write to temporary file and rename over claimed filename so readers never see partially written image"""
+    data = image_encoder.pool.encode(image, image_format, save_args)
+    tmp = f'{fn}.tmp'
+    try:
+        with open(tmp, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, fn)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def atomically_save_image(image, filename, extension, params, exifinfo, txt_fullfn, target='samples'):
+    """encode and write single image with its metadata files, runs in image saver worker thread
+    metadata files, generation log and image_saved_callback are written or called only when image itself was saved
+    image_saved_callback therefore runs on image saver worker thread and not on thread that generated image unless save_workers is 0"""
     Image.MAX_IMAGE_PIXELS = None # disable check in Pillow and rely on check below to allow large custom image sizes
-    while True:
-        image, filename, extension, params, exifinfo, txt_fullfn = save_queue.get()
-        fn = filename + extension
-        filename = filename.strip()
-        if extension[0] != '.': # add dot if missing
-            extension = '.' + extension
+    fn = filename + extension
+    filename = filename.strip()
+    if extension[0] != '.': # add dot if missing
+        extension = '.' + extension
+    try:
+        image_format = Image.registered_extensions()[extension]
+    except Exception:
+        shared.log.warning(f'Unknown image format: {extension}')
+        image_format = 'JPEG'
+    if shared.opts.image_watermark_enabled:
+        image = set_watermark(image, shared.opts.image_watermark)
+    shared.log.debug(f'Saving: image="{fn}" type={image_format} size={image.width}x{image.height}')
+    # actual save
+    exifinfo = (exifinfo or "") if shared.opts.image_metadata else ""
+    saved = True
+    if image_format == 'PNG':
+        pnginfo_data = PngImagePlugin.PngInfo()
+        for k, v in params.pnginfo.items():
+            pnginfo_data.add_text(k, str(v))
+        write_encoded(fn, image, image_format, { **image_encoder.profile_args(target, image_format), 'pnginfo': pnginfo_data if shared.opts.image_metadata else None })
+    elif image_format == 'JPEG':
+        if image.mode == 'RGBA':
+            shared.log.warning('Saving RGBA image as JPEG: Alpha channel will be lost')
+            image = image.convert("RGB")
+        elif image.mode == 'I;16':
+            image = image.point(lambda p: p * 0.0038910505836576).convert("L")
+        exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(exifinfo, encoding="unicode") } })
+        write_encoded(fn, image, image_format, { **image_encoder.profile_args(target, image_format), 'quality': shared.opts.jpeg_quality, 'exif': exif_bytes })
+    elif image_format == 'WEBP':
+        if image.mode == 'I;16':
+            image = image.point(lambda p: p * 0.0038910505836576).convert("RGB")
+        exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(exifinfo, encoding="unicode") } })
         try:
-            image_format = Image.registered_extensions()[extension]
-        except Exception:
-            shared.log.warning(f'Unknown image format: {extension}')
-            image_format = 'JPEG'
-        if shared.opts.image_watermark_enabled:
-            image = set_watermark(image, shared.opts.image_watermark)
-        shared.log.debug(f'Saving: image="{fn}" type={image_format} size={image.width}x{image.height}')
-        # actual save
-        exifinfo = (exifinfo or "") if shared.opts.image_metadata else ""
-        if image_format == 'PNG':
-            pnginfo_data = PngImagePlugin.PngInfo()
-            for k, v in params.pnginfo.items():
-                pnginfo_data.add_text(k, str(v))
-            image.save(fn, format=image_format, optimize=True, compress_level=9, pnginfo=pnginfo_data if shared.opts.image_metadata else None)
-        elif image_format == 'JPEG':
-            if image.mode == 'RGBA':
-                shared.log.warning('Saving RGBA image as JPEG: Alpha channel will be lost')
-                image = image.convert("RGB")
-            elif image.mode == 'I;16':
-                image = image.point(lambda p: p * 0.0038910505836576).convert("L")
-            exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(exifinfo, encoding="unicode") } })
-            image.save(fn, format=image_format, optimize=True, quality=shared.opts.jpeg_quality, exif=exif_bytes)
-        elif image_format == 'WEBP':
-            if image.mode == 'I;16':
-                image = image.point(lambda p: p * 0.0038910505836576).convert("RGB")
-            exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(exifinfo, encoding="unicode") } })
-            try:
-                image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, lossless=shared.opts.webp_lossless, exif=exif_bytes)
-            except Exception as e:
-                shared.log.warning(f'Image save failed: {fn} {e}')
-        else:
-            # shared.log.warning(f'Unrecognized image format: {extension} attempting save as {image_format}')
-            try:
-                image.save(fn, format=image_format, quality=shared.opts.jpeg_quality)
-            except Exception as e:
-                shared.log.warning(f'Image save failed: {fn} {e}')
-        # additional metadata saved in files
-        if shared.opts.save_txt and len(exifinfo) > 0:
-            try:
-                with open(txt_fullfn, "w", encoding="utf8") as file:
-                    file.write(f"{exifinfo}\n")
-            except Exception as e:
-                shared.log.warning(f'Image description save failed: {txt_fullfn} {e}')
-        with open(os.path.join(paths.data_path, "params.txt"), "w", encoding="utf8") as file:
-            file.write(exifinfo)
-        if shared.opts.save_log_fn != '' and len(exifinfo) > 0:
-            fn = os.path.join(paths.data_path, shared.opts.save_log_fn)
-            entries = shared.readfile(fn)
-            idx = len(list(entries))
-            if idx == 0:
-                entries = []
-            entry = { 'id': idx, 'filename': filename, 'time': datetime.datetime.now().isoformat(), 'info': exifinfo }
-            entries.append(entry)
-            shared.writefile(entries, fn, mode='w')
-        save_queue.task_done()
+            write_encoded(fn, image, image_format, { **image_encoder.profile_args(target, image_format), 'quality': shared.opts.jpeg_quality, 'lossless': shared.opts.webp_lossless, 'exif': exif_bytes })
+        except Exception as e:
+            saved = False
+            shared.log.warning(f'Image save failed: {fn} {e}')
+    else:
+        # shared.log.warning(f'Unrecognized image format: {extension} attempting save as {image_format}')
+        try:
+            write_encoded(fn, image, image_format, { 'quality': shared.opts.jpeg_quality })
+        except Exception as e:
+            saved = False
+            shared.log.warning(f'Image save failed: {fn} {e}')
+    if not saved:
+        remove_placeholder(params.filename)
+        return None, None
+    params.image.already_saved_as = fn # published only once file is completely written so that ui and api never read partial file
+    # additional metadata saved in files
+    if shared.opts.save_txt and len(exifinfo) > 0:
+        try:
+            with open(txt_fullfn, "w", encoding="utf8") as file:
+                file.write(f"{exifinfo}\n")
+        except Exception as e:
+            shared.log.warning(f'Image description save failed: {txt_fullfn} {e}')
+    write_params(exifinfo)
+    if shared.opts.save_log_fn != '' and len(exifinfo) > 0:
+        generation_log.log.append(filename, exifinfo)
+    script_callbacks.image_saved_callback(params)
+    return params.filename, txt_fullfn
 
 
-save_queue = queue.Queue()
-save_thread = threading.Thread(target=atomically_save_image, daemon=True)
-save_thread.start()
+class ImageSaver:
+    """saves images in pool of worker threads so generation does not wait for image encoding
+    number of queued saves is bounded and caller blocks when queue is full
+    filenames of pending saves are claimed by sequence allocator so they are not reused before file is written"""
+    def __init__(self):
+        self.executor = None
+        self.workers = 0
+        self.slots = None
+        self.pending = {} # filename -> future
+        self.lock = threading.Lock()
+        self.log_lock = threading.Lock()
+
+    def start(self):
+        workers = max(1, shared.opts.save_workers)
+        if self.executor is not None and self.workers == workers:
+            return
+        if self.executor is not None:
+            self.flush()
+            self.executor.shutdown(wait=True)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-save')
+        self.slots = threading.BoundedSemaphore(workers + max(0, shared.opts.save_queue_size))
+
+    def run(self, *args):
+        try:
+            return atomically_save_image(*args)
+        except Exception as e:
+            shared.log.error(f'Image save failed: file="{args[1]}{args[2]}" {e}')
+            raise
+        finally:
+            remove_placeholder(args[3].filename) # format specific save errors are only logged
+
+    def submit(self, image, filename, extension, params, exifinfo, txt_fullfn, target='samples'):
+        """queue image for saving and return future resolving to saved filenames"""
+        if shared.opts.save_workers == 0:
+            future = Future()
+            try:
+                future.set_result(self.run(image, filename, extension, params, exifinfo, txt_fullfn, target))
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            return future
+        self.start()
+        slots = self.slots
+        slots.acquire() # backpressure: wait for free slot when workers are behind
+        with self.lock:
+            future = self.executor.submit(self.run, image, filename, extension, params, exifinfo, txt_fullfn, target)
+            self.pending[params.filename] = future
+        def done(_future):
+            slots.release()
+            with self.lock:
+                if self.pending.get(params.filename, None) is _future:
+                    del self.pending[params.filename]
+        future.add_done_callback(done)
+        return future
+
+    def future(self, filename):
+        """future of pending save or none if file is already saved"""
+        with self.lock:
+            return self.pending.get(filename, None)
+
+    def flush(self, timeout=None):
+        """wait for all queued saves to complete"""
+        with self.lock:
+            futures = list(self.pending.values())
+        if len(futures) > 0:
+            shared.log.debug(f'Image save: flush pending={len(futures)}')
+            wait(futures, timeout=timeout)
+
+
+saver = ImageSaver()
+atexit.register(saver.flush)
 
 
 def save_image(image, path, basename, seed=None, prompt=None, extension='jpg', info=None, short_filename=False, no_prompt=False, grid=False, pnginfo_section_name='parameters', p=None, existing_info=None, forced_filename=None, suffix="", save_to_dirs=None):
@@ -550,6 +694,7 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='jpg', i
     if path is None or len(path) == 0: # set default path to avoid errors when functions are triggered manually or via api and param is not set
         path = shared.opts.outdir_save
     namegen = FilenameGenerator(p, seed, prompt, image, grid=grid)
+    placeholder = None
     if save_to_dirs is None:
         save_to_dirs = (grid and shared.opts.grid_save_to_dirs) or (not grid and shared.opts.save_to_dirs and not no_prompt)
     if save_to_dirs:
@@ -570,13 +715,11 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='jpg', i
         if shared.opts.save_images_add_number:
             if '[seq]' not in file_decoration:
                 file_decoration = f"[seq]-{file_decoration}"
-            basecount = get_next_sequence_number(path, basename)
-            fullfn = None
-            for i in range(9999):
-                seq = f"{basecount + i:05}" if basename == '' else f"{basename}-{basecount + i:04}"
-                fullfn = os.path.join(path, f"{file_decoration.replace('[seq]', seq)}.{extension}")
-                if not os.path.exists(fullfn):
-                    break
+            def filename_for(number):
+                seq = f"{number:05}" if basename == '' else f"{basename}-{number:04}"
+                return os.path.join(path, f"{file_decoration.replace('[seq]', seq)}.{extension}")
+            fullfn, claimed = sequence.claim(path, basename, filename_for)
+            placeholder = fullfn if claimed else None
         else:
             if basename == '':
                 fullfn = os.path.join(path, f"{file_decoration}.{extension}")
@@ -597,12 +740,11 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='jpg', i
         filename = filename[:max_name_len - max(4, len(extension))]
         params.filename = filename + extension
     txt_fullfn = f"{filename}.txt" if shared.opts.save_txt and len(exifinfo) > 0 else None
+    if placeholder is not None and params.filename != placeholder: # renamed by callback or truncated
+        remove_placeholder(placeholder)
 
-    save_queue.put((params.image, filename, extension, params, exifinfo, txt_fullfn)) # actual save is executed in a thread that polls data from queue
-    save_queue.join()
-
-    params.image.already_saved_as = params.filename
-    script_callbacks.image_saved_callback(params)
+    params.image.saving_as = params.filename # already_saved_as is set by save worker once file is written
+    saver.submit(params.image, filename, extension, params, exifinfo, txt_fullfn, target='grids' if grid else 'samples') # actual save is executed in worker thread, image_saved_callback runs after file is written
     return params.filename, txt_fullfn
 
 
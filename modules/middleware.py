@@ -15,6 +15,7 @@ from installer import log
 import modules.errors as errors
 
 errors.install()
+gzip_skip = ['/sdapi/v1/txt2img', '/sdapi/v1/img2img', '/sdapi/v1/extra-single-image', '/sdapi/v1/extra-batch-images', '/sdapi/v1/jobs/', '/sdapi/v1/stream'] # responses carry already compressed images
 
 
 def setup_middleware(app: FastAPI, cmd_opts):
@@ -26,7 +27,15 @@ def setup_middleware(app: FastAPI, cmd_opts):
     from fastapi.middleware.gzip import GZipMiddleware
     app.user_middleware = [x for x in app.user_middleware if x.cls.__name__ != 'CORSMiddleware']
     app.middleware_stack = None # reset current middleware to allow modifying user provided list
-    app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+    class SelectiveGZipMiddleware(GZipMiddleware):
+        async def __call__(self, scope, receive, send):
+            if scope['type'] == 'http' and any(scope.get('path', '').startswith(path) for path in gzip_skip):
+                await self.app(scope, receive, send)
+                return
+            await super().__call__(scope, receive, send)
+
+    app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024)
     if cmd_opts.cors_origins and cmd_opts.cors_regex:
         app.add_middleware(CORSMiddleware, allow_origins=cmd_opts.cors_origins.split(','), allow_origin_regex=cmd_opts.cors_regex, allow_methods=['*'], allow_credentials=True, allow_headers=['*'])
     elif cmd_opts.cors_origins:
@@ -2,8 +2,10 @@ import os
 import json
 import math
 import time
+import copy
 import hashlib
 import random
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import nullcontext
 from typing import Any, Dict, List
 import torch
@@ -12,6 +14,7 @@ import cv2
 from PIL import Image, ImageFilter, ImageOps
 from skimage import exposure
 from ldm.data.util import AddMiDaS
+from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 from ldm.models.diffusion.ddpm import LatentDepth2ImageDiffusion
 from einops import repeat, rearrange
 from blendmodes.blend import blendLayers, BlendType
@@ -23,6 +26,7 @@ import modules.masking
 import modules.paths
 import modules.scripts
 import modules.prompt_parser
+import modules.prompt_cache
 import modules.extra_networks
 import modules.face_restoration
 import modules.images as images
@@ -33,6 +37,9 @@ import modules.sd_samplers_common
 import modules.sd_models
 import modules.sd_vae
 import modules.sd_vae_approx
+import modules.sd_vae_batch
+import modules.sd_vae_tiled
+import modules.stream
 import modules.generation_parameters_copypaste
 
 
@@ -76,7 +83,7 @@ def txt2img_image_conditioning(sd_model, x, width, height):
     if sd_model.model.conditioning_key in {'hybrid', 'concat'}: # Inpainting models
         # The "masked-image" in this case will just be all zeros since the entire image is masked.
         image_conditioning = torch.zeros(x.shape[0], 3, height, width, device=x.device)
-        image_conditioning = sd_model.get_first_stage_encoding(sd_model.encode_first_stage(image_conditioning))
+        image_conditioning = sd_model.get_first_stage_encoding(encode_first_stage(sd_model, image_conditioning))
         # Add the fake full 1s mask to the first dimension.
         image_conditioning = torch.nn.functional.pad(image_conditioning, (0, 0, 0, 0, 1, 0), value=1.0)
         image_conditioning = image_conditioning.to(x.dtype)
@@ -179,7 +186,7 @@ class StableDiffusionProcessing:
         transformed = transformer({"jpg": rearrange(source_image[0], "c h w -> h w c")})
         midas_in = torch.from_numpy(transformed["midas_in"][None, ...]).to(device=shared.device)
         midas_in = repeat(midas_in, "1 ... -> n ...", n=self.batch_size)
-        conditioning_image = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(source_image))
+        conditioning_image = self.sd_model.get_first_stage_encoding(encode_first_stage(self.sd_model, source_image))
         conditioning = torch.nn.functional.interpolate(
             self.sd_model.depth_model(midas_in),
             size=conditioning_image.shape[2:],
@@ -191,7 +198,7 @@ class StableDiffusionProcessing:
         return conditioning
 
     def edit_image_conditioning(self, source_image):
-        conditioning_image = self.sd_model.encode_first_stage(source_image).mode()
+        conditioning_image = encode_first_stage(self.sd_model, source_image).mode()
         return conditioning_image
 
     def unclip_image_conditioning(self, source_image):
@@ -225,7 +232,7 @@ class StableDiffusionProcessing:
             getattr(self, "inpainting_mask_weight", shared.opts.inpainting_mask_weight)
         )
         # Encode the new masked image using first stage of network.
-        conditioning_image = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(conditioning_image))
+        conditioning_image = self.sd_model.get_first_stage_encoding(encode_first_stage(self.sd_model, conditioning_image))
         # Create the concatenated conditioning tensor to be fed to `c_concat`
         conditioning_mask = torch.nn.functional.interpolate(conditioning_mask, size=latent_image.shape[-2:])
         conditioning_mask = conditioning_mask.expand(conditioning_image.shape[0], -1, -1, -1)
@@ -434,7 +441,9 @@ def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, see
 
 def decode_first_stage(model, x):
     with devices.autocast(disable = x.dtype==devices.dtype_vae):
-        if hasattr(model, 'decode_first_stage'):
+        if hasattr(model, 'decode_first_stage') and hasattr(model, 'first_stage_model') and modules.sd_vae_tiled.enabled(x):
+            x = modules.sd_vae_tiled.decode(model.decode_first_stage, x, model.first_stage_model.decoder)
+        elif hasattr(model, 'decode_first_stage'):
             x = model.decode_first_stage(x)
         elif hasattr(model, 'vae'):
             x = model.vae(x)
@@ -443,6 +452,30 @@ def decode_first_stage(model, x):
     return x
 
 
+def encode_first_stage(model, x):
+    """encode images to latent distribution, large images are encoded using tiled vae"""
+    if not hasattr(model, 'first_stage_model') or not modules.sd_vae_tiled.enabled(x, latent=False):
+        return model.encode_first_stage(x)
+    vae = model.first_stage_model
+    moments = modules.sd_vae_tiled.encode(lambda tile: vae.quant_conv(vae.encoder(tile.to(dtype=devices.dtype_vae))), x, vae.encoder)
+    return DiagonalGaussianDistribution(moments.to(x.device)) # latents are small compared to images
+
+
+def rollback_vae(model):
+    """reload vae in bfloat16 after it produced nans in half precision, returns False if rollback is not possible"""
+    if shared.opts.no_half or shared.opts.no_half_vae or not shared.cmd_opts.rollback_vae or devices.dtype_vae == torch.bfloat16:
+        return False
+    devices.dtype_vae = torch.bfloat16
+    vae_file, vae_source = modules.sd_vae.resolve_vae(model.sd_model_checkpoint)
+    modules.sd_vae.load_vae(model, vae_file, vae_source)
+    return True
+
+
+def decode_first_stage_batched(model, x, output_device=devices.cpu):
+    """decode latents in memory-sized chunks with per-chunk nan check and rollback"""
+    return modules.sd_vae_batch.decode(lambda chunk: decode_first_stage(model, chunk.to(dtype=devices.dtype_vae)), x, rollback=lambda: rollback_vae(model), output_device=output_device)
+
+
 def get_fixed_seed(seed):
     if seed is None or seed == '' or seed == -1:
         return int(random.randrange(4294967294))
@@ -625,6 +658,11 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
         else:
             res = process_images_inner(p)
     finally:
+        if getattr(p, 'pipeline', None) is not None: # processing failed while postprocessing worker was still busy
+            p.pipeline.drain(raise_errors=False)
+            p.pipeline = None
+        if shared.state.interrupted: # make sure everything generated so far is on disk before returning
+            images.saver.flush()
         if not shared.opts.cuda_compile:
             modules.sd_models.apply_token_merging(p.sd_model, 0)
         if p.override_settings_restore_afterwards: # restore opts to original state
@@ -659,6 +697,122 @@ def validate_sample(sample):
     return sample
 
 
+def postprocess_images(p: StableDiffusionProcessing, x_samples_ddim, infotexts, output_images):
+    """convert decoded samples of a single batch to images, apply face restore, color correction and overlay, then save them
+    p is either processing object itself or a snapshot of it when running in postprocessing pipeline"""
+    def infotext(index):
+        return create_infotext(p, p.prompts, p.seeds, p.subseeds, index=index, all_negative_prompts=p.negative_prompts)
+
+    for i, x_sample in enumerate(x_samples_ddim):
+        p.batch_index = i
+        if type(x_sample) == Image.Image:
+            image = x_sample
+            x_sample = np.array(x_sample)
+        else:
+            x_sample = 255. * (np.moveaxis(x_sample.cpu().numpy(), 0, 2) if shared.backend == shared.Backend.ORIGINAL else x_sample)
+            x_sample = validate_sample(x_sample)
+            image = Image.fromarray(x_sample)
+        if p.restore_faces:
+            if shared.opts.save and not p.do_not_save_samples and shared.opts.save_images_before_face_restoration:
+                orig = p.restore_faces
+                p.restore_faces = False
+                info = infotext(i)
+                p.restore_faces = orig
+                images.save_image(Image.fromarray(x_sample), path=p.outpath_samples, basename="", seed=p.seeds[i], prompt=p.prompts[i], extension=shared.opts.samples_format, info=info, p=p, suffix="-before-face-restore")
+            p.ops.append('face')
+            x_sample = modules.face_restoration.restore_faces(x_sample)
+            image = Image.fromarray(x_sample)
+        if p.scripts is not None:
+            pp = modules.scripts.PostprocessImageArgs(image)
+            p.scripts.postprocess_image(p, pp)
+            image = pp.image
+        if p.color_corrections is not None and i < len(p.color_corrections):
+            if shared.opts.save and not p.do_not_save_samples and shared.opts.save_images_before_color_correction:
+                orig = p.color_corrections
+                p.color_corrections = None
+                info = infotext(i)
+                p.color_corrections = orig
+                image_without_cc = apply_overlay(image, p.paste_to, i, p.overlay_images)
+                images.save_image(image_without_cc, path=p.outpath_samples, basename="", seed=p.seeds[i], prompt=p.prompts[i], extension=shared.opts.samples_format, info=info, p=p, suffix="-before-color-correct")
+            p.ops.append('color')
+            image = apply_color_correction(p.color_corrections[i], image)
+        image = apply_overlay(image, p.paste_to, i, p.overlay_images)
+        text = infotext(i)
+        infotexts.append(text)
+        image.info["parameters"] = text
+        output_images.append(image)
+        modules.stream.broadcaster.publish_image(image, p.iteration * p.batch_size + i, seed=p.seeds[i], info=text)
+        if shared.opts.samples_save and not p.do_not_save_samples:
+            images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], shared.opts.samples_format, info=text, p=p) # main save image
+        if hasattr(p, 'mask_for_overlay') and p.mask_for_overlay and any([shared.opts.save_mask, shared.opts.save_mask_composite, shared.opts.return_mask, shared.opts.return_mask_composite]):
+            image_mask = p.mask_for_overlay.convert('RGB')
+            image_mask_composite = Image.composite(image.convert('RGBA').convert('RGBa'), Image.new('RGBa', image.size), images.resize_image(3, p.mask_for_overlay, image.width, image.height).convert('L')).convert('RGBA')
+            if shared.opts.save_mask:
+                images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], shared.opts.samples_format, info=text, p=p, suffix="-mask")
+            if shared.opts.save_mask_composite:
+                images.save_image(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], shared.opts.samples_format, info=text, p=p, suffix="-mask-composite")
+            if shared.opts.return_mask:
+                output_images.append(image_mask)
+            if shared.opts.return_mask_composite:
+                output_images.append(image_mask_composite)
+
+
+class PostprocessPipeline:
+    """runs per-image postprocessing of batch n in a worker thread while batch n+1 is sampled
+    single worker keeps output order deterministic and scripts batch callbacks still run on main thread in order"""
+    executor = None
+    mutable = ['extra_generation_params', 'extra_network_data', 'all_prompts', 'all_negative_prompts', 'all_seeds', 'all_subseeds', 'prompts', 'negative_prompts', 'seeds', 'subseeds']
+
+    def __init__(self, p: StableDiffusionProcessing, infotexts, output_images, depth=2):
+        self.p = p
+        self.infotexts = infotexts
+        self.output_images = output_images
+        self.depth = depth
+        self.pending = []
+        self.snapshots = []
+
+    @staticmethod
+    def supported(p: StableDiffusionProcessing):
+        if not shared.opts.processing_pipeline or p.n_iter < 2 or shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+            return False
+        if p.scripts is not None and any(type(s).postprocess_image is not modules.scripts.Script.postprocess_image for s in p.scripts.alwayson_scripts):
+            return False # script per-image callbacks must not interleave with sampling of next batch
+        return True
+
+    def worker(self, snapshot, x_samples_ddim):
+        with devices.inference_context():
+            postprocess_images(snapshot, x_samples_ddim, self.infotexts, self.output_images)
+
+    def submit(self, x_samples_ddim):
+        if PostprocessPipeline.executor is None:
+            PostprocessPipeline.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='postprocess')
+        while len(self.pending) >= self.depth: # backpressure so decoded batches do not pile up in memory
+            self.pending.pop(0).result()
+        snapshot = copy.copy(self.p)
+        snapshot.ops = list(self.p.ops)
+        for name in PostprocessPipeline.mutable: # main thread mutates these in place while worker builds infotext of previous batch
+            value = getattr(self.p, name, None)
+            if isinstance(value, (list, dict)):
+                setattr(snapshot, name, copy.copy(value))
+        self.snapshots.append((snapshot, len(snapshot.ops)))
+        self.pending.append(PostprocessPipeline.executor.submit(self.worker, snapshot, x_samples_ddim))
+
+    def drain(self, raise_errors=True):
+        """wait for all submitted batches and merge operations recorded by workers back into processing object"""
+        errors = []
+        for future in self.pending:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        self.pending.clear()
+        for snapshot, n in self.snapshots:
+            self.p.ops += snapshot.ops[n:]
+        self.snapshots.clear()
+        if raise_errors and len(errors) > 0:
+            raise errors[0]
+
+
 def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     """this is the main loop that both txt2img and img2img use; it calls func_init once inside all the scopes and func_sample once per batch"""
 
@@ -720,6 +874,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         if shared.state.job_count == -1:
             shared.state.job_count = p.n_iter
         extra_network_data = None
+        pipeline = PostprocessPipeline(p, infotexts, output_images) if PostprocessPipeline.supported(p) else None
+        p.pipeline = pipeline
         for n in range(p.n_iter):
             p.iteration = n
             if shared.state.skipped:
@@ -741,12 +897,12 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             if not p.disable_extra_networks:
                 with devices.autocast():
                     modules.extra_networks.activate(p, extra_network_data)
+            modules.prompt_cache.cache.set_networks(extra_network_data if not p.disable_extra_networks else None)
             if p.scripts is not None:
                 p.scripts.process_batch(p, batch_number=n, prompts=p.prompts, seeds=p.seeds, subseeds=p.subseeds)
             if n == 0:
-                with open(os.path.join(modules.paths.data_path, "params.txt"), "w", encoding="utf8") as file:
-                    processed = Processed(p, [], p.seed, "")
-                    file.write(processed.infotext(p, 0))
+                processed = Processed(p, [], p.seed, "")
+                images.write_params(processed.infotext(p, 0))
             step_multiplier = 1
             sampler_config = modules.sd_samplers.find_sampler_config(p.sampler_name)
             step_multiplier = 2 if sampler_config and sampler_config.options.get("second_order", False) else 1
@@ -761,22 +917,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                         comments[comment] = 1
                 with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
                     samples_ddim = p.sample(conditioning=c, unconditional_conditioning=uc, seeds=p.seeds, subseeds=p.subseeds, subseed_strength=p.subseed_strength, prompts=p.prompts)
-                x_samples_ddim = [decode_first_stage(p.sd_model, samples_ddim[i:i+1].to(dtype=devices.dtype_vae))[0].cpu() for i in range(samples_ddim.size(0))]
-                try:
-                    for x in x_samples_ddim:
-                        devices.test_for_nans(x, "vae")
-                except devices.NansException as e:
-                    if not shared.opts.no_half and not shared.opts.no_half_vae and shared.cmd_opts.rollback_vae:
-                        shared.log.warning('Tensor with all NaNs was produced in VAE')
-                        devices.dtype_vae = torch.bfloat16
-                        vae_file, vae_source = modules.sd_vae.resolve_vae(p.sd_model.sd_model_checkpoint)
-                        modules.sd_vae.load_vae(p.sd_model, vae_file, vae_source)
-                        x_samples_ddim = [decode_first_stage(p.sd_model, samples_ddim[i:i+1].to(dtype=devices.dtype_vae))[0].cpu() for i in range(samples_ddim.size(0))]
-                        for x in x_samples_ddim:
-                            devices.test_for_nans(x, "vae")
-                    else:
-                        raise e
-                x_samples_ddim = torch.stack(x_samples_ddim).float()
+                x_samples_ddim = decode_first_stage_batched(p.sd_model, samples_ddim).float()
                 x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
                 del samples_ddim
 
@@ -802,61 +943,17 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             def infotext(index): # pylint: disable=function-redefined # noqa: F811
                 return create_infotext(p, p.prompts, p.seeds, p.subseeds, index=index, all_negative_prompts=p.negative_prompts)
 
-            for i, x_sample in enumerate(x_samples_ddim):
-                p.batch_index = i
-                if type(x_sample) == Image.Image:
-                    image = x_sample
-                    x_sample = np.array(x_sample)
-                else:
-                    x_sample = 255. * (np.moveaxis(x_sample.cpu().numpy(), 0, 2) if shared.backend == shared.Backend.ORIGINAL else x_sample)
-                    x_sample = validate_sample(x_sample)
-                    image = Image.fromarray(x_sample)
-                if p.restore_faces:
-                    if shared.opts.save and not p.do_not_save_samples and shared.opts.save_images_before_face_restoration:
-                        orig = p.restore_faces
-                        p.restore_faces = False
-                        info = infotext(i)
-                        p.restore_faces = orig
-                        images.save_image(Image.fromarray(x_sample), path=p.outpath_samples, basename="", seed=p.seeds[i], prompt=p.prompts[i], extension=shared.opts.samples_format, info=info, p=p, suffix="-before-face-restore")
-                    p.ops.append('face')
-                    x_sample = modules.face_restoration.restore_faces(x_sample)
-                    image = Image.fromarray(x_sample)
-                if p.scripts is not None:
-                    pp = modules.scripts.PostprocessImageArgs(image)
-                    p.scripts.postprocess_image(p, pp)
-                    image = pp.image
-                if p.color_corrections is not None and i < len(p.color_corrections):
-                    if shared.opts.save and not p.do_not_save_samples and shared.opts.save_images_before_color_correction:
-                        orig = p.color_corrections
-                        p.color_corrections = None
-                        info = infotext(i)
-                        p.color_corrections = orig
-                        image_without_cc = apply_overlay(image, p.paste_to, i, p.overlay_images)
-                        images.save_image(image_without_cc, path=p.outpath_samples, basename="", seed=p.seeds[i], prompt=p.prompts[i], extension=shared.opts.samples_format, info=info, p=p, suffix="-before-color-correct")
-                    p.ops.append('color')
-                    image = apply_color_correction(p.color_corrections[i], image)
-                image = apply_overlay(image, p.paste_to, i, p.overlay_images)
-                text = infotext(i)
-                infotexts.append(text)
-                image.info["parameters"] = text
-                output_images.append(image)
-                if shared.opts.samples_save and not p.do_not_save_samples:
-                    images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], shared.opts.samples_format, info=text, p=p) # main save image
-                if hasattr(p, 'mask_for_overlay') and p.mask_for_overlay and any([shared.opts.save_mask, shared.opts.save_mask_composite, shared.opts.return_mask, shared.opts.return_mask_composite]):
-                    image_mask = p.mask_for_overlay.convert('RGB')
-                    image_mask_composite = Image.composite(image.convert('RGBA').convert('RGBa'), Image.new('RGBa', image.size), images.resize_image(3, p.mask_for_overlay, image.width, image.height).convert('L')).convert('RGBA')
-                    if shared.opts.save_mask:
-                        images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], shared.opts.samples_format, info=text, p=p, suffix="-mask")
-                    if shared.opts.save_mask_composite:
-                        images.save_image(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], shared.opts.samples_format, info=text, p=p, suffix="-mask-composite")
-                    if shared.opts.return_mask:
-                        output_images.append(image_mask)
-                    if shared.opts.return_mask_composite:
-                        output_images.append(image_mask_composite)
+            if pipeline is not None:
+                pipeline.submit(x_samples_ddim)
+            else:
+                postprocess_images(p, x_samples_ddim, infotexts, output_images)
             del x_samples_ddim
             devices.torch_gc()
             shared.state.nextjob()
 
+        if pipeline is not None: # also reached on interrupt or skip so that already sampled batches are completed
+            pipeline.drain()
+            p.pipeline = None
         t1 = time.time()
         shared.log.info(f'Processed: images={len(output_images)} time={t1 - t0:.2f}s its={(p.steps * len(output_images)) / (t1 - t0):.2f} memory={modules.memstats.memory_stats()}')
 
@@ -1019,7 +1116,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
             for i in range(samples.shape[0]):
                 save_intermediate(samples, i)
             if latent_scale_mode is None or self.hr_force: # non-latent upscaling
-                decoded_samples = decode_first_stage(self.sd_model, samples.to(dtype=devices.dtype_vae))
+                decoded_samples = decode_first_stage_batched(self.sd_model, samples).float()
                 lowres_samples = torch.clamp((decoded_samples + 1.0) / 2.0, min=0.0, max=1.0)
                 batch_images = []
                 for _i, x_sample in enumerate(lowres_samples):
@@ -1035,17 +1132,17 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
                 decoded_samples = 2. * decoded_samples - 1.
                 if shared.opts.sd_vae_sliced_encode and len(decoded_samples) > 1:
                     samples = torch.stack([
-                        self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(torch.unsqueeze(decoded_sample, 0)))[0]
+                        self.sd_model.get_first_stage_encoding(encode_first_stage(self.sd_model, torch.unsqueeze(decoded_sample, 0)))[0]
                         for decoded_sample
                         in decoded_samples
                     ])
                 else:
-                    samples = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(decoded_samples))
+                    samples = self.sd_model.get_first_stage_encoding(encode_first_stage(self.sd_model, decoded_samples))
                 image_conditioning = self.img2img_image_conditioning(decoded_samples, samples)
             else:
                 samples = torch.nn.functional.interpolate(samples, size=(target_height // 8, target_width // 8), mode=latent_scale_mode["mode"], antialias=latent_scale_mode["antialias"])
                 if getattr(self, "inpainting_mask_weight", shared.opts.inpainting_mask_weight) < 1.0:
-                    image_conditioning = self.img2img_image_conditioning(decode_first_stage(self.sd_model, samples.to(dtype=devices.dtype_vae)), samples)
+                    image_conditioning = self.img2img_image_conditioning(decode_first_stage(self.sd_model, samples.to(dtype=devices.dtype_vae)).to(samples.device), samples)
                 else:
                     image_conditioning = self.txt2img_image_conditioning(samples.to(dtype=devices.dtype_vae))
                 if self.latent_sampler == "PLMS":
@@ -1194,7 +1291,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
         image = torch.from_numpy(batch_images)
         image = 2. * image - 1.
         image = image.to(device=shared.device, dtype=devices.dtype_vae)
-        self.init_latent = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(image))
+        self.init_latent = self.sd_model.get_first_stage_encoding(encode_first_stage(self.sd_model, image))
         if self.resize_mode == 4:
             self.init_latent = torch.nn.functional.interpolate(self.init_latent, size=(self.height // 8, self.width // 8), mode="bilinear")
         if image_mask is not None:
@@ -10,6 +10,8 @@ import modules.shared as shared
 import modules.sd_samplers as sd_samplers
 import modules.sd_models as sd_models
 import modules.sd_vae as sd_vae
+import modules.sd_vae_batch as sd_vae_batch
+import modules.sd_vae_tiled as sd_vae_tiled
 import modules.taesd.sd_vae_taesd as sd_vae_taesd
 import modules.images as images
 from modules.lora_diffusers import lora_state, unload_diffusers_lora
@@ -79,7 +81,19 @@ def process_diffusers(p: StableDiffusionProcessing, seeds, prompts, negative_pro
             model.upcast_vae()
             latents = latents.to(next(iter(model.vae.post_quant_conv.parameters())).dtype)
 
-        decoded = model.vae.decode(latents / model.vae.config.scaling_factor, return_dict=False)[0]
+        def upcast_vae():
+            if model.vae.dtype != torch.float16 or not hasattr(model, 'upcast_vae'):
+                return False
+            model.upcast_vae()
+            return True
+
+        def decode(chunk):
+            chunk = chunk.to(dtype=next(iter(model.vae.post_quant_conv.parameters())).dtype)
+            if sd_vae_tiled.enabled(chunk):
+                return sd_vae_tiled.decode(lambda tile: model.vae.decode(tile / model.vae.config.scaling_factor, return_dict=False)[0], chunk, model.vae.decoder)
+            return model.vae.decode(chunk / model.vae.config.scaling_factor, return_dict=False)[0]
+
+        decoded = sd_vae_batch.decode(decode, latents, rollback=upcast_vae, nan_check=shared.cmd_opts.rollback_vae, output_device=None)
         if shared.opts.diffusers_move_unet and not getattr(model, 'has_accelerate', False):
             model.unet.to(unet_device)
         t1 = time.time()
@@ -95,7 +109,14 @@ def process_diffusers(p: StableDiffusionProcessing, seeds, prompts, negative_pro
             devices.torch_gc()
         if not shared.cmd_opts.lowvram and not shared.opts.diffusers_seq_cpu_offload:
             model.vae.to(devices.device)
-        encoded = model.vae.encode(image.to(model.vae.device, model.vae.dtype))
+        image = image.to(model.vae.device, model.vae.dtype)
+        if sd_vae_tiled.enabled(image, latent=False):
+            from diffusers.models.vae import DiagonalGaussianDistribution
+            from diffusers.models.autoencoder_kl import AutoencoderKLOutput
+            moments = sd_vae_tiled.encode(lambda tile: model.vae.quant_conv(model.vae.encoder(tile)), image, model.vae.encoder).to(image.device)
+            encoded = AutoencoderKLOutput(latent_dist=DiagonalGaussianDistribution(moments))
+        else:
+            encoded = model.vae.encode(image)
         if shared.opts.diffusers_move_unet and not getattr(model, 'has_accelerate', False):
             model.unet.to(unet_device)
         return encoded
@@ -3,6 +3,7 @@ import io
 import time
 from pydantic import BaseModel, Field # pylint: disable=no-name-in-module
 import modules.shared as shared
+from modules.scheduler import scheduler
 
 
 current_task = None
@@ -37,6 +38,21 @@ def add_task_to_queue(id_job):
     pending_tasks[id_job] = time.time()
 
 
+def current_progress():
+    """progress in range 0-1 and eta in seconds of currently running job from shared state, eta is None until progress is known"""
+    job_count, job_no = shared.state.job_count, shared.state.job_no
+    sampling_steps, sampling_step = shared.state.sampling_steps, shared.state.sampling_step
+    if job_count == 0:
+        return 0, None
+    progress = job_no / job_count
+    if sampling_steps > 0:
+        progress += 1 / job_count * sampling_step / sampling_steps
+    progress = min(progress, 1)
+    elapsed = time.time() - (shared.state.time_start or time.time())
+    eta = elapsed / progress - elapsed if progress > 0 else None
+    return progress, eta
+
+
 class ProgressRequest(BaseModel):
     id_task: str = Field(default=None, title="Task ID", description="id of the task to get progress for")
     id_live_preview: int = Field(default=-1, title="Live preview image ID", description="id of last received last preview image")
@@ -59,23 +75,16 @@ def setup_progress_api(app):
 
 
 def progressapi(req: ProgressRequest):
+    job = scheduler.get(req.id_task)
     active = req.id_task == current_task
-    queued = req.id_task in pending_tasks
-    completed = req.id_task in finished_tasks
+    queued = req.id_task in pending_tasks or (job is not None and job.status == 'queued')
+    completed = req.id_task in finished_tasks or (job is not None and job.status in ['done', 'failed', 'cancelled'])
     paused = shared.state.paused
     if not active:
-        return InternalProgressResponse(active=active, queued=queued, paused=paused, completed=completed, id_live_preview=-1, textinfo="Queued..." if queued else "Waiting...")
-    progress = 0
-    job_count, job_no = shared.state.job_count, shared.state.job_no
-    sampling_steps, sampling_step = shared.state.sampling_steps, shared.state.sampling_step
-    if job_count > 0:
-        progress += job_no / job_count
-    if sampling_steps > 0 and job_count > 0:
-        progress += 1 / job_count * sampling_step / sampling_steps
-    progress = min(progress, 1)
-    elapsed_since_start = time.time() - shared.state.time_start
-    predicted_duration = elapsed_since_start / progress if progress > 0 else None
-    eta = predicted_duration - elapsed_since_start if predicted_duration is not None else None
+        position = scheduler.position(req.id_task) if queued else None
+        textinfo = f"Queued: position {position + 1}" if position is not None else "Queued..." if queued else "Waiting..."
+        return InternalProgressResponse(active=active, queued=queued, paused=paused, completed=completed, id_live_preview=-1, textinfo=textinfo)
+    progress, eta = current_progress()
     id_live_preview = req.id_live_preview
     live_preview = None
     shared.state.set_current_image()
@@ -0,0 +1,157 @@
+import threading
+import collections
+import torch
+from modules import shared
+
+
+def conditioning_size(value):
+    """total bytes of tensors referenced by conditioning structure"""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(conditioning_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(conditioning_size(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return sum(conditioning_size(v) for v in vars(value).values())
+    return 0
+
+
+def conditioning_to(value, device):
+    """copy of conditioning structure with all tensors moved to device"""
+    if isinstance(value, torch.Tensor):
+        return value.to(device)
+    if isinstance(value, dict):
+        return { k: conditioning_to(v, device) for k, v in value.items() }
+    if isinstance(value, list):
+        return [conditioning_to(v, device) for v in value]
+    if isinstance(value, tuple) and hasattr(value, '_fields'): # namedtuple such as ScheduledPromptConditioning
+        return type(value)(*[conditioning_to(v, device) for v in value])
+    if isinstance(value, tuple):
+        return tuple(conditioning_to(v, device) for v in value)
+    return value
+
+
+def conditioning_device(value):
+    """device of first tensor in conditioning structure"""
+    if isinstance(value, torch.Tensor):
+        return value.device
+    values = value.values() if isinstance(value, dict) else value if isinstance(value, (list, tuple)) else []
+    for v in values:
+        device = conditioning_device(v)
+        if device is not None:
+            return device
+    return None
+
+
+def networks_key(extra_network_data):
+    """hashable description of extra networks activated for current batch"""
+    if not extra_network_data:
+        return ()
+    return tuple((name, tuple(tuple(params.items) for params in params_list)) for name, params_list in sorted(extra_network_data.items()))
+
+
+def model_key(model):
+    if model is None:
+        return None
+    info = getattr(model, 'sd_checkpoint_info', None)
+    return getattr(model, 'sd_model_hash', None) or (info.filename if info is not None else id(model))
+
+
+def embeddings_version(model):
+    from modules import sd_hijack
+    db = getattr(model, 'embedding_db', None) if shared.backend == shared.Backend.DIFFUSERS else getattr(sd_hijack.model_hijack, 'embedding_db', None)
+    return (id(db), getattr(db, 'version', 0)) if db is not None else None
+
+
+class ConditioningCache:
+    """process-wide LRU cache of encoded prompts bounded by tensor bytes
+    entries are keyed by model, clip skip, embeddings, active extra networks, parser settings, prompt and steps
+    entries are stored in system memory so cache does not take vram and are moved back to original device on hit
+    cache is cleared when loaded model or its embeddings change since entries would never be hit again"""
+    def __init__(self):
+        self.entries = collections.OrderedDict() # key -> (conditioning, embeddings_used, comments, device)
+        self.sizes = {}
+        self.lock = threading.RLock()
+        self.networks = ()
+        self.scope = None # (model, embeddings) of current entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def enabled(self):
+        return shared.opts.prompt_cache_size > 0
+
+    def budget(self):
+        return shared.opts.prompt_cache_size * 1024 * 1024
+
+    def used(self):
+        return sum(self.sizes.values())
+
+    def set_networks(self, extra_network_data):
+        self.networks = networks_key(extra_network_data)
+
+    def key(self, model, *args):
+        scope = (model_key(shared.sd_model), embeddings_version(shared.sd_model))
+        with self.lock:
+            if scope != self.scope:
+                if len(self.entries) > 0:
+                    shared.log.debug(f'Prompt cache: invalidate entries={len(self.entries)}')
+                self.clear()
+                self.scope = scope
+        settings = (shared.opts.CLIP_stop_at_last_layers, shared.opts.prompt_attention, shared.opts.prompt_mean_norm, shared.opts.comma_padding_backtrack)
+        return scope + (model_key(model), settings, self.networks) + args
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+        conditioning, embeddings_used, comments, device = entry
+        return (conditioning_to(conditioning, device) if device is not None else conditioning), embeddings_used, comments
+
+    def put(self, key, conditioning, embeddings_used=(), comments=()):
+        if not self.enabled():
+            return
+        size = conditioning_size(conditioning)
+        if size > self.budget():
+            return
+        device = conditioning_device(conditioning)
+        stored = conditioning_to(conditioning, torch.device('cpu')) if device is not None and device.type != 'cpu' else conditioning
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = (stored, list(embeddings_used), list(comments), device)
+            self.sizes[key] = size
+            while len(self.entries) > 1 and self.used() > self.budget():
+                victim = next(iter(self.entries))
+                self.pop(victim)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            self.sizes.pop(key, None)
+            return self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'used': self.used(),
+                'budget': self.budget(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 3) if total > 0 else 0,
+            }
+
+
+cache = ConditioningCache()
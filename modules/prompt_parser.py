@@ -9,6 +9,8 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 import os
 import re
+import threading
+import collections
 from collections import namedtuple
 from typing import List
 import lark
@@ -162,21 +164,35 @@ def get_learned_conditioning(model, prompts, steps):
         ]
     ]
     """
+    from modules import prompt_cache, sd_hijack
     res = []
     prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps)
     cache = {}
+    hijack = sd_hijack.model_hijack
     for prompt, prompt_schedule in zip(prompts, prompt_schedules):
         debug(f'Prompt schedule: {prompt_schedule}')
         cached = cache.get(prompt, None)
         if cached is not None:
             res.append(cached)
             continue
+        key = prompt_cache.cache.key(model, prompt, steps) if prompt_cache.cache.enabled() else None
+        entry = prompt_cache.cache.get(key) if key is not None else None
+        if entry is not None:
+            cond_schedule, embeddings_used, comments = entry
+            hijack.embedding_db.embeddings_used = list(embeddings_used)
+            hijack.comments += comments
+            cache[prompt] = cond_schedule
+            res.append(cond_schedule)
+            continue
+        comments = len(hijack.comments)
         texts = [x[1] for x in prompt_schedule]
         conds = model.get_learned_conditioning(texts)
         cond_schedule = []
         for i, (end_at_step, _text) in enumerate(prompt_schedule):
             cond_schedule.append(ScheduledPromptConditioning(end_at_step, conds[i]))
         cache[prompt] = cond_schedule
+        if key is not None:
+            prompt_cache.cache.put(key, cond_schedule, hijack.embedding_db.embeddings_used, hijack.comments[comments:])
         res.append(cond_schedule)
     return res
 
@@ -227,42 +243,90 @@ def get_multicond_learned_conditioning(model, prompts, steps) -> MulticondLearne
     return MulticondLearnedConditioning(shape=(len(prompts),), batch=res)
 
 
+class CompiledSchedules:
+    """list of prompt schedules compiled into one stacked tensor of all distinct conds and per-step index table
+    each step then needs single index_select, or nothing at all if active schedules did not change since previous step
+    returned tensor is shared between steps and must not be modified in-place"""
+    def __init__(self, schedules: List[List[ScheduledPromptConditioning]]):
+        param = schedules[0][0].cond
+        conds = []
+        positions = {}
+        for schedule in schedules:
+            for entry in schedule:
+                if id(entry.cond) not in positions:
+                    positions[id(entry.cond)] = len(conds)
+                    conds.append(entry.cond)
+        # if prompts have wildly different lengths above the limit we'll get tensors fo different shapes and won't be able to torch.stack them. So this fixes that.
+        token_count = max([x.shape[0] for x in conds])
+        for i in range(len(conds)):
+            if conds[i].shape[0] != token_count:
+                last_vector = conds[i][-1:]
+                last_vector_repeated = last_vector.repeat([token_count - conds[i].shape[0], 1])
+                conds[i] = torch.vstack([conds[i], last_vector_repeated])
+        self.stacked = torch.stack(conds).to(device=param.device, dtype=param.dtype)
+        lengths = { positions[id(x.cond)]: x.cond.shape[0] for schedule in schedules for x in schedule }
+        last_step = max(entry.end_at_step for schedule in schedules for entry in schedule)
+        patterns = {}
+        self.steps = [] # step -> pattern index, last entry is used for any step past all schedules
+        self.patterns = [] # pattern index -> (index tensor, token count)
+        for step in range(last_step + 2):
+            rows = []
+            for schedule in schedules:
+                target = next((entry for entry in schedule if step <= entry.end_at_step), schedule[0])
+                rows.append(positions[id(target.cond)])
+            rows = tuple(rows)
+            if rows not in patterns:
+                patterns[rows] = len(self.patterns)
+                self.patterns.append((torch.tensor(rows, dtype=torch.long, device=self.stacked.device), max(lengths[r] for r in rows)))
+            self.steps.append(patterns[rows])
+        self.current = None
+        self.tensor = None
+
+    def at(self, step):
+        pattern = self.steps[min(max(step, 0), len(self.steps) - 1)]
+        if pattern != self.current:
+            index, token_count = self.patterns[pattern]
+            self.tensor = self.stacked.index_select(0, index)[:, :token_count]
+            self.current = pattern
+        return self.tensor
+
+
+compiled_schedules = collections.OrderedDict() # id -> (conditioning, compiled), bounded to conditionings of few most recent jobs
+compiled_schedules_lock = threading.Lock()
+
+
+def compile_schedules(c, get_schedules):
+    """compiled schedules of conditioning c, get_schedules is only called to build list of schedules on cache miss"""
+    with compiled_schedules_lock:
+        entry = compiled_schedules.get(id(c), None)
+        if entry is not None and entry[0] is c:
+            return entry[1]
+    compiled = CompiledSchedules(get_schedules())
+    with compiled_schedules_lock:
+        compiled_schedules[id(c)] = (c, compiled)
+        while len(compiled_schedules) > 4:
+            compiled_schedules.popitem(last=False)
+    return compiled
+
+
 def reconstruct_cond_batch(c: List[List[ScheduledPromptConditioning]], current_step):
-    param = c[0][0].cond
-    res = torch.zeros((len(c),) + param.shape, device=param.device, dtype=param.dtype)
-    for i, cond_schedule in enumerate(c):
-        target_index = 0
-        for current, (end_at, _cond) in enumerate(cond_schedule):
-            if current_step <= end_at:
-                target_index = current
-                break
-        res[i] = cond_schedule[target_index].cond
-    return res
+    return compile_schedules(c, lambda: c).at(current_step)
 
 
 def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
-    param = c.batch[0][0].schedules[0].cond
-    tensors = []
-    conds_list = []
-    for composable_prompts in c.batch:
-        conds_for_batch = []
-        for composable_prompt in composable_prompts:
-            target_index = 0
-            for current, entry in enumerate(composable_prompt.schedules):
-                if current_step <= entry.end_at_step:
-                    target_index = current
-                    break
-            conds_for_batch.append((len(tensors), composable_prompt.weight))
-            tensors.append(composable_prompt.schedules[target_index].cond)
-        conds_list.append(conds_for_batch)
-    # if prompts have wildly different lengths above the limit we'll get tensors fo different shapes and won't be able to torch.stack them. So this fixes that.
-    token_count = max([x.shape[0] for x in tensors])
-    for i in range(len(tensors)):
-        if tensors[i].shape[0] != token_count:
-            last_vector = tensors[i][-1:]
-            last_vector_repeated = last_vector.repeat([token_count - tensors[i].shape[0], 1])
-            tensors[i] = torch.vstack([tensors[i], last_vector_repeated])
-    return conds_list, torch.stack(tensors).to(device=param.device, dtype=param.dtype)
+    conds_list = getattr(c, 'conds_list', None)
+    if conds_list is None:
+        conds_list = []
+        index = 0
+        for composable_prompts in c.batch:
+            conds_for_batch = []
+            for composable_prompt in composable_prompts:
+                conds_for_batch.append((index, composable_prompt.weight))
+                index += 1
+            conds_list.append(conds_for_batch)
+        c.conds_list = conds_list # layout of flattened conds does not depend on step
+    compiled = compile_schedules(c, lambda: [composable_prompt.schedules for composable_prompts in c.batch for composable_prompt in composable_prompts])
+    return conds_list, compiled.at(current_step)
 
 
 def parse_prompt_attention(text):
@@ -5,6 +5,7 @@ from compel import Compel, ReturnedEmbeddingsType
 from compel.embeddings_provider import BaseTextualInversionManager
 import modules.shared as shared
 import modules.prompt_parser as prompt_parser
+import modules.prompt_cache as prompt_cache
 
 
 debug_output = os.environ.get('SD_PROMPT_DEBUG', None)
@@ -88,12 +89,18 @@ def compel_encode_prompts(
     negative_embeds = []
     negative_pooleds = []
     for i in range(len(prompts)):
-        prompt_embed, positive_pooled, negative_embed, negative_pooled = compel_encode_prompt(pipeline,
-                                                                                              prompts[i],
-                                                                                              negative_prompts[i],
-                                                                                              prompts_2[i] if prompts_2 is not None else None,
-                                                                                              negative_prompts_2[i] if negative_prompts_2 is not None else None,
-                                                                                              is_refiner, clip_skip)
+        args = (prompts[i], negative_prompts[i], prompts_2[i] if prompts_2 is not None else None, negative_prompts_2[i] if negative_prompts_2 is not None else None, is_refiner, clip_skip)
+        key = prompt_cache.cache.key(pipeline, *args) if prompt_cache.cache.enabled() else None
+        entry = prompt_cache.cache.get(key) if key is not None else None
+        if entry is not None:
+            (prompt_embed, positive_pooled, negative_embed, negative_pooled), embeddings_used, _comments = entry
+            if hasattr(pipeline, 'embedding_db'): # encode resets embeddings used on every call so restore what it would have recorded
+                pipeline.embedding_db.embeddings_used = list(embeddings_used)
+        else:
+            prompt_embed, positive_pooled, negative_embed, negative_pooled = compel_encode_prompt(pipeline, *args)
+            if key is not None and prompt_embed is not None:
+                embeddings_used = pipeline.embedding_db.embeddings_used if hasattr(pipeline, 'embedding_db') else []
+                prompt_cache.cache.put(key, (prompt_embed, positive_pooled, negative_embed, negative_pooled), embeddings_used)
         prompt_embeds.append(prompt_embed)
         positive_pooleds.append(positive_pooled)
         negative_embeds.append(negative_embed)
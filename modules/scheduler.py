@@ -0,0 +1,237 @@
+import time
+import uuid
+import threading
+import contextlib
+import contextvars
+import collections
+from modules import shared
+
+
+INTERACTIVE = 0
+BATCH = 1
+priorities = { 'interactive': INTERACTIVE, 'batch': BATCH }
+history_size = 256
+
+current_client = contextvars.ContextVar('scheduler_client', default='local') # set per api request from client address or x-client-id header
+current_priority = contextvars.ContextVar('scheduler_priority', default=INTERACTIVE)
+current_job_id = contextvars.ContextVar('scheduler_job_id', default=None)
+current_cancel = contextvars.ContextVar('scheduler_cancel', default=None) # event set when job is cancelled before it is registered with scheduler
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, name, priority=INTERACTIVE, client='local', id_job=None):
+        self.id = id_job or f'job({uuid.uuid4().hex})'
+        self.name = name
+        self.priority = priority
+        self.client = client
+        self.status = 'queued' # queued, running, done, failed, cancelled
+        self.cancelled = False
+        self.thread = threading.get_ident()
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def wait_time(self):
+        end = self.started or self.finished or time.time()
+        return end - self.submitted
+
+    def run_time(self):
+        return (self.finished or time.time()) - self.started if self.started is not None else 0
+
+    def dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'priority': 'batch' if self.priority == BATCH else 'interactive',
+            'client': self.client,
+            'status': self.status,
+            'submitted': self.submitted,
+            'wait': round(self.wait_time(), 3),
+            'run': round(self.run_time(), 3),
+        }
+
+
+class Scheduler:
+    """single gpu worker job scheduler replacing global queue lock
+    jobs run one at a time, interactive jobs before batch jobs, clients of same priority are served round-robin and each client in fifo order
+    queued jobs can be cancelled, running jobs are interrupted via shared state
+    scheduler can also be used as plain context manager in place of a lock"""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues = { INTERACTIVE: collections.OrderedDict(), BATCH: collections.OrderedDict() } # priority -> client -> deque of jobs
+        self.jobs = collections.OrderedDict() # id -> job, includes recently finished jobs
+        self.running = None
+        self.local = threading.local()
+        self.submitted = 0
+        self.started = 0
+        self.finished = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    def depth(self):
+        return { 'interactive': sum(len(q) for q in self.queues[INTERACTIVE].values()), 'batch': sum(len(q) for q in self.queues[BATCH].values()) }
+
+    def position(self, id_job):
+        """number of jobs that would currently start before given queued job"""
+        with self.cond:
+            job = self.jobs.get(id_job, None)
+            if job is None or job.status != 'queued':
+                return None
+            order = []
+            for priority in sorted(self.queues.keys()):
+                queues = [list(q) for q in self.queues[priority].values()]
+                while any(queues):
+                    for q in queues:
+                        if q:
+                            order.append(q.pop(0))
+            return order.index(job)
+
+    def get(self, id_job):
+        with self.cond:
+            return self.jobs.get(id_job, None)
+
+    def dispatch(self):
+        if self.running is not None:
+            return
+        for priority in sorted(self.queues.keys()):
+            queue = self.queues[priority]
+            if len(queue) == 0:
+                continue
+            client, jobs = next(iter(queue.items()))
+            job = jobs.popleft()
+            if len(jobs) == 0:
+                del queue[client]
+            else:
+                queue.move_to_end(client) # round-robin between clients
+            job.status = 'running'
+            job.started = time.time()
+            self.running = job
+            self.started += 1
+            self.wait_total += job.started - job.submitted
+            self.wait_max = max(self.wait_max, job.started - job.submitted)
+            self.cond.notify_all()
+            return
+
+    def enter(self, job):
+        with self.cond:
+            self.submitted += 1
+            self.jobs[job.id] = job
+            while len(self.jobs) > history_size:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.status in ['queued', 'running']:
+                    break
+                self.jobs.popitem(last=False)
+            self.queues[job.priority].setdefault(job.client, collections.deque()).append(job)
+            self.dispatch()
+            while job.status == 'queued':
+                self.cond.wait()
+            if job.status == 'cancelled':
+                raise JobCancelled(f'Job cancelled: id={job.id} name={job.name}')
+        return job
+
+    def leave(self, job, error=False):
+        with self.cond:
+            job.finished = time.time()
+            if job.cancelled:
+                job.status = 'cancelled'
+                self.cancelled += 1
+            elif error:
+                job.status = 'failed'
+                self.failed += 1
+            else:
+                job.status = 'done'
+                self.completed += 1
+            self.finished += 1
+            self.run_total += job.finished - job.started
+            if self.running is job:
+                self.running = None
+            self.dispatch()
+
+    @contextlib.contextmanager
+    def job(self, name, priority=None, client=None, id_job=None):
+        """run block as scheduled job, nested use from thread that already runs a job executes inline"""
+        running = self.running
+        if running is not None and running.thread == threading.get_ident():
+            yield running
+            return
+        job = Job(name, priority=current_priority.get() if priority is None else priority, client=client or current_client.get(), id_job=id_job or current_job_id.get())
+        cancel = current_cancel.get()
+        if cancel is not None and cancel.is_set():
+            raise JobCancelled(f'Job cancelled: id={job.id} name={job.name}')
+        self.enter(job)
+        if cancel is not None and cancel.is_set(): # cancelled after check but before job was registered so scheduler could not see it
+            job.cancelled = True
+            self.leave(job)
+            raise JobCancelled(f'Job cancelled: id={job.id} name={job.name}')
+        try:
+            yield job
+        except BaseException:
+            self.leave(job, error=True)
+            raise
+        self.leave(job)
+
+    def cancel(self, id_job):
+        with self.cond:
+            job = self.jobs.get(id_job, None)
+            if job is None:
+                return False
+            if job.status == 'queued':
+                queue = self.queues[job.priority]
+                jobs = queue.get(job.client, None)
+                if jobs is not None and job in jobs:
+                    jobs.remove(job)
+                    if len(jobs) == 0:
+                        del queue[job.client]
+                job.status = 'cancelled'
+                job.cancelled = True
+                job.finished = time.time()
+                self.cancelled += 1
+                self.cond.notify_all()
+                shared.log.info(f'Scheduler: cancelled queued job id={job.id} name={job.name}')
+                return True
+            if job.status == 'running':
+                job.cancelled = True
+                shared.state.interrupt()
+                shared.log.info(f'Scheduler: cancelled running job id={job.id} name={job.name}')
+                return True
+            return False
+
+    def __enter__(self):
+        context = self.job('queue')
+        context.__enter__() # pylint: disable=unnecessary-dunder-call
+        if not hasattr(self.local, 'contexts'):
+            self.local.contexts = []
+        self.local.contexts.append(context)
+        return self
+
+    def __exit__(self, *args):
+        return self.local.contexts.pop().__exit__(*args)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'depth': self.depth(),
+                'running': self.running.dict() if self.running is not None else None,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'wait_avg': round(self.wait_total / self.started, 3) if self.started > 0 else 0,
+                'wait_max': round(self.wait_max, 3),
+                'run_avg': round(self.run_total / self.finished, 3) if self.finished > 0 else 0,
+            }
+
+    def history(self):
+        with self.cond:
+            return [job.dict() for job in self.jobs.values()]
+
+
+scheduler = Scheduler()
@@ -383,6 +383,7 @@ def on_image_saved(callback):
     """register a function to be called after an image is saved to a file.
     The callback is called with one argument:
         - params: ImageSaveParams - parameters the image was saved with. Changing fields in this object does nothing.
+    The callback runs on image saver worker thread, not on thread that generated the image, and is not called if save failed.
     """
     add_callback(callback_map['callbacks_image_saved'], callback)
 
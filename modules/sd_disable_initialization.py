@@ -1,3 +1,4 @@
+import threading
 import ldm.modules.encoders.modules
 import open_clip
 import torch
@@ -90,3 +91,44 @@ class DisableInitialization:
             setattr(obj, field, original)
 
         self.replaced.clear()
+
+
+class InitializeOnMeta(DisableInitialization):
+    """
+    Context manager that causes all parameters of common layers to be created on meta device so that module tree
+    is constructed without allocating memory, weights are later materialized from checkpoint tensors.
+    Module.to is disabled while active since constructors moving layers to a device would fail on meta tensors.
+    Patches only apply to the thread that entered the block, other threads keep original behavior.
+    ```
+    with InitializeOnMeta():
+        sd_model = instantiate_from_config(sd_config.model)
+    ```
+    """
+
+    def __init__(self, enabled=True): # pylint: disable=super-init-not-called
+        self.replaced = []
+        self.enabled = enabled
+
+    def __enter__(self):
+        if not self.enabled:
+            return
+
+        owner = threading.get_ident()
+
+        def on_meta(original):
+            def init(*args, **kwargs):
+                if threading.get_ident() == owner:
+                    kwargs["device"] = "meta"
+                return original(*args, **kwargs)
+            return init
+
+        def no_move(original):
+            def to(module, *args, **kwargs):
+                if threading.get_ident() == owner:
+                    return module
+                return original(module, *args, **kwargs)
+            return to
+
+        for cls in [torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d, torch.nn.MultiheadAttention, torch.nn.LayerNorm, torch.nn.GroupNorm, torch.nn.Embedding]:
+            self.replace(cls, '__init__', on_meta(cls.__init__))
+        self.replace(torch.nn.Module, 'to', no_move(torch.nn.Module.to))
@@ -1,16 +1,18 @@
 import re
 import io
+import copy
 import sys
 import json
 import time
 import logging
 import threading
 import contextlib
-import collections
+import collections.abc
 import os.path
 from os import mkdir
 from urllib import request
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 from rich import progress # pylint: disable=redefined-builtin
 import torch
 import safetensors.torch
@@ -19,7 +21,7 @@ import tomesd
 from transformers import logging as transformers_logging
 import ldm.modules.midas as midas
 from ldm.util import instantiate_from_config
-from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config
+from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, cachedb, sd_models_cache, sd_models_delta
 from modules.sd_hijack_inpainting import do_inpainting_hijack
 from modules.timer import Timer
 from modules.memstats import memory_stats
@@ -36,11 +38,13 @@ model_dir = "Stable-diffusion"
 model_path = os.path.abspath(os.path.join(paths.models_path, model_dir))
 checkpoints_list = {}
 checkpoint_aliases = {}
-checkpoints_loaded = collections.OrderedDict()
+checkpoints_loaded = sd_models_cache.CheckpointCache()
 sd_metadata_file = os.path.join(paths.data_path, "metadata.json")
-sd_metadata = None
+sd_headers_file = os.path.join(paths.data_path, "headers.json")
 sd_metadata_pending = 0
 sd_metadata_timer = 0
+sd_fingerprints = {} # (filename, size, mtime, inode) -> submodule fingerprints
+fingerprint_samples = 4096 # elements sampled per tensor
 
 class CheckpointInfo:
     def __init__(self, filename):
@@ -49,6 +53,7 @@ class CheckpointInfo:
         self.hash = None
         self.filename = filename
         self.type = ''
+        self.delta_base = None # sha256 of base model if this is a delta checkpoint
         abspath = os.path.abspath(filename)
 
         if os.path.isfile(abspath): # ckpt or safetensor
@@ -96,22 +101,30 @@ class CheckpointInfo:
                 self.metadata = read_metadata_from_safetensors(filename)
             except Exception as e:
                 errors.display(e, f"reading checkpoint metadata: {filename}")
+            self.delta_base = self.metadata.get('sd_delta_base', None)
 
     def register(self):
         checkpoints_list[self.title] = self
         for i in self.ids:
             checkpoint_aliases[i] = self
 
-    def calculate_shorthash(self):
-        self.sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}")
-        if self.sha256 is None:
-            return
+    def set_hash(self, sha256):
+        """update hash, title and lookup ids once hash is known"""
+        self.sha256 = sha256
+        self.hash = self.sha256[0:8]
         self.shorthash = self.sha256[0:10]
         if self.shorthash not in self.ids:
-            self.ids += [self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]']
-        checkpoints_list.pop(self.title)
+            self.ids += [self.hash, self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]']
+        if checkpoints_list.get(self.title, None) is self:
+            checkpoints_list.pop(self.title)
         self.title = f'{self.name} [{self.shorthash}]'
         self.register()
+
+    def calculate_shorthash(self):
+        sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}")
+        if sha256 is None:
+            return
+        self.set_hash(sha256)
         return self.shorthash
 
 
@@ -159,6 +172,7 @@ def list_models():
     model_list = modelloader.load_models(model_path=model_path, model_url=None, command_path=shared.opts.ckpt_dir, ext_filter=ext_filter, download_name=None, ext_blacklist=[".vae.ckpt", ".vae.safetensors"])
     if shared.backend == shared.Backend.DIFFUSERS:
         model_list += modelloader.load_diffusers_models(model_path=os.path.join(models_path, 'Diffusers'), command_path=shared.opts.diffusers_dir)
+    prefetch_safetensors_headers(model_list)
     for filename in sorted(model_list, key=str.lower):
         checkpoint_info = CheckpointInfo(filename)
         if checkpoint_info.name is not None:
@@ -175,6 +189,7 @@ def list_models():
     elif shared.cmd_opts.ckpt != shared.default_sd_model_file and shared.cmd_opts.ckpt is not None:
         shared.log.warning(f"Checkpoint not found: {shared.cmd_opts.ckpt}")
     shared.log.info(f'Available models: {shared.opts.ckpt_dir} items={len(checkpoints_list)} time={time.time()-t0:.2f}s')
+    hashes.queue_unhashed([(ckpt.filename, f"checkpoint/{ckpt.name}", False, ckpt.set_hash) for ckpt in checkpoints_list.values() if ckpt.sha256 is None and ckpt.type != 'diffusers'])
 
     checkpoints_list = dict(sorted(checkpoints_list.items(), key=lambda cp: cp[1].filename))
     if len(checkpoints_list) == 0:
@@ -306,12 +321,17 @@ def get_state_dict_from_checkpoint(pl_sd):
     return pl_sd
 
 
+def metadata_store():
+    return cachedb.get_store(sd_metadata_file, flat='metadata')
+
+
 def write_metadata():
     global sd_metadata_pending # pylint: disable=global-statement
     if sd_metadata_pending == 0:
         shared.log.debug(f"Model metadata: {sd_metadata_file} no changes")
         return
-    shared.writefile(sd_metadata, sd_metadata_file)
+    metadata_store().commit()
+    header_store().commit()
     shared.log.info(f"Model metadata saved: {sd_metadata_file} items={sd_metadata_pending} time={sd_metadata_timer:.2f}s")
     sd_metadata_pending = 0
 
@@ -330,14 +350,70 @@ def scrub_dict(dict_obj, keys):
     return
 
 
+def header_store():
+    return cachedb.get_store(sd_headers_file, flat='safetensors')
+
+
+def read_safetensors_header(filename):
+    """returns indexed safetensors header: tensors as name -> [dtype, shape, start, end] and raw metadata"""
+    res = header_store().get('safetensors', filename, filename)
+    if res is not None:
+        return res
+    with open(filename, mode="rb") as file:
+        header_len = int.from_bytes(file.read(8), "little")
+        header = file.read(header_len)
+    if header_len <= 2 or header[0:2] not in (b'{"', b"{'"):
+        shared.log.error(f"Not a valid safetensors file: {filename}")
+    json_obj = json.loads(header)
+    metadata = {}
+    for k, v in json_obj.pop("__metadata__", {}).items():
+        if v.startswith("data:"):
+            v = 'data'
+        if len(v) > 2048 and k in ['ss_datasets', 'workflow', 'prompt', 'ss_bucket_info']:
+            continue
+        metadata[k] = v
+    tensors = { k: [v['dtype'], v['shape'], *v['data_offsets']] for k, v in json_obj.items() }
+    res = { 'metadata': metadata, 'tensors': tensors }
+    header_store().set('safetensors', filename, res, filename)
+    return res
+
+
+def prefetch_safetensors_headers(filenames):
+    """populate header index concurrently so that following reads do not open files serially"""
+    if shared.cmd_opts.no_metadata:
+        return
+    filenames = [f for f in filenames if f.lower().endswith('.safetensors')]
+    if len(filenames) == 0:
+        return
+
+    def prefetch(filename):
+        try:
+            read_safetensors_header(filename)
+        except Exception as e:
+            shared.log.error(f"Error reading header from: {filename} {e}")
+
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=16, thread_name_prefix='header') as executor:
+        list(executor.map(prefetch, filenames))
+    header_store().commit()
+    shared.log.debug(f'Model headers: items={len(filenames)} time={time.time()-t0:.2f}s')
+
+
+def sniff_model_type(filename):
+    """guess model type from indexed tensor names without loading the model"""
+    try:
+        keys = read_safetensors_header(filename)['tensors'].keys()
+    except Exception:
+        return None
+    if any(k.startswith('conditioner.embedders.') for k in keys):
+        return 'Stable Diffusion XL'
+    if any(k.startswith('cond_stage_model.') for k in keys):
+        return 'Stable Diffusion'
+    return None
+
+
 def read_metadata_from_safetensors(filename):
-    global sd_metadata # pylint: disable=global-statement
-    if sd_metadata is None:
-        if not os.path.isfile(sd_metadata_file):
-            sd_metadata = {}
-        else:
-            sd_metadata = shared.readfile(sd_metadata_file)
-    res = sd_metadata.get(filename, None)
+    res = metadata_store().get('metadata', filename, filename)
     if res is not None:
         return res
     res = {}
@@ -345,39 +421,21 @@ def read_metadata_from_safetensors(filename):
         return {}
     try:
         t0 = time.time()
-        with open(filename, mode="rb") as file:
-            metadata_len = file.read(8)
-            metadata_len = int.from_bytes(metadata_len, "little")
-            json_start = file.read(2)
-            if metadata_len <= 2 or json_start not in (b'{"', b"{'"):
-                shared.log.error(f"Not a valid safetensors file: {filename}")
-            json_data = json_start + file.read(metadata_len-2)
-            json_obj = json.loads(json_data)
-            for k, v in json_obj.get("__metadata__", {}).items():
-                if v.startswith("data:"):
-                    v = 'data'
-                if k == 'format' and v == 'pt':
-                    continue
-                large = True if len(v) > 2048 else False
-                if large and k == 'ss_datasets':
-                    continue
-                if large and k == 'workflow':
-                    continue
-                if large and k == 'prompt':
-                    continue
-                if large and k == 'ss_bucket_info':
-                    continue
-                if v[0:1] == '{':
-                    try:
-                        v = json.loads(v)
-                        if large and k == 'ss_tag_frequency':
-                            v = { i: len(j) for i, j in v.items() }
-                        if large and k == 'sd_merge_models':
-                            scrub_dict(v, ['sd_merge_recipe'])
-                    except Exception:
-                        pass
-                res[k] = v
-        sd_metadata[filename] = res
+        for k, v in read_safetensors_header(filename)['metadata'].items():
+            if k == 'format' and v == 'pt':
+                continue
+            large = True if len(v) > 2048 else False
+            if v[0:1] == '{':
+                try:
+                    v = json.loads(v)
+                    if large and k == 'ss_tag_frequency':
+                        v = { i: len(j) for i, j in v.items() }
+                    if large and k == 'sd_merge_models':
+                        scrub_dict(v, ['sd_merge_recipe'])
+                except Exception:
+                    pass
+            res[k] = v
+        metadata_store().set('metadata', filename, res, filename)
         global sd_metadata_pending # pylint: disable=global-statement
         sd_metadata_pending += 1
         t1 = time.time()
@@ -392,6 +450,10 @@ def read_state_dict(checkpoint_file, map_location=None): # pylint: disable=unuse
     if shared.backend == shared.Backend.DIFFUSERS:
         return None
     try:
+        if checkpoint_file.lower().endswith('.safetensors'):
+            metadata = read_safetensors_header(checkpoint_file).get('metadata', {})
+            if 'sd_delta_base' in metadata:
+                return sd_models_delta.read_delta(checkpoint_file, metadata)
         pl_sd = None
         with progress.open(checkpoint_file, 'rb', description=f'[cyan]Loading weights: [yellow]{checkpoint_file}', auto_refresh=True, console=shared.console) as f:
             _, extension = os.path.splitext(checkpoint_file)
@@ -423,36 +485,222 @@ def read_state_dict(checkpoint_file, map_location=None): # pylint: disable=unuse
 
 
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
-    if checkpoint_info in checkpoints_loaded:
+    res = checkpoints_loaded.get(checkpoint_info)
+    if res is not None:
         shared.log.info("Model weights loading: from cache")
-        return checkpoints_loaded[checkpoint_info]
+        return res
+    res = sd_models_cache.prefetcher.take(checkpoint_info)
+    if res is not None:
+        shared.log.info("Model weights loading: from prefetch")
+        timer.record("load")
+        return res
+    if shared.opts.sd_stream_weights and checkpoint_info.filename.lower().endswith('.safetensors') and checkpoint_info.delta_base is None and shared.backend == shared.Backend.ORIGINAL:
+        try:
+            res = LazyStateDict(checkpoint_info.filename)
+            shared.log.debug(f'Model weights loading: type=safetensors mode=streaming tensors={len(res)}')
+            timer.record("load")
+            return res
+        except Exception as e:
+            shared.log.warning(f'Model weights streaming failed: {checkpoint_info.filename} {e}')
+    t0 = time.time()
     res = read_state_dict(checkpoint_info.filename)
+    checkpoints_loaded.record_cost(checkpoint_info, time.time() - t0)
     timer.record("load")
     return res
 
 
-def load_model_weights(model: torch.nn.Module, checkpoint_info: CheckpointInfo, state_dict, timer):
-    _pipeline, _model_type = detect_pipeline(checkpoint_info.path, 'model')
-    shared.log.debug(f'Model weights loading: {memory_stats()}')
-    timer.record("hash")
-    if model_data.sd_dict == 'None':
-        shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
-    if state_dict is None:
-        state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
-    try:
-        model.load_state_dict(state_dict, strict=False)
-    except Exception as e:
-        shared.log.error(f'Error loading model weights: {checkpoint_info.filename}')
-        shared.log.error(' '.join(str(e).splitlines()[:2]))
+class LazyStateDict(collections.abc.Mapping):
+    """state dict view over safetensors file that reads tensors on access with checkpoint keys remapped on the fly"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = safetensors.safe_open(filename, framework="pt", device="cpu") # uses mmap so only accessed tensors are read
+        self.keys_map = {}
+        for k in self.file.keys():
+            new_key = transform_checkpoint_dict_key(k)
+            if new_key is not None:
+                self.keys_map[new_key] = k
+
+    def __getitem__(self, key):
+        return self.file.get_tensor(self.keys_map[key])
+
+    def __contains__(self, key):
+        return key in self.keys_map
+
+    def __iter__(self):
+        return iter(self.keys_map)
+
+    def __len__(self):
+        return len(self.keys_map)
+
+
+def load_state_dict_streaming(model: torch.nn.Module, state_dict, modules=None):
+    """copy tensors one module at a time into existing parameters casting to parameter dtype so peak overhead is a single module
+    goes through _load_from_state_dict so that module load hooks still run"""
+    missing_keys, unexpected_keys, error_msgs = [], [], []
+    with torch.no_grad():
+        for name, module in (modules if modules is not None else model.named_modules()):
+            prefix = f'{name}.' if len(name) > 0 else ''
+            keys = [prefix + k for k, v in module._parameters.items() if v is not None] # pylint: disable=protected-access
+            keys += [prefix + k for k, v in module._buffers.items() if v is not None and k not in module._non_persistent_buffers_set] # pylint: disable=protected-access
+            local_state_dict = { k: state_dict[k] for k in keys if k in state_dict }
+            if len(local_state_dict) == 0:
+                continue
+            module._load_from_state_dict(local_state_dict, prefix, {}, False, missing_keys, unexpected_keys, error_msgs) # pylint: disable=protected-access
+            del local_state_dict
+    if len(error_msgs) > 0:
+        raise RuntimeError('\n'.join(error_msgs))
+
+
+def tensor_sample(state_dict, key):
+    """strided sample of tensor elements, streaming state dict reads only first and last rows instead of whole tensor"""
+    if isinstance(state_dict, LazyStateDict):
+        tensor_slice = state_dict.file.get_slice(state_dict.keys_map[key])
+        shape = tensor_slice.get_shape()
+        if len(shape) > 0 and shape[0] > 2:
+            return torch.cat([tensor_slice[0:1].reshape(-1), tensor_slice[shape[0]-1:shape[0]].reshape(-1)]), shape
+    v = state_dict[key]
+    if not isinstance(v, torch.Tensor):
+        return None, None
+    flat = v.detach().reshape(-1)
+    return flat[::max(1, flat.numel() // fingerprint_samples)], v.shape
+
+
+def state_dict_fingerprints(state_dict, filename=None):
+    """per top-level submodule hash of sampled tensor contents, computed once per checkpoint file
+    different fingerprints rule out unchanged submodule, equal fingerprints are only a candidate confirmed by weights_unchanged"""
+    import hashlib
+    stat = cachedb.file_stat(filename) if filename is not None else None
+    if stat is not None and (filename, *stat) in sd_fingerprints:
+        return dict(sd_fingerprints[(filename, *stat)])
+    fingerprints = {}
+    for k in sorted(state_dict.keys()):
+        sample, shape = tensor_sample(state_dict, k)
+        if sample is None:
+            continue
+        h = fingerprints.setdefault(k.split('.')[0], hashlib.blake2b(digest_size=16))
+        h.update(f'{k}:{sample.dtype}:{tuple(shape)}'.encode())
+        h.update(memoryview(sample.cpu().contiguous().view(torch.uint8).numpy()))
+    fingerprints = { k: h.hexdigest() for k, h in fingerprints.items() }
+    if stat is not None:
+        sd_fingerprints[(filename, *stat)] = fingerprints
+    return dict(fingerprints)
+
+
+def weights_unchanged(modules, state_dict, prefix):
+    """exact check that loading top-level submodule from state dict would not change any of its weights"""
+    with torch.no_grad():
+        for name, module in modules.items():
+            if name.split('.')[0] != prefix:
+                continue
+            for k, v in list(module._parameters.items()) + list(module._buffers.items()): # pylint: disable=protected-access
+                key = f'{name}.{k}'
+                if v is None or key not in state_dict:
+                    continue
+                tensor = state_dict[key]
+                if tensor.shape != v.shape or not torch.equal(tensor.to(device=v.device, dtype=v.dtype), v):
+                    return False
+    return True
+
+
+def hot_swap_weights(sd_model, checkpoint_info: CheckpointInfo, state_dict, timer):
+    """overwrite weights of loaded model in-place on its current device keeping hijacks, compiled graphs and embeddings
+    only valid for checkpoint with same config as loaded model"""
+    modules = getattr(sd_model, 'sd_swap_modules', None)
+    if modules is None:
         return False
-    del state_dict
-    timer.record("apply")
-    if shared.opts.sd_checkpoint_cache > 0:
-        # cache newly loaded model
-        checkpoints_loaded[checkpoint_info] = model.state_dict().copy()
-    if shared.opts.opt_channelslast:
-        model.to(memory_format=torch.channels_last)
-        timer.record("channels")
+    current = dict(getattr(sd_model, 'sd_swap_hashes', {}))
+    if sd_vae.loaded_vae_file is not None: # first stage holds external vae weights so it does not match any checkpoint
+        current.pop('first_stage_model', None)
+    signature = sd_models_delta.delta_signature(checkpoint_info, state_dict)
+    keys = sd_models_delta.transfer_keys(sd_model, checkpoint_info, state_dict)
+    if keys is not None: # sibling of loaded model so only tensors that differ are copied
+        state_dict = { k: state_dict[k] for k in keys }
+        fingerprints, skip = {}, []
+    else:
+        fingerprints = state_dict_fingerprints(state_dict, checkpoint_info.filename)
+        skip = [k for k, v in fingerprints.items() if current.get(k, None) == v and weights_unchanged(modules, state_dict, k)]
+    timer.record("fingerprint")
+    checkpoints_loaded.detach(sd_model.sd_checkpoint_info, sd_model) # cached entry may reference live weights that are about to be overwritten
+    load_state_dict_streaming(sd_model, state_dict, modules=[(name, module) for name, module in modules.items() if name.split('.')[0] not in skip])
+    timer.record("swap")
+    sd_model.sd_model_hash = checkpoint_info.calculate_shorthash()
+    sd_model.sd_model_checkpoint = checkpoint_info.filename
+    sd_model.sd_checkpoint_info = checkpoint_info
+    sd_model.sd_swap_hashes = fingerprints
+    sd_model.sd_delta = signature
+    shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
+    shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
+    timer.record("hash")
+    if 'first_stage_model' not in skip or sd_vae.loaded_vae_file is not None:
+        sd_vae.delete_base_vae()
+        sd_vae.clear_loaded_vae()
+        vae_file, vae_source = sd_vae.resolve_vae(checkpoint_info.filename)
+        sd_vae.load_vae(sd_model, vae_file, vae_source)
+        timer.record("vae")
+    shared.log.debug(f'Model hot swap: skipped={skip} updated={[k for k in fingerprints.keys() if k not in skip]}')
+    return True
+
+
+def is_meta(model: torch.nn.Module):
+    return any(p.is_meta for p in model.parameters())
+
+
+def initialize_missing(module: torch.nn.Module, keys, prefix):
+    """initialize tensors missing in checkpoint by resetting uninitialized copy of module so that assigned tensors are not overwritten"""
+    def empty(v):
+        if v is None:
+            return None
+        tensor = torch.empty_like(v, device=devices.cpu)
+        return torch.nn.Parameter(tensor, requires_grad=v.requires_grad) if isinstance(v, torch.nn.Parameter) else tensor
+
+    shadow = copy.copy(module)
+    shadow._parameters = { k: empty(v) for k, v in module._parameters.items() } # pylint: disable=protected-access
+    shadow._buffers = { k: empty(v) for k, v in module._buffers.items() } # pylint: disable=protected-access
+    shadow._modules = {} # pylint: disable=protected-access
+    reset = getattr(shadow, 'reset_parameters', None) or getattr(shadow, '_reset_parameters', None)
+    if reset is None:
+        raise RuntimeError(f'Model weights missing in checkpoint and module cannot initialize them: {[prefix + k for k in keys]}')
+    reset()
+    for k in keys:
+        target = module._parameters if k in module._parameters else module._buffers # pylint: disable=protected-access
+        source = shadow._parameters if k in shadow._parameters else shadow._buffers # pylint: disable=protected-access
+        target[k].copy_(source[k])
+
+
+def load_state_dict_assign(model: torch.nn.Module, state_dict):
+    """materialize model constructed on meta device by assigning checkpoint tensors as its parameters and buffers
+    tensors are cast only if dtype differs and missing entries are allocated and initialized by module reset after load"""
+    missing = []
+    with torch.no_grad():
+        for name, module in model.named_modules():
+            prefix = f'{name}.' if len(name) > 0 else ''
+            uninitialized = []
+            for collection in [module._parameters, module._buffers]: # pylint: disable=protected-access
+                for k, v in collection.items():
+                    if v is None:
+                        continue
+                    key = prefix + k
+                    persistent = collection is module._parameters or k not in module._non_persistent_buffers_set # pylint: disable=protected-access
+                    if key in state_dict and persistent:
+                        tensor = state_dict[key]
+                        if tensor.shape != v.shape:
+                            raise RuntimeError(f'size mismatch for {key}: checkpoint={tuple(tensor.shape)} model={tuple(v.shape)}')
+                        if tensor.dtype != v.dtype: # e.g. position_ids stored as float in checkpoint but int64 in model
+                            tensor = tensor.to(dtype=v.dtype)
+                    elif v.is_meta:
+                        tensor = torch.empty_like(v, device=devices.cpu)
+                        missing.append(key)
+                        uninitialized.append(k)
+                    else:
+                        continue
+                    collection[k] = torch.nn.Parameter(tensor, requires_grad=v.requires_grad) if isinstance(v, torch.nn.Parameter) else tensor
+            if len(uninitialized) > 0:
+                initialize_missing(module, uninitialized, prefix)
+    if len(missing) > 0:
+        shared.log.debug(f'Model weights missing in checkpoint: initialized={len(missing)} {missing[:5]}')
+
+
+def set_model_dtype(model: torch.nn.Module):
     if not shared.opts.no_half:
         vae = model.first_stage_model
         depth_model = getattr(model, 'depth_model', None)
@@ -471,9 +719,55 @@ def load_model_weights(model: torch.nn.Module, checkpoint_info: CheckpointInfo,
     else:
         model.model.diffusion_model.to(devices.dtype_unet)
     model.first_stage_model.to(devices.dtype_vae)
+
+
+def load_model_weights(model: torch.nn.Module, checkpoint_info: CheckpointInfo, state_dict, timer):
+    _pipeline, _model_type = detect_pipeline(checkpoint_info.path, 'model')
+    shared.log.debug(f'Model weights loading: {memory_stats()}')
+    timer.record("hash")
+    if model_data.sd_dict == 'None':
+        shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
+    if state_dict is None:
+        state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
+    signature = sd_models_delta.delta_signature(checkpoint_info, state_dict)
+    keys = sd_models_delta.transfer_keys(model, checkpoint_info, state_dict)
+    if keys is not None: # model holds sibling derived from same base so only tensors that differ are copied
+        shared.log.debug(f'Model weights loading: delta tensors={len(keys)}')
+        state_dict = { k: state_dict[k] for k in keys }
+        model.sd_swap_hashes = {}
+    elif shared.opts.sd_hot_swap:
+        model.sd_swap_hashes = state_dict_fingerprints(state_dict, checkpoint_info.filename)
+        timer.record("fingerprint")
+    if getattr(model, 'sd_checkpoint_info', None) is not None:
+        checkpoints_loaded.detach(model.sd_checkpoint_info, model) # cached entry may reference live weights that are about to be overwritten
+    try:
+        if is_meta(model):
+            set_model_dtype(model) # cast on meta device is free so that tensors are cast once while being assigned
+            timer.record("dtype")
+            load_state_dict_assign(model, state_dict)
+        elif isinstance(state_dict, (LazyStateDict, sd_models_delta.DeltaStateDict)):
+            set_model_dtype(model) # cast model first so that each tensor is cast while being copied
+            timer.record("dtype")
+            load_state_dict_streaming(model, state_dict)
+        else:
+            model.load_state_dict(state_dict, strict=False)
+    except Exception as e:
+        shared.log.error(f'Error loading model weights: {checkpoint_info.filename}')
+        shared.log.error(' '.join(str(e).splitlines()[:2]))
+        return False
+    del state_dict
+    timer.record("apply")
+    if checkpoints_loaded.enabled():
+        # cache newly loaded model
+        checkpoints_loaded.put(checkpoint_info, model.state_dict())
+    if shared.opts.opt_channelslast:
+        model.to(memory_format=torch.channels_last)
+        timer.record("channels")
+    set_model_dtype(model)
+    model.sd_delta = signature
+    model.sd_swap_modules = { k: v for k, v in model.named_modules() if k != '' } # unhijacked module names match checkpoint keys, root is excluded to avoid reference cycle
     # clean up cache if limit is reached
-    while len(checkpoints_loaded) > shared.opts.sd_checkpoint_cache:
-        checkpoints_loaded.popitem(last=False)
+    checkpoints_loaded.trim()
     model.sd_model_hash = checkpoint_info.calculate_shorthash()
     model.sd_model_checkpoint = checkpoint_info.filename
     model.sd_checkpoint_info = checkpoint_info
@@ -613,6 +907,7 @@ def detect_pipeline(f: str, op: str = 'model'):
     if guess == 'Autodetect':
         try:
             size = round(os.path.getsize(f) / 1024 / 1024 / 1024, 2)
+            sniffed = sniff_model_type(f) # tensor names are authoritative, size is still used for warnings
             if size < 1:
                 shared.log.warning(f'Model size smaller than expected: {f} size={size} GB')
             elif size < 5.5: # maximum size of sd1.5 fp32 unpruned is 5.3GB
@@ -627,10 +922,14 @@ def detect_pipeline(f: str, op: str = 'model'):
                 if shared.backend == shared.Backend.ORIGINAL:
                     shared.log.warning(f'Model detected as SD-XL base model, but attempting to load using backend=original: {f} size={size} GB')
                 guess = 'Stable Diffusion XL'
-            else:
+            elif sniffed is None:
                 guess = 'Unknown'
                 shared.log.error(f'Model autodetect failed, set diffuser pipeline manually: {f}')
                 return None, None
+            if sniffed is not None and sniffed != guess:
+                if sniffed == 'Stable Diffusion XL' and shared.backend == shared.Backend.ORIGINAL:
+                    shared.log.warning(f'Model detected as SD-XL model, but attempting to load using backend=original: {f} size={size} GB')
+                guess = sniffed
             shared.log.debug(f'Model autodetect {op}: {f} pipeline={guess} size={size} GB')
         except Exception as e:
             shared.log.error(f'Error detecting diffusers pipeline: model={f} {e}')
@@ -1059,7 +1358,8 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None, timer=None,
         try:
             clip_is_included_into_sd = sd1_clip_weight in state_dict or sd2_clip_weight in state_dict
             with sd_disable_initialization.DisableInitialization(disable_clip=clip_is_included_into_sd):
-                sd_model = instantiate_from_config(sd_config.model)
+                with sd_disable_initialization.InitializeOnMeta(enabled=clip_is_included_into_sd and shared.opts.sd_meta_init):
+                    sd_model = instantiate_from_config(sd_config.model)
         except Exception:
             sd_model = instantiate_from_config(sd_config.model)
     for line in stdout.getvalue().splitlines():
@@ -1102,7 +1402,7 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None, timer=None,
     shared.log.info(f"Model loaded in {timer.summary()}")
     current_checkpoint_info = None
     devices.torch_gc(force=True)
-    shared.log.info(f'Model load finished: {memory_stats()} cached={len(checkpoints_loaded.keys())}')
+    shared.log.info(f'Model load finished: {memory_stats()} cached={len(checkpoints_loaded)}')
 
 
 def reload_model_weights(sd_model=None, info=None, reuse_dict=False, op='model'):
@@ -1120,12 +1420,26 @@ def reload_model_weights(sd_model=None, info=None, reuse_dict=False, op='model')
         shared.log.debug(f'Load model weights: existing={sd_model is not None} target={checkpoint_info.filename} info={info}')
     if sd_model is None:
         sd_model = model_data.sd_model if op == 'model' or op == 'dict' else model_data.sd_refiner
+    timer = Timer()
+    state_dict = None
+    checkpoint_config = None
     if sd_model is None:  # previous model load failed
         current_checkpoint_info = None
     else:
         current_checkpoint_info = getattr(sd_model, 'sd_checkpoint_info', None)
         if current_checkpoint_info is not None and checkpoint_info is not None and current_checkpoint_info.filename == checkpoint_info.filename:
             return
+        if shared.opts.sd_hot_swap and shared.backend == shared.Backend.ORIGINAL and not load_dict and getattr(sd_model, 'sd_swap_modules', None) is not None:
+            state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
+            checkpoint_config = sd_models_config.find_checkpoint_config(state_dict, checkpoint_info)
+            timer.record("config")
+            if checkpoint_config == sd_model.used_config:
+                try:
+                    if hot_swap_weights(sd_model, checkpoint_info, state_dict, timer):
+                        shared.log.info(f"Weights swapped in {timer.summary()}")
+                        return
+                except Exception as e:
+                    shared.log.error(f'Model hot swap failed, using full reload: {checkpoint_info.filename} {e}')
         if not getattr(sd_model, 'has_accelerate', False):
             if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
                 lowvram.send_everything_to_cpu()
@@ -1137,10 +1451,10 @@ def reload_model_weights(sd_model=None, info=None, reuse_dict=False, op='model')
         else:
             unload_model_weights(op=op)
             sd_model = None
-    timer = Timer()
-    state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
-    checkpoint_config = sd_models_config.find_checkpoint_config(state_dict, checkpoint_info)
-    timer.record("config")
+    if state_dict is None:
+        state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
+        checkpoint_config = sd_models_config.find_checkpoint_config(state_dict, checkpoint_info)
+        timer.record("config")
     if sd_model is None or checkpoint_config != sd_model.used_config:
         sd_model = None
         if shared.backend == shared.Backend.ORIGINAL:
@@ -0,0 +1,264 @@
+import os
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import psutil
+import torch
+from modules import shared
+
+
+def state_dict_size(state_dict):
+    return sum(v.numel() * v.element_size() for v in state_dict.values() if isinstance(v, torch.Tensor))
+
+
+class CheckpointCache:
+    """RAM cache of checkpoint state dicts bounded by entry count and byte budget
+    cached tensors are detached references to loaded weights so reuse is copied in-place by load_state_dict without new allocations"""
+    def __init__(self):
+        self.entries = collections.OrderedDict() # checkpoint_info -> state_dict
+        self.sizes = {}
+        self.costs = {} # time it took to read entry from disk, used by cost-based eviction
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, checkpoint_info):
+        return checkpoint_info in self.entries
+
+    def __getitem__(self, checkpoint_info):
+        return self.entries[checkpoint_info]
+
+    def __setitem__(self, checkpoint_info, state_dict):
+        self.put(checkpoint_info, state_dict)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def enabled(self):
+        return shared.opts.sd_checkpoint_cache > 0
+
+    def budget(self):
+        budget = []
+        if shared.opts.data.get('sd_checkpoint_cache_size', 0) > 0:
+            budget.append(shared.opts.sd_checkpoint_cache_size * 1024 * 1024)
+        if shared.opts.data.get('sd_checkpoint_cache_percent', 0) > 0:
+            budget.append(psutil.virtual_memory().total * shared.opts.sd_checkpoint_cache_percent / 100)
+        return min(budget) if len(budget) > 0 else float('inf')
+
+    def used(self):
+        return sum(self.sizes.values())
+
+    def get(self, checkpoint_info):
+        if not self.enabled() or self.budget() == 0: # disabled cache does not count misses
+            return None
+        with self.lock:
+            state_dict = self.entries.get(checkpoint_info, None)
+            if state_dict is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(checkpoint_info)
+        return state_dict
+
+    def record_cost(self, checkpoint_info, cost):
+        with self.lock:
+            self.costs[checkpoint_info] = cost
+
+    def put(self, checkpoint_info, state_dict):
+        if not self.enabled() or state_dict is None:
+            return
+        size = state_dict_size(state_dict)
+        if size > self.budget():
+            shared.log.debug(f'Model cache: skip name={checkpoint_info.name} size={size // 1024 // 1024}MB budget={self.budget() // 1024 // 1024}MB')
+            return
+        pin = shared.opts.data.get('sd_checkpoint_cache_pin', False) and torch.cuda.is_available()
+        cached = {}
+        for k, v in state_dict.items():
+            if isinstance(v, torch.Tensor):
+                v = v.detach()
+                if pin and v.device.type == 'cpu' and not v.is_pinned():
+                    v = v.pin_memory()
+            cached[k] = v
+        with self.lock:
+            cost = self.costs.get(checkpoint_info, 0)
+            self.pop(checkpoint_info)
+            self.entries[checkpoint_info] = cached
+            self.sizes[checkpoint_info] = size
+            self.costs[checkpoint_info] = cost
+            self.trim(keep=checkpoint_info)
+
+    def detach(self, checkpoint_info, model):
+        """replace cached tensors that alias live weights of model with cpu copies so entry survives weights being overwritten in-place"""
+        with self.lock:
+            state_dict = self.entries.get(checkpoint_info, None)
+            if state_dict is None:
+                return
+            live = set(t.untyped_storage().data_ptr() for t in list(model.parameters()) + list(model.buffers()) if not t.is_meta)
+            pin = shared.opts.data.get('sd_checkpoint_cache_pin', False) and torch.cuda.is_available()
+            copied = 0
+            for k, v in state_dict.items():
+                if isinstance(v, torch.Tensor) and not v.is_meta and v.untyped_storage().data_ptr() in live:
+                    v = v.to(device='cpu', copy=True)
+                    state_dict[k] = v.pin_memory() if pin else v
+                    copied += 1
+            if copied > 0:
+                shared.log.debug(f'Model cache: detach name={checkpoint_info.name} tensors={copied}')
+
+    def pop(self, checkpoint_info):
+        with self.lock:
+            self.sizes.pop(checkpoint_info, None)
+            self.costs.pop(checkpoint_info, None)
+            return self.entries.pop(checkpoint_info, None)
+
+    def trim(self, keep=None):
+        """evict entries until both count and byte budget are satisfied"""
+        with self.lock:
+            budget = self.budget()
+            while len(self.entries) > 0 and (len(self.entries) > shared.opts.sd_checkpoint_cache or self.used() > budget):
+                candidates = [k for k in self.entries.keys() if k != keep]
+                if len(candidates) == 0:
+                    break
+                if shared.opts.data.get('sd_checkpoint_cache_policy', 'LRU') == 'cost':
+                    victim = min(candidates, key=lambda k: self.costs.get(k, 0) / max(1, self.sizes.get(k, 1))) # cheapest to reload per byte goes first
+                else:
+                    victim = candidates[0]
+                shared.log.debug(f'Model cache: evict name={victim.name} size={self.sizes.get(victim, 0) // 1024 // 1024}MB')
+                self.pop(victim)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.costs.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'enabled': self.enabled() and self.budget() > 0,
+                'entries': len(self.entries),
+                'used': self.used(),
+                'budget': self.budget() if self.budget() != float('inf') else None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 3) if total > 0 else 0,
+            }
+
+
+
+class CheckpointPrefetcher:
+    """speculatively reads state dict of checkpoint that is expected to be needed next while current one is still in use"""
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.RLock()
+        self.pending = {} # checkpoint_info -> future
+        self.ready = collections.OrderedDict() # checkpoint_info -> state_dict
+        self.failed = set() # checkpoint_info of prefetches that failed and were not taken yet
+        self.requested = 0
+        self.hits = 0
+        self.misses = 0
+        self.wasted = 0
+
+    def enabled(self):
+        return shared.opts.data.get('sd_checkpoint_prefetch', False) and shared.backend == shared.Backend.ORIGINAL
+
+    def prefetch(self, checkpoint_info):
+        from modules import sd_models
+        if checkpoint_info is None or not self.enabled():
+            return
+        current = getattr(sd_models.model_data.sd_model, 'sd_checkpoint_info', None)
+        if current is not None and current.filename == checkpoint_info.filename:
+            return
+        with self.lock:
+            if checkpoint_info in self.pending or checkpoint_info in self.ready or checkpoint_info in sd_models.checkpoints_loaded:
+                return
+            try:
+                size = os.path.getsize(checkpoint_info.filename)
+            except OSError:
+                return
+            budget = sd_models.checkpoints_loaded.budget()
+            used = sum(state_dict_size(sd) for sd in self.ready.values())
+            if size > budget or size > psutil.virtual_memory().available:
+                shared.log.debug(f'Model prefetch: skip name={checkpoint_info.name} size={size // 1024 // 1024}MB')
+                return
+            while len(self.ready) > 0 and used + size > budget: # drop oldest unused prefetch
+                _info, sd = self.ready.popitem(last=False)
+                used -= state_dict_size(sd)
+                self.wasted += 1
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+            self.requested += 1
+            self.pending[checkpoint_info] = self.executor.submit(self.worker, checkpoint_info)
+        shared.log.debug(f'Model prefetch: queued name={checkpoint_info.name}')
+
+    def worker(self, checkpoint_info):
+        from modules import sd_models
+        t0 = time.time()
+        state_dict = None
+        try:
+            state_dict = sd_models.read_state_dict(checkpoint_info.filename)
+        except Exception as e:
+            shared.log.error(f'Model prefetch: failed name={checkpoint_info.name} {e}')
+            with self.lock:
+                self.failed.add(checkpoint_info)
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(checkpoint_info, None)
+                if state_dict is not None:
+                    self.ready[checkpoint_info] = state_dict
+                    sd_models.checkpoints_loaded.record_cost(checkpoint_info, time.time() - t0)
+        shared.log.debug(f'Model prefetch: ready name={checkpoint_info.name} time={time.time()-t0:.2f}s')
+        return state_dict
+
+    def take(self, checkpoint_info):
+        """returns prefetched state dict waiting for in-flight read if needed"""
+        with self.lock:
+            future = self.pending.get(checkpoint_info, None)
+            state_dict = self.ready.pop(checkpoint_info, None)
+            requested = future is not None or state_dict is not None or checkpoint_info in self.failed
+        if state_dict is None and future is not None:
+            try:
+                future.result()
+            except Exception: # failed prefetch is a miss, caller reads checkpoint itself
+                pass
+            with self.lock:
+                state_dict = self.ready.pop(checkpoint_info, None)
+        with self.lock:
+            self.failed.discard(checkpoint_info)
+            if state_dict is not None:
+                self.hits += 1
+            elif requested: # loads of checkpoints that were never prefetched are not misses
+                self.misses += 1
+        return state_dict
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'requested': self.requested,
+                'pending': len(self.pending),
+                'ready': len(self.ready),
+                'hits': self.hits,
+                'misses': self.misses,
+                'wasted': self.wasted,
+                'hit_rate': round(self.hits / total, 3) if total > 0 else 0,
+            }
+
+
+prefetcher = CheckpointPrefetcher()
+
+
+def prefetch_override(override_settings):
+    """hint prefetcher with checkpoint requested by override settings of a queued job"""
+    if not prefetcher.enabled() or not override_settings or override_settings.get('sd_model_checkpoint', None) is None:
+        return
+    from modules import sd_models
+    prefetcher.prefetch(sd_models.get_closet_checkpoint_match(override_settings['sd_model_checkpoint']))
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import collections.abc
+import torch
+import safetensors.torch
+from modules import shared
+
+
+suffix_up = '.delta_up'
+suffix_down = '.delta_down'
+
+
+class DeltaStateDict(collections.abc.Mapping):
+    """state dict of delta checkpoint resolved against its base checkpoint
+    tensors present in delta override base, everything else is served from base state dict without copying"""
+    def __init__(self, base, delta, base_sha256, removed=()):
+        self.base = base
+        self.delta = delta
+        self.base_sha256 = base_sha256
+        self.removed = set(removed)
+        self.delta_keys = frozenset(delta.keys())
+
+    def __getitem__(self, key):
+        if key in self.removed:
+            raise KeyError(key)
+        if key in self.delta:
+            return self.delta[key]
+        return self.base[key]
+
+    def __contains__(self, key):
+        return key not in self.removed and (key in self.delta or key in self.base)
+
+    def __iter__(self):
+        for k in self.base:
+            if k not in self.removed:
+                yield k
+        for k in self.delta:
+            if k not in self.base:
+                yield k
+
+    def __len__(self):
+        return len(set(self.base.keys()).union(self.delta.keys()) - self.removed)
+
+
+def find_base(base_sha256, base_name=None):
+    from modules import sd_models
+    info = sd_models.checkpoint_aliases.get(base_sha256, None)
+    if info is not None:
+        return info
+    info = next((ckpt for ckpt in sd_models.checkpoints_list.values() if ckpt.sha256 == base_sha256), None)
+    if info is not None:
+        return info
+    if base_name is not None:
+        info = sd_models.get_closet_checkpoint_match(base_name)
+        if info is not None and info.calculate_shorthash() is not None and info.sha256 == base_sha256:
+            return info
+    return None
+
+
+def base_state_dict(base_info, cached=True):
+    from modules import sd_models
+    state_dict = sd_models.checkpoints_loaded.get(base_info) if cached else None
+    if state_dict is not None:
+        return state_dict
+    if base_info.filename.lower().endswith('.safetensors') and getattr(base_info, 'delta_base', None) is None:
+        return sd_models.LazyStateDict(base_info.filename) # only tensors that are actually used are read
+    return sd_models.read_state_dict(base_info.filename)
+
+
+def read_delta(filename, metadata):
+    """load delta checkpoint and resolve it against its base, returns None if base cannot be found"""
+    from modules import sd_models
+    t0 = time.time()
+    info = json.loads(metadata.get('sd_delta', '{}'))
+    base_sha256 = metadata['sd_delta_base']
+    base_info = find_base(base_sha256, info.get('base_name', None))
+    if base_info is None:
+        shared.log.error(f'Delta checkpoint base not found: {filename} base={info.get("base_name", None)} sha256={base_sha256}')
+        return None
+    base = base_state_dict(base_info)
+    if base is None:
+        return None
+    raw = safetensors.torch.load_file(filename, device='cpu')
+    delta = {}
+    lowrank = set(info.get('lowrank', []))
+    for k, v in raw.items():
+        if k.endswith(suffix_up) or k.endswith(suffix_down):
+            continue
+        delta[sd_models.transform_checkpoint_dict_key(k)] = v
+    for k in lowrank:
+        up, down = raw[k + suffix_up], raw[k + suffix_down]
+        key = sd_models.transform_checkpoint_dict_key(k) # same key transform as exact delta tensors
+        tensor = base[key]
+        delta[key] = (tensor.float() + (up.float() @ down.float()).reshape(tensor.shape)).to(up.dtype)
+    del raw
+    shared.log.debug(f'Model delta: file={filename} base={base_info.name} tensors={len(delta)} lowrank={len(lowrank)} time={time.time()-t0:.2f}s')
+    return DeltaStateDict(base, delta, base_sha256, info.get('removed', []))
+
+
+def delta_signature(checkpoint_info, state_dict):
+    """returns (base sha256, keys that differ from base) or None if unknown"""
+    if isinstance(state_dict, DeltaStateDict):
+        return state_dict.base_sha256, state_dict.delta_keys
+    if checkpoint_info is not None and getattr(checkpoint_info, 'sha256', None) is not None:
+        return checkpoint_info.sha256, frozenset()
+    return None
+
+
+def transfer_keys(model, checkpoint_info, state_dict):
+    """when model holds a sibling of target checkpoint derived from same base only keys that differ in either of them need to be copied"""
+    from modules import sd_vae
+    current = getattr(model, 'sd_delta', None)
+    target = delta_signature(checkpoint_info, state_dict)
+    if current is None or target is None or current[0] != target[0]:
+        return None
+    if len(current[1]) == 0 and len(target[1]) == 0:
+        return None
+    keys = set(current[1]).union(target[1])
+    if sd_vae.loaded_vae_file is not None: # first stage holds external vae weights that need to be reset
+        keys.update(k for k in state_dict.keys() if k.startswith('first_stage_model.'))
+    return [k for k in keys if k in state_dict]
+
+
+def lowrank_approximation(diff, reference_norm, max_error):
+    """returns (up, down) such that up @ down approximates diff within relative error or None if it does not save space"""
+    matrix = diff.reshape(diff.shape[0], -1)
+    m, n = matrix.shape
+    if min(m, n) < 16:
+        return None
+    u, s, vh = torch.linalg.svd(matrix, full_matrices=False) # pylint: disable=not-callable
+    residual = torch.cumsum((s ** 2).flip(0), 0).flip(0).sqrt() # residual[r] is error of rank r approximation
+    allowed = max_error * reference_norm
+    rank = next((r for r in range(1, len(s)) if residual[r] <= allowed), None)
+    if rank is None or rank * (m + n) >= m * n // 2:
+        return None
+    return (u[:, :rank] * s[:rank]).contiguous(), vh[:rank].contiguous()
+
+
+def create_delta(state_dict, base, base_info, lowrank=False, max_error=0.01):
+    """returns (tensors, metadata) that store only tensors of state_dict that differ from base"""
+    tensors = {}
+    lowrank_keys = []
+    for k, v in state_dict.items():
+        if k in base and base[k].shape == v.shape and torch.equal(base[k].to(v.dtype), v):
+            continue
+        if lowrank and k in base and base[k].shape == v.shape and v.is_floating_point() and v.ndim >= 2:
+            b = base[k].float()
+            res = lowrank_approximation(v.float() - b, torch.linalg.norm(v.float()).item(), max_error) # pylint: disable=not-callable
+            if res is not None:
+                tensors[k + suffix_up] = res[0].to(v.dtype)
+                tensors[k + suffix_down] = res[1].to(v.dtype)
+                lowrank_keys.append(k)
+                continue
+        tensors[k] = v.contiguous()
+    removed = [k for k in base.keys() if k not in state_dict]
+    metadata = {
+        'sd_delta_base': base_info.sha256,
+        'sd_delta': json.dumps({ 'base_name': base_info.name, 'lowrank': lowrank_keys, 'removed': removed, 'max_error': max_error if lowrank else 0 }),
+    }
+    return tensors, metadata
+
+
+def save_delta(filename, state_dict, base_info, lowrank=False, max_error=0.01, metadata=None):
+    if base_info.calculate_shorthash() is None:
+        raise RuntimeError(f'Delta checkpoint requires hash of base model: {base_info.filename}')
+    t0 = time.time()
+    base = base_state_dict(base_info, cached=False)
+    tensors, delta_metadata = create_delta(state_dict, base, base_info, lowrank=lowrank, max_error=max_error)
+    del base
+    metadata = { **(metadata or { 'format': 'pt' }), **delta_metadata }
+    safetensors.torch.save_file(tensors, filename, metadata=metadata)
+    shared.log.info(f'Model delta saved: {filename} base={base_info.name} tensors={len(tensors)} of={len(state_dict)} size={os.path.getsize(filename) // 1024 // 1024}MB time={time.time()-t0:.2f}s')
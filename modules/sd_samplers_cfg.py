@@ -0,0 +1,50 @@
+import torch
+
+
+class CFGPlan:
+    """composable classifier-free guidance layout of a batch compiled into tensors
+    conds_list[i] lists (index into denoised output, weight) of every AND-term of image i
+    inputs are expanded with single repeat_interleave and all terms are combined with single matrix product"""
+    def __init__(self, conds_list, device):
+        self.device = device
+        self.batch_size = len(conds_list)
+        self.repeats = [len(conds) for conds in conds_list]
+        self.total = sum(self.repeats)
+        self.single = all(n == 1 for n in self.repeats)
+        self.repeats_tensor = torch.tensor(self.repeats, dtype=torch.long, device=device)
+        self.first = torch.tensor([conds[0][0] for conds in conds_list], dtype=torch.long, device=device) # output index of first term of each image
+        rows = max(index for conds in conds_list for index, _weight in conds) + 1
+        weights = torch.zeros((self.batch_size, rows), dtype=torch.float32)
+        for i, conds in enumerate(conds_list):
+            for index, weight in conds:
+                weights[i, index] += weight
+        self.weights = weights.to(device)
+        self.weights_sum = weights.sum(dim=1).to(device)
+
+    def expand(self, x):
+        """repeat each image once per its AND-term"""
+        if self.single:
+            return x
+        return x.repeat_interleave(self.repeats_tensor, dim=0, output_size=self.total)
+
+    def combine(self, x_out, uncond_count, cond_scale):
+        """denoised[i] = uncond[i] + cond_scale * sum(weight * (x_out[index] - uncond[i])) for all terms of image i"""
+        denoised_uncond = x_out[-uncond_count:]
+        conds = x_out[:self.weights.shape[1]].flatten(1)
+        weights = self.weights.to(x_out.dtype)
+        shape = (-1, ) + (1, ) * (denoised_uncond.ndim - 1)
+        weighted = torch.mm(weights, conds).view_as(denoised_uncond) - self.weights_sum.to(x_out.dtype).view(shape) * denoised_uncond
+        return denoised_uncond + cond_scale * weighted
+
+
+plans = {} # id -> (conds_list, plan), conds_list is same object for every step of a job so plan is built once
+
+
+def get_plan(conds_list, device):
+    entry = plans.get(id(conds_list), None)
+    if entry is not None and entry[0] is conds_list and entry[1].device == device:
+        return entry[1]
+    plan = CFGPlan(conds_list, device)
+    plans.clear()
+    plans[id(conds_list)] = (conds_list, plan)
+    return plan
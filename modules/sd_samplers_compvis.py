@@ -6,7 +6,7 @@ import numpy as np
 import torch
 
 from modules.shared import state
-from modules import sd_samplers_common, prompt_parser, shared
+from modules import sd_samplers_common, sd_samplers_cfg, prompt_parser, shared
 import modules.models.diffusion.uni_pc
 
 
@@ -85,7 +85,8 @@ class VanillaStableDiffusionSampler:
         conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
         unconditional_conditioning = prompt_parser.reconstruct_cond_batch(unconditional_conditioning, self.step)
 
-        assert all(len(conds) == 1 for conds in conds_list), 'composition via AND is not supported for DDIM/PLMS samplers'
+        plan = sd_samplers_cfg.get_plan(conds_list, tensor.device)
+        assert plan.single, 'composition via AND is not supported for DDIM/PLMS/UniPC samplers'
         cond = tensor
 
         # for DDIM, shapes must match, we can't just process cond and uncond independently;
@@ -0,0 +1,89 @@
+import torch
+from modules import shared, devices
+
+
+decoder_channels = 128 # channels of full-resolution decoder blocks
+activation_factor = 8 # number of full-resolution activations alive at peak during decode
+memory_reserve = 0.8 # fraction of free memory decode is allowed to use
+
+
+def is_oom(e: Exception):
+    oom = getattr(torch.cuda, 'OutOfMemoryError', None)
+    if oom is not None and isinstance(e, oom):
+        return True
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e).lower()
+
+
+def free_memory():
+    """free device memory in bytes including memory cached by torch allocator, None if unknown"""
+    if devices.device is None or devices.device.type == 'cpu':
+        return None
+    try:
+        free, _total = torch.cuda.mem_get_info()
+        if devices.device.type == 'cuda':
+            free += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+        return free
+    except Exception:
+        return None
+
+
+def image_memory(shape, dtype=None):
+    """estimated peak memory in bytes needed to decode single latent of given shape"""
+    dtype = dtype or devices.dtype_vae
+    element = torch.tensor([], dtype=dtype).element_size()
+    pixels = shape[-2] * 8 * shape[-1] * 8
+    return pixels * decoder_channels * element * activation_factor
+
+
+def chunk_size(latents: torch.Tensor, dtype=None):
+    """number of latents decoded at once, uses fixed value from settings or derives it from free device memory"""
+    total = latents.shape[0]
+    if shared.opts.sd_vae_batch_size > 0:
+        return max(1, min(total, shared.opts.sd_vae_batch_size))
+    if shared.cmd_opts.lowvram:
+        return 1
+    free = free_memory()
+    if free is None:
+        return total
+    return max(1, min(total, int(free * memory_reserve) // max(1, image_memory(latents.shape, dtype))))
+
+
+def decode(decode_fn, latents: torch.Tensor, rollback=None, nan_check=True, output_device=devices.cpu):
+    """decode latents in chunks sized by available memory
+    chunk is halved and retried on out-of-memory
+    each chunk is checked for nans and after successful rollback only the affected chunk is decoded again
+    decode_fn receives latents chunk and returns decoded images, rollback returns False if it cannot recover"""
+    if latents.shape[0] == 0:
+        return latents
+    size = chunk_size(latents)
+    decoded = []
+    rolled_back = False
+    i = 0
+    while i < latents.shape[0]:
+        chunk = latents[i:i+size]
+        try:
+            x = decode_fn(chunk)
+        except Exception as e:
+            if not is_oom(e) or size == 1:
+                raise
+            size = max(1, size // 2)
+            shared.log.warning(f'VAE decode out of memory: retry batch={size}')
+            devices.torch_gc(force=True)
+            continue
+        if nan_check:
+            try:
+                for sample in x:
+                    devices.test_for_nans(sample, "vae")
+            except devices.NansException:
+                if rolled_back or rollback is None or not rollback():
+                    raise
+                rolled_back = True
+                shared.log.warning(f'VAE decode produced NaN values: rollback dtype={devices.dtype_vae} images={i}:{i+len(chunk)}')
+                continue
+        decoded.append(x.to(output_device) if output_device is not None else x)
+        i += len(chunk)
+    if len(decoded) > 1 or size < latents.shape[0]:
+        shared.log.debug(f'VAE decode: images={latents.shape[0]} batch={size} chunks={len(decoded)}')
+    if output_device is None and len(set(x.device for x in decoded)) > 1: # tiled chunks are returned on cpu
+        decoded = [x.to(devices.cpu) for x in decoded]
+    return torch.cat(decoded) if len(decoded) > 1 else decoded[0]
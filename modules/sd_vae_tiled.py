@@ -0,0 +1,147 @@
+"""
+tiled vae encode/decode for both backends
+input is split into overlapping tiles which are processed one at a time and blended with linear ramps over the overlap
+groupnorm statistics are recorded once on a downscaled copy of the whole input and reused for every tile,
+so all tiles are normalized identically instead of each tile using its own local statistics which causes visible seams
+peak memory is bounded by tile size, output is accumulated and returned on cpu so callers move it to device only when needed
+compared to untiled decode mean absolute difference is expected to stay below `tolerance` in [-1, 1] output range,
+largest differences are along tile seams since vae mid-block attention only sees the current tile
+use cli/vae-tiled-verify.py to measure the difference for a given vae and tile size
+"""
+import torch
+from modules import shared, devices, sd_vae_batch
+
+
+tolerance = 0.01
+
+
+class GroupNormStats:
+    """replaces forward of all groupnorm layers of a module so that statistics can be recorded and then reused"""
+    def __init__(self, module):
+        self.layers = [m for m in module.modules() if isinstance(m, torch.nn.GroupNorm)]
+        self.stats = {}
+        self.recording = False
+
+    def forward(self, layer, x):
+        n = x.shape[0]
+        groups = x.float().reshape(n, layer.num_groups, -1)
+        if self.recording or id(layer) not in self.stats:
+            var, mean = torch.var_mean(groups, dim=2, unbiased=False)
+            if self.recording:
+                self.stats[id(layer)] = (mean, var)
+        else:
+            mean, var = self.stats[id(layer)]
+            mean, var = mean[:n].to(x.device), var[:n].to(x.device)
+        x_norm = ((groups - mean[..., None]) / torch.sqrt(var[..., None] + layer.eps)).reshape(x.shape).to(x.dtype)
+        if layer.affine:
+            shape = (1, -1) + (1, ) * (x.ndim - 2)
+            x_norm = x_norm * layer.weight.reshape(shape) + layer.bias.reshape(shape)
+        return x_norm
+
+    def record(self, fn, x, tile):
+        """run fn over input downscaled to fit single tile and keep statistics of every layer"""
+        h, w = x.shape[-2:]
+        scale = min(1.0, tile / max(h, w))
+        small = torch.nn.functional.interpolate(x, size=(max(1, round(h * scale)), max(1, round(w * scale))), mode='area') if scale < 1 else x
+        self.recording = True
+        try:
+            fn(small)
+        finally:
+            self.recording = False
+
+    def __enter__(self):
+        for layer in self.layers:
+            layer.forward = lambda x, layer=layer: self.forward(layer, x)
+        return self
+
+    def __exit__(self, *args):
+        for layer in self.layers:
+            del layer.forward
+        self.stats.clear()
+
+
+def tile_starts(size, tile, overlap):
+    if size <= tile:
+        return [0]
+    step = max(1, tile - overlap)
+    starts = list(range(0, size - tile + 1, step))
+    if starts[-1] != size - tile:
+        starts.append(size - tile)
+    return starts
+
+
+def ramp(length, overlap, first, last):
+    """blend weights along one axis, edges shared with neighbour tiles fade in or out over overlap"""
+    weights = torch.ones(length)
+    overlap = min(overlap, length // 2)
+    if overlap > 0:
+        fade = (torch.arange(overlap) + 0.5) / overlap
+        if not first:
+            weights[:overlap] = fade
+        if not last:
+            weights[-overlap:] = fade.flip(0)
+    return weights
+
+
+def run(fn, x, module, tile, overlap):
+    """apply fn to overlapping tiles of x and blend results, fn may change resolution by constant factor"""
+    h, w = x.shape[-2:]
+    ys, xs = tile_starts(h, tile, overlap), tile_starts(w, tile, overlap)
+    output = weights = None
+    with GroupNormStats(module) as stats:
+        stats.record(fn, x, tile)
+        for y in ys:
+            for x0 in xs:
+                res = fn(x[..., y:y+tile, x0:x0+tile]).float().cpu()
+                scale = res.shape[-1] / min(tile, w - x0)
+                if output is None:
+                    output = torch.zeros((res.shape[0], res.shape[1], round(h * scale), round(w * scale)))
+                    weights = torch.zeros((1, 1, output.shape[2], output.shape[3]))
+                oy, ox = round(y * scale), round(x0 * scale)
+                oh, ow = res.shape[-2], res.shape[-1]
+                mask = ramp(oh, round(overlap * scale), y == ys[0], y == ys[-1])[:, None] * ramp(ow, round(overlap * scale), x0 == xs[0], x0 == xs[-1])[None, :]
+                output[..., oy:oy+oh, ox:ox+ow] += res * mask
+                weights[..., oy:oy+oh, ox:ox+ow] += mask
+                del res
+    shared.log.debug(f'VAE tiled: input={list(x.shape)} output={list(output.shape)} tiles={len(ys) * len(xs)} tile={tile} overlap={overlap} groupnorm={len(stats.layers)}')
+    return output / weights
+
+
+def enabled(x: torch.Tensor, latent=True):
+    """tiling is used when forced in settings, above pixel threshold or when full pass is not expected to fit free memory"""
+    mode = shared.opts.sd_vae_tiled
+    if mode == 'Never':
+        return False
+    if mode == 'Always':
+        return True
+    shape = tuple(x.shape[-2:]) if latent else (x.shape[-2] // 8, x.shape[-1] // 8)
+    if shape[0] * 8 * shape[1] * 8 >= shared.opts.sd_vae_tiled_threshold * 1024 * 1024:
+        return True
+    free = sd_vae_batch.free_memory() # checked per sample since batches that do not fit are split into chunks instead
+    return free is not None and sd_vae_batch.image_memory(shape) > free * sd_vae_batch.memory_reserve
+
+
+def latent_tile():
+    return max(16, shared.opts.sd_vae_tile_size // 8)
+
+
+def decode(decode_fn, latents: torch.Tensor, module):
+    """decode latents tile by tile, module is vae decoder whose groupnorm layers are synchronized"""
+    tile = latent_tile()
+    return run(decode_fn, latents, module, tile, tile // 4).to(dtype=latents.dtype)
+
+
+def encode(encode_fn, images: torch.Tensor, module):
+    """encode images tile by tile, encode_fn must return moments so that tiles can be blended before sampling"""
+    tile = latent_tile() * 8
+    return run(encode_fn, images, module, tile, tile // 4).to(dtype=images.dtype)
+
+
+def verify(fn, x, module, tiled_fn=decode):
+    """compare tiled and untiled result, returns mean and max absolute difference"""
+    with devices.inference_context():
+        reference = fn(x).float().cpu()
+        result = tiled_fn(fn, x, module).float().cpu()
+    diff = (reference - result).abs()
+    shared.log.info(f'VAE tiled verify: mean={diff.mean().item():.4f} max={diff.max().item():.4f} tolerance={tolerance}')
+    return diff.mean().item(), diff.max().item()
@@ -380,13 +380,25 @@ options_templates.update(options_section(('sd', "Execution & Models"), {
     "sd_vae": OptionInfo("Automatic", "VAE model", gr.Dropdown, lambda: {"choices": shared_items.sd_vae_items()}, refresh=shared_items.refresh_vae_list),
     "sd_model_dict": OptionInfo('None', "Use baseline data from a different model", gr.Dropdown, lambda: {"choices": ['None'] + list_checkpoint_tiles()}, refresh=refresh_checkpoints),
     "stream_load": OptionInfo(False, "Load models using stream loading method"),
+    "sd_stream_weights": OptionInfo(False, "Load safetensors models tensor-by-tensor directly into model"),
+    "sd_meta_init": OptionInfo(False, "Construct model on meta device and assign weights from checkpoint"),
+    "sd_hot_swap": OptionInfo(False, "Swap weights in-place when switching between models with same config"),
     "model_reuse_dict": OptionInfo(False, "When loading models attempt to reuse previous model dictionary", gr.Checkbox, {"visible": False}),
     "prompt_attention": OptionInfo("Full parser", "Prompt attention parser", gr.Radio, lambda: {"choices": ["Full parser", "Compel parser", "A1111 parser", "Fixed attention"] }),
     "prompt_mean_norm": OptionInfo(True, "Prompt attention mean normalization"),
     "comma_padding_backtrack": OptionInfo(20, "Prompt padding for long prompts", gr.Slider, {"minimum": 0, "maximum": 74, "step": 1 }),
+    "prompt_cache_size": OptionInfo(256, "Encoded prompt cache size in MB of system memory (0=disabled)", gr.Slider, {"minimum": 0, "maximum": 4096, "step": 16}),
     "sd_checkpoint_cache": OptionInfo(0, "Number of cached models", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    "sd_checkpoint_cache_size": OptionInfo(0, "Maximum size of cached models in MB (0=unlimited)", gr.Number),
+    "sd_checkpoint_cache_percent": OptionInfo(50, "Maximum size of cached models as percentage of system RAM", gr.Slider, {"minimum": 0, "maximum": 100, "step": 1}),
+    "sd_checkpoint_cache_policy": OptionInfo("LRU", "Cached models eviction policy", gr.Radio, lambda: {"choices": ["LRU", "cost"]}),
+    "sd_checkpoint_cache_pin": OptionInfo(False, "Use pinned memory for cached models"),
+    "sd_checkpoint_prefetch": OptionInfo(False, "Prefetch next model for queued and XYZ grid jobs"),
     "sd_vae_checkpoint_cache": OptionInfo(0, "Number of cached VAEs", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
     "sd_disable_ckpt": OptionInfo(False, "Disallow usage of models in ckpt format"),
+    "sd_cache_backend": OptionInfo("sqlite", "Model hash and metadata cache backend", gr.Radio, lambda: {"choices": ["sqlite", "json"]}),
+    "sd_hash_background": OptionInfo(True, "Calculate model hashes in background"),
+    "sd_hash_readers": OptionInfo(1, "Concurrent hash readers per storage device", gr.Slider, {"minimum": 1, "maximum": 8, "step": 1}),
 }))
 
 options_templates.update(options_section(('optimizations', "Optimizations"), {
@@ -402,6 +414,16 @@ options_templates.update(options_section(('optimizations', "Optimizations"), {
     "token_merging_ratio_hr": OptionInfo(0.0, "Token merging ratio for hires pass", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}),
     "inference_mode": OptionInfo("no-grad", "Torch inference mode", gr.Radio, lambda: {"choices": ["no-grad", "inference-mode", "none"]}),
     "sd_vae_sliced_encode": OptionInfo(False, "VAE Slicing (original)"),
+    "sd_vae_batch_size": OptionInfo(0, "VAE decode batch size (0=auto from free memory)", gr.Slider, {"minimum": 0, "maximum": 32, "step": 1}),
+    "sd_vae_tiled": OptionInfo("Auto", "Tiled VAE encode/decode", gr.Radio, lambda: {"choices": ["Auto", "Always", "Never"]}),
+    "sd_vae_tiled_threshold": OptionInfo(4.0, "Tiled VAE auto threshold in megapixels", gr.Slider, {"minimum": 0.5, "maximum": 64.0, "step": 0.5}),
+    "sd_vae_tile_size": OptionInfo(1024, "Tiled VAE tile size in pixels", gr.Slider, {"minimum": 256, "maximum": 4096, "step": 64}),
+    "processing_pipeline": OptionInfo(False, "Postprocess and save images while next batch is processing"),
+    "api_coalesce": OptionInfo(False, "Merge compatible concurrent API txt2img requests into single batch"),
+    "api_coalesce_window": OptionInfo(50, "API request coalescing window in ms", gr.Slider, {"minimum": 0, "maximum": 1000, "step": 10}),
+    "api_coalesce_max_batch": OptionInfo(8, "API request coalescing maximum batch size", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
+    "api_jobs_ttl": OptionInfo(3600, "API async job results retention in seconds", gr.Slider, {"minimum": 60, "maximum": 86400, "step": 60}),
+    "api_jobs_limit": OptionInfo(100, "API async job results maximum count", gr.Slider, {"minimum": 1, "maximum": 1000, "step": 1}),
 }))
 
 options_templates.update(options_section(('cuda', "Compute Settings"), {
@@ -480,11 +502,17 @@ options_templates.update(options_section(('saving-images', "Image Options"), {
     "webp_lossless": OptionInfo(False, "Use lossless compression for webp images"),
     "save_selected_only": OptionInfo(True, "When using 'Save' button, only save a single selected image"),
     "samples_save_zip": OptionInfo(True, "Create zip archive when downloading multiple images"),
+    "save_workers": OptionInfo(2, "Background image save workers (0=save in generation thread)", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}),
+    "save_queue_size": OptionInfo(8, "Maximum images waiting to be saved before generation is paused", gr.Slider, {"minimum": 0, "maximum": 64, "step": 1}),
+    "image_profile_samples": OptionInfo("default", "Encoding profile for saved images", gr.Radio, {"choices": ["default", "fastest", "balanced", "smallest"]}),
+    "image_profile_grids": OptionInfo("default", "Encoding profile for saved grids", gr.Radio, {"choices": ["default", "fastest", "balanced", "smallest"]}),
+    "image_profile_api": OptionInfo("default", "Encoding profile for API responses", gr.Radio, {"choices": ["default", "fastest", "balanced", "smallest"]}),
+    "image_encode_workers": OptionInfo(0 if sys.platform == 'win32' else 2, "Image encoder processes (0=encode in calling thread)", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}),
 
     "image_sep_metadata": OptionInfo("<h2>Metadata/Logging</h2>", "", gr.HTML),
     "image_metadata": OptionInfo(True, "Include metadata in saved images"),
     "save_txt": OptionInfo(False, "Create text file next to every image with generation parameters"),
-    "save_log_fn": OptionInfo("", "Create JSON log file for each saved image", component_args=hide_dirs),
+    "save_log_fn": OptionInfo("", "Append entry to generation log file for each saved image", component_args=hide_dirs),
     "image_watermark_enabled": OptionInfo(False, "Include watermark in saved images"),
     "image_watermark": OptionInfo('', "Image watermark string"),
     "image_sep_grid": OptionInfo("<h2>Grid Options</h2>", "", gr.HTML),
@@ -557,6 +585,7 @@ options_templates.update(options_section(('live-preview', "Live Previews"), {
     "show_progress_type": OptionInfo("Approximate NN", "Live preview method", gr.Radio, {"choices": ["Full VAE", "Approximate NN", "Approximate simple", "TAESD"]}),
     "live_preview_content": OptionInfo("Combined", "Live preview subject", gr.Radio, {"choices": ["Combined", "Prompt", "Negative prompt"], "visible": False}),
     "live_preview_refresh_period": OptionInfo(500, "Progress update period", gr.Slider, {"minimum": 0, "maximum": 5000, "step": 25}),
+    "stream_preview_period": OptionInfo(1000, "Streaming API live preview period", gr.Slider, {"minimum": 100, "maximum": 10000, "step": 100}),
     "logmonitor_show": OptionInfo(True, "Show log view"),
     "logmonitor_refresh_period": OptionInfo(5000, "Log view update period", gr.Slider, {"minimum": 0, "maximum": 30000, "step": 25}),
 }))
@@ -0,0 +1,143 @@
+import io
+import json
+import time
+import base64
+import asyncio
+import threading
+from modules import shared
+from modules.progress import current_progress
+
+
+queue_size = 32 # frames buffered per subscriber, oldest frames are dropped for slow clients
+keepalive = 15
+
+
+class Frame:
+    """single server-sent event, serialized once and shared by all subscribers"""
+    def __init__(self, event, data, job=None):
+        self.event = event
+        self.job = job
+        self.data = f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+
+class Subscriber:
+    def __init__(self, loop, job=None):
+        self.loop = loop
+        self.job = job
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def put(self, frame):
+        if self.job is not None and frame.job is not None and frame.job != self.job:
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(frame)
+
+
+def encode_image(image, fmt='jpeg', quality=None):
+    buffered = io.BytesIO()
+    image.save(buffered, format=fmt, quality=quality or shared.opts.jpeg_quality)
+    return f'data:image/{fmt};base64,{base64.b64encode(buffered.getvalue()).decode("ascii")}'
+
+
+def running_job():
+    from modules.scheduler import scheduler
+    job = scheduler.running
+    return job.id if job is not None else None
+
+
+class Broadcaster:
+    """pushes generation progress, throttled previews and finished images to streaming clients
+    single monitor thread samples shared state while there are subscribers so cost does not grow with number of clients"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.thread = None
+        self.last_progress = None
+        self.last_preview = 0
+        self.id_live_preview = -1
+        self.job = ''
+
+    def active(self):
+        return len(self.subscribers) > 0
+
+    def subscribe(self, job=None):
+        subscriber = Subscriber(asyncio.get_running_loop(), job)
+        with self.lock:
+            self.subscribers.append(subscriber)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.monitor, name='stream-monitor', daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def publish(self, event, data, job=None):
+        if not self.active():
+            return
+        frame = Frame(event, data, job or running_job())
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.put, frame)
+            except RuntimeError: # event loop of disconnected client is closed
+                self.unsubscribe(subscriber)
+
+    def publish_image(self, image, index, seed=None, info=None):
+        """called for every finished image as soon as it is postprocessed"""
+        if not self.active():
+            return
+        try:
+            self.publish('image', { 'index': index, 'seed': seed, 'info': info, 'image': encode_image(image.convert('RGB') if image.mode not in ['RGB', 'L'] else image, fmt='png') })
+        except Exception as e:
+            shared.log.error(f'Stream: image publish failed: {e}')
+
+    def monitor(self):
+        while self.active():
+            interval = max(shared.opts.live_preview_refresh_period, 50) / 1000
+            state = shared.state
+            if state.job != self.job:
+                if self.job != '' and state.job == '':
+                    self.publish('end', { 'job': self.job })
+                elif state.job != '':
+                    self.publish('begin', { 'job': state.job, 'timestamp': state.job_timestamp })
+                self.job = state.job
+            if state.job != '':
+                current = (state.job_no, state.job_count, state.sampling_step, state.sampling_steps)
+                if current != self.last_progress:
+                    self.last_progress = current
+                    progress, eta = current_progress()
+                    self.publish('progress', { 'job': state.job, 'job_no': state.job_no, 'job_count': state.job_count, 'step': state.sampling_step, 'steps': state.sampling_steps, 'progress': round(progress, 4), 'eta': eta, 'textinfo': state.textinfo })
+                if shared.opts.live_previews_enable and time.time() - self.last_preview >= shared.opts.stream_preview_period / 1000:
+                    state.set_current_image()
+                    if state.current_image is not None and state.id_live_preview != self.id_live_preview:
+                        self.id_live_preview = state.id_live_preview
+                        self.last_preview = time.time()
+                        try:
+                            self.publish('preview', { 'id_live_preview': state.id_live_preview, 'step': state.sampling_step, 'image': encode_image(state.current_image) })
+                        except Exception as e:
+                            shared.log.error(f'Stream: preview publish failed: {e}')
+            time.sleep(interval)
+
+
+async def events(request, job=None):
+    """async generator of serialized events for single client until it disconnects"""
+    subscriber = broadcaster.subscribe(job)
+    try:
+        while True:
+            try:
+                frame = await asyncio.wait_for(subscriber.queue.get(), timeout=keepalive)
+                yield frame.data
+            except asyncio.TimeoutError:
+                yield b': keepalive\n\n'
+            if await request.is_disconnected():
+                break
+    finally:
+        broadcaster.unsubscribe(subscriber)
+
+
+broadcaster = Broadcaster()
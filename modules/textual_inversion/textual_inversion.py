@@ -96,6 +96,7 @@ class EmbeddingDatabase:
         self.embedding_dirs = {}
         self.previously_displayed_embeddings = ()
         self.embeddings_used = []
+        self.version = 0 # incremented whenever set of registered embeddings changes
 
     def add_embedding_dir(self, path):
         self.embedding_dirs[path] = DirWithTextualInversionEmbeddings(path)
@@ -104,6 +105,7 @@ class EmbeddingDatabase:
         self.embedding_dirs.clear()
 
     def register_embedding(self, embedding, model):
+        self.version += 1
         self.word_embeddings[embedding.name] = embedding
         ids = model.cond_stage_model.tokenize([embedding.name])[0]
         first_id = ids[0]
@@ -243,6 +245,7 @@ class EmbeddingDatabase:
                     break
             if not need_reload:
                 return
+        self.version += 1
         self.ids_lookup.clear()
         self.word_embeddings.clear()
         self.skipped_embeddings.clear()
@@ -1076,6 +1076,24 @@ def create_ui(startup_timer = None):
                 loadsave.create_ui()
                 create_dirty_indicator("tab_defaults", [], interactive=False)
 
+            with gr.TabItem("History", id="system_history", elem_id="system_tab_history"):
+                with gr.Row():
+                    history_since = gr.Textbox(label="Since", placeholder="YYYY-MM-DD", elem_id="history_since")
+                    history_until = gr.Textbox(label="Until", placeholder="YYYY-MM-DD", elem_id="history_until")
+                    history_model = gr.Textbox(label="Model", placeholder="name or hash", elem_id="history_model")
+                    history_seed = gr.Number(label="Seed", value=-1, precision=0, elem_id="history_seed")
+                    history_limit = gr.Number(label="Limit", value=100, precision=0, elem_id="history_limit")
+                    history_search = gr.Button(value="Search", variant="primary", elem_id="history_search")
+                history_headers = ['id', 'time', 'filename', 'model', 'seed', 'info']
+                history_results = gr.Dataframe(headers=history_headers, interactive=False, wrap=True, elem_id="history_results")
+
+                def query_history(since, until, model, seed, limit):
+                    from modules.generation_log import log
+                    entries = log.query(since=since or None, until=until or None, model=model or None, seed=int(seed) if seed is not None and seed >= 0 else None, limit=int(limit or 0))
+                    return [[entry.get(k, None) for k in history_headers] for entry in entries]
+
+                history_search.click(fn=query_history, inputs=[history_since, history_until, history_model, history_seed, history_limit], outputs=[history_results])
+
             with gr.TabItem("Change log", id="change_log", elem_id="system_tab_changelog"):
                 with open('CHANGELOG.md', 'r', encoding='utf-8') as f:
                     md = f.read()
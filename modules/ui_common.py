@@ -137,6 +137,7 @@ def save_files(js_data, images, html_info, index):
                 filenames.append(os.path.basename(txt_fullfn))
                 fullfns.append(txt_fullfn)
             modules.script_callbacks.image_save_btn_callback(filename)
+    modules.images.saver.flush() # files are served to browser so they must exist
     if shared.opts.samples_save_zip and len(fullfns) > 1:
         zip_filepath = os.path.join(shared.opts.outdir_save, "images.zip")
         from zipfile import ZipFile
@@ -95,6 +95,9 @@ def create_ui():
                             discard_weights = gr.Textbox(value="", label="Discard weights with matching name")
                         with FormRow():
                             save_metadata = gr.Checkbox(value=True, label="Save metadata")
+                        with FormRow():
+                            delta_format = gr.Radio(choices=["None", "Exact", "Low-rank"], value="None", label="Save as delta from primary model")
+                            delta_error = gr.Slider(minimum=0.0, maximum=0.1, step=0.001, value=0.01, label="Low-rank max relative error")
                         with gr.Row():
                             modelmerger_merge = gr.Button(value="Merge", variant='primary')
 
@@ -124,6 +127,8 @@ def create_ui():
                         bake_in_vae,
                         discard_weights,
                         save_metadata,
+                        delta_format,
+                        delta_error,
                     ],
                     outputs=[
                         primary_model_name,
@@ -1,5 +1,6 @@
 import os
 import tempfile
+from concurrent.futures import wait
 from collections import namedtuple
 from pathlib import Path
 import gradio as gr
@@ -44,6 +45,12 @@ def pil_to_temp_file(self, img, dir: str, format="png") -> str: # pylint: disabl
     filename = str(temp_dir / f"image.{format}")
     img.save(filename, pnginfo=gr.processing_utils.get_pil_metadata(img))
     """
+    saving_as = getattr(img, 'saving_as', None)
+    if saving_as is not None and getattr(img, 'already_saved_as', None) is None:
+        from modules import images
+        future = images.saver.future(saving_as)
+        if future is not None: # wait for pending background save instead of encoding image again
+            wait([future])
     already_saved_as = getattr(img, 'already_saved_as', None)
     if already_saved_as and os.path.isfile(already_saved_as):
         register_tmp_file(shared.demo, already_saved_as)
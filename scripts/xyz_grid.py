@@ -12,7 +12,7 @@ import numpy as np
 import gradio as gr
 import modules.scripts as scripts
 import modules.shared as shared
-from modules import images, sd_samplers, processing, sd_models, sd_vae
+from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_models_cache
 from modules.processing import process_images, Processed, StableDiffusionProcessingTxt2Img
 from modules.ui_components import ToolButton
 import modules.ui_symbols as symbols
@@ -69,8 +69,16 @@ def confirm_samplers(p, xs):
             shared.log.warning(f"XYZ grid: unknown sampler: {x}")
 
 
+def prefetch_next_checkpoint(x, xs):
+    if len(xs) < 2 or x not in xs:
+        return
+    next_x = xs[(xs.index(x) + 1) % len(xs)] # checkpoint axis may be repeated if its not the outermost axis
+    sd_models_cache.prefetcher.prefetch(sd_models.get_closet_checkpoint_match(next_x))
+
+
 def apply_checkpoint(p, x, xs):
     if x == shared.opts.sd_model_checkpoint:
+        prefetch_next_checkpoint(x, xs)
         return
     info = sd_models.get_closet_checkpoint_match(x)
     if info is None:
@@ -78,6 +86,7 @@ def apply_checkpoint(p, x, xs):
     else:
         sd_models.reload_model_weights(shared.sd_model, info)
         p.override_settings['sd_model_checkpoint'] = info.name
+        prefetch_next_checkpoint(x, xs)
 
 
 def apply_dict(p, x, xs):
@@ -0,0 +1,41 @@
+import os
+import sys
+import json
+import types
+import logging
+import tempfile
+
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, root)
+
+
+class State:
+    def __init__(self):
+        self.interrupted = False
+
+    def interrupt(self):
+        self.interrupted = True
+
+
+def readfile(filename, silent=False): # pylint: disable=unused-argument
+    with open(filename, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def writefile(data, filename, mode='w', silent=False): # pylint: disable=unused-argument
+    with open(filename, mode, encoding='utf8') as f:
+        json.dump(data, f)
+
+
+def install(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+# unit tests cover pure logic modules so shared and paths are replaced with minimal versions instead of full server initialization
+import modules # pylint: disable=wrong-import-position
+modules.shared = install('modules.shared', log=logging.getLogger('sd'), opts=types.SimpleNamespace(data={}), state=State(), readfile=readfile, writefile=writefile)
+modules.paths = install('modules.paths', data_path=tempfile.mkdtemp(prefix='sdnext-test-'))
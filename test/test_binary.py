@@ -0,0 +1,65 @@
+import json
+import email
+import email.policy
+import pytest
+
+
+pytest.importorskip('fastapi')
+Image = pytest.importorskip('PIL.Image')
+from pydantic import BaseModel # pylint: disable=wrong-import-position,wrong-import-order
+from fastapi.exceptions import HTTPException # pylint: disable=wrong-import-position,wrong-import-order
+from modules.api import binary # pylint: disable=wrong-import-position
+
+
+def parse_multipart(response):
+    """parse response body with stdlib mime parser so that framing is checked independently of how it was written"""
+    message = email.message_from_bytes(f'Content-Type: {response.media_type}\r\n\r\n'.encode('ascii') + response.body, policy=email.policy.HTTP)
+    assert message.is_multipart()
+    return list(message.iter_parts())
+
+
+def test_mime():
+    assert binary.mime('jpg') == 'image/jpeg'
+    assert binary.mime('.JPEG') == 'image/jpeg'
+    assert binary.mime('png') == 'image/png'
+    assert binary.mime('webp') == 'image/webp'
+
+
+def test_multipart_parts():
+    images = [b'\x89PNG\r\n\x1a\n first', b'--not a boundary\r\n second']
+    response = binary.multipart({ 'seed': 1, 'prompt': 'test' }, images, 'png')
+    assert response.media_type.startswith('multipart/mixed; boundary=')
+    parts = parse_multipart(response)
+    assert len(parts) == 3
+    assert parts[0].get_content_type() == 'application/json'
+    assert parts[0].get_filename() == 'info.json'
+    assert json.loads(parts[0].get_payload(decode=True)) == { 'seed': 1, 'prompt': 'test' }
+    for i, data in enumerate(images):
+        assert parts[i + 1].get_content_type() == 'image/png'
+        assert parts[i + 1].get_filename() == f'{i:05}.png'
+        assert parts[i + 1]['Content-Length'] == str(len(data))
+        assert parts[i + 1].get_payload(decode=True) == data
+
+
+def test_multipart_without_images():
+    parts = parse_multipart(binary.multipart({}, [], 'jpg'))
+    assert len(parts) == 1
+
+
+def test_upload_name():
+    image = Image.new('RGB', (8, 8))
+    image.upload_name = 'init.png'
+    assert binary.upload_name(image) == 'init.png'
+    assert binary.upload_name([image, 'base64']) == ['init.png', 'base64']
+    assert binary.upload_name(Image.new('RGB', (8, 8))) == ''
+    assert binary.upload_name(None) is None
+
+
+def test_parse_reports_validation_errors():
+    class Request(BaseModel):
+        steps: int
+
+    assert binary.parse(Request, { 'steps': 20 }).steps == 20
+    with pytest.raises(HTTPException) as e:
+        binary.parse(Request, { 'steps': 'many' })
+    assert e.value.status_code == 422
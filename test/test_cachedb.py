@@ -0,0 +1,68 @@
+import os
+import json
+import sqlite3
+from modules import cachedb
+
+
+def store_at(tmp_path):
+    return cachedb.SQLiteStore(str(tmp_path / 'cache.db'))
+
+
+def test_pending_entries_are_visible_before_commit(tmp_path):
+    store = store_at(tmp_path)
+    store.set('hashes', 'a', { 'sha256': '1234' })
+    assert store.get('hashes', 'a') == { 'sha256': '1234' }
+    assert store.section('hashes') == { 'a': { 'sha256': '1234' } }
+    assert sqlite3.connect(store.filename).execute('SELECT COUNT(*) FROM entries').fetchone()[0] == 0
+
+
+def test_commit_persists_entries(tmp_path):
+    store = store_at(tmp_path)
+    store.set('hashes', 'a', 1)
+    store.set('hashes', 'b', 2)
+    store.set('hashes', 'a', 3)
+    store.commit()
+    assert len(store.pending) == 0
+    reopened = store_at(tmp_path)
+    assert reopened.section('hashes') == { 'a': 3, 'b': 2 }
+
+
+def test_commit_after_batch_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(cachedb, 'commit_every', 3)
+    store = store_at(tmp_path)
+    for i in range(3):
+        store.set('hashes', str(i), i)
+    assert len(store.pending) == 0
+    assert store_at(tmp_path).get('hashes', '2') == 2
+
+
+def test_entry_is_invalidated_when_file_changes(tmp_path):
+    fn = tmp_path / 'model.safetensors'
+    fn.write_bytes(b'a')
+    store = store_at(tmp_path)
+    store.set('hashes', 'model', 'abc', filename=str(fn))
+    store.commit()
+    assert store.get('hashes', 'model', filename=str(fn)) == 'abc'
+    fn.write_bytes(b'changed')
+    assert store.get('hashes', 'model', filename=str(fn)) is None
+    os.remove(fn)
+    assert store.get('hashes', 'model', filename=str(fn)) is None
+
+
+def test_import_json_runs_once(tmp_path):
+    legacy = tmp_path / 'cache.json'
+    legacy.write_text(json.dumps({ 'hashes': { 'a': { 'mtime': 1, 'sha256': 'x' } } }), encoding='utf8')
+    store = store_at(tmp_path)
+    store.import_json(str(legacy))
+    assert store.get('hashes', 'a') == { 'mtime': 1, 'sha256': 'x' }
+    legacy.write_text(json.dumps({ 'hashes': { 'b': { 'sha256': 'y' } } }), encoding='utf8')
+    store_at(tmp_path).import_json(str(legacy))
+    assert store_at(tmp_path).get('hashes', 'b') is None
+
+
+def test_import_json_flat(tmp_path):
+    legacy = tmp_path / 'metadata.json'
+    legacy.write_text(json.dumps({ 'model': { 'title': 'x' } }), encoding='utf8')
+    store = store_at(tmp_path)
+    store.import_json(str(legacy), flat='metadata')
+    assert store.get('metadata', 'model') == { 'title': 'x' }
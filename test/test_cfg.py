@@ -0,0 +1,59 @@
+import pytest
+
+
+torch = pytest.importorskip('torch')
+from modules.sd_samplers_cfg import CFGPlan, get_plan # pylint: disable=wrong-import-position
+
+
+def conds_layout(weights):
+    """weights per image, each image gets consecutive output indices for its AND-terms"""
+    conds_list = []
+    index = 0
+    for terms in weights:
+        conds_list.append([(index + j, w) for j, w in enumerate(terms)])
+        index += len(terms)
+    return conds_list
+
+
+def loop_expand(x, conds_list):
+    return torch.cat([torch.stack([x[i] for _ in range(len(conds))]) for i, conds in enumerate(conds_list)])
+
+
+def loop_combine(x_out, conds_list, cond_scale):
+    denoised_uncond = x_out[-len(conds_list):]
+    denoised = torch.clone(denoised_uncond)
+    for i, conds in enumerate(conds_list):
+        for cond_index, weight in conds:
+            denoised[i] += (x_out[cond_index] - denoised_uncond[i]) * (weight * cond_scale)
+    return denoised
+
+
+@pytest.mark.parametrize('weights', [
+    [[1.0]],
+    [[1.0], [1.0], [1.0]],
+    [[0.5, 0.5], [1.0], [0.2, 0.3, 0.5]],
+    [[1.0, -0.5], [0.7, 0.7]],
+])
+def test_plan_matches_loops(weights):
+    torch.manual_seed(0)
+    conds_list = conds_layout(weights)
+    x = torch.randn((len(conds_list), 4, 8, 8))
+    terms = sum(len(w) for w in weights)
+    x_out = torch.randn((terms + len(conds_list), 4, 8, 8))
+    plan = CFGPlan(conds_list, x.device)
+    assert torch.equal(plan.expand(x), loop_expand(x, conds_list))
+    assert torch.allclose(plan.combine(x_out, len(conds_list), 7.0), loop_combine(x_out, conds_list, 7.0), atol=1e-5)
+
+
+def test_shared_cond_index():
+    conds_list = [[(0, 1.0)], [(0, 1.0)]] # same prompt for both images is encoded once
+    x_out = torch.randn((3, 4, 8, 8))
+    plan = CFGPlan(conds_list, x_out.device)
+    assert torch.allclose(plan.combine(x_out, 2, 5.0), loop_combine(x_out, conds_list, 5.0), atol=1e-5)
+
+
+def test_plan_is_reused_for_same_layout():
+    conds_list = conds_layout([[1.0], [0.5, 0.5]])
+    plan = get_plan(conds_list, torch.device('cpu'))
+    assert get_plan(conds_list, torch.device('cpu')) is plan
+    assert get_plan(conds_layout([[1.0], [0.5, 0.5]]), torch.device('cpu')) is not plan
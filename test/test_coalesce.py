@@ -0,0 +1,136 @@
+import sys
+import json
+import time
+import types
+import threading
+import pytest
+from modules import shared
+from modules.api import coalesce
+from modules.scheduler import JobCancelled, current_job_id
+
+
+@pytest.fixture(autouse=True)
+def setup(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'modules.processing', types.SimpleNamespace(get_fixed_seed=lambda seed: 1000 if seed in [None, '', -1] else seed))
+    monkeypatch.setattr(shared.opts, 'sd_model_checkpoint', 'model', raising=False)
+    monkeypatch.setattr(shared.opts, 'api_coalesce', True, raising=False)
+    monkeypatch.setattr(shared.opts, 'api_coalesce_max_batch', 8, raising=False)
+    monkeypatch.setattr(shared.opts, 'api_coalesce_window', 2000, raising=False)
+
+
+class Processed:
+    def __init__(self, args):
+        self.images = [f'image-{p}-{s}' for p, s in zip(args['prompt'], args['seed'])]
+        self.index_of_first_image = 0
+        self.info = { 'all_prompts': args['prompt'], 'all_seeds': args['seed'], 'infotexts': [f'info {p}' for p in args['prompt']], 'prompt': args['prompt'][0] }
+
+    def js(self):
+        return json.dumps(self.info)
+
+
+def member(prompt, batch_size=1, seed=-1, subseed_strength=0, id_job=None):
+    token = current_job_id.set(id_job)
+    try:
+        return coalesce.Member({ 'prompt': prompt, 'negative_prompt': f'not {prompt}', 'seed': seed, 'subseed': 5, 'subseed_strength': subseed_strength, 'batch_size': batch_size, 'steps': 20 })
+    finally:
+        current_job_id.reset(token)
+
+
+def test_request_key_ignores_per_request_fields():
+    a = member('a', seed=1).args
+    b = member('b', seed=2, batch_size=3).args
+    assert coalesce.request_key(a) == coalesce.request_key(b)
+    assert coalesce.request_key(a) != coalesce.request_key({ **a, 'steps': 30 })
+
+
+def test_member_seeds():
+    assert member('a', batch_size=3, seed=10).seeds == [10, 11, 12]
+    assert member('a', batch_size=3, seed=10, subseed_strength=0.5).seeds == [10, 10, 10]
+    assert member('a', batch_size=2).subseeds == [5, 6]
+
+
+def test_merge_and_split():
+    members = [member('a', batch_size=2, seed=10), member('b', seed=20), member('c', batch_size=3, seed=30)]
+    args = coalesce.merge(members)
+    assert args['prompt'] == ['a', 'a', 'b', 'c', 'c', 'c']
+    assert args['negative_prompt'] == ['not a', 'not a', 'not b', 'not c', 'not c', 'not c']
+    assert args['seed'] == [10, 11, 20, 30, 31, 32]
+    assert args['batch_size'] == 6
+    assert args['n_iter'] == 1
+    coalesce.split(Processed(args), members)
+    images, info = members[2].result
+    info = json.loads(info)
+    assert images == ['image-c-30', 'image-c-31', 'image-c-32']
+    assert info['all_seeds'] == [30, 31, 32]
+    assert info['infotexts'] == ['info c', 'info c', 'info c']
+    assert info['prompt'] == 'c'
+    assert info['seed'] == 30
+    assert info['batch_size'] == 3
+    assert members[1].result[0] == ['image-b-20']
+
+
+def run_group(runs):
+    def run(members):
+        runs.append([m.args['prompt'] for m in members])
+        coalesce.split(Processed(coalesce.merge(members)), members)
+    return run
+
+
+def submit(coalescer, key, m, run, results):
+    try:
+        results[m.args['prompt']] = coalescer.submit(key, m, run)
+    except JobCancelled as e:
+        results[m.args['prompt']] = e
+
+
+def wait_for(condition, timeout=5):
+    t0 = time.time()
+    while not condition():
+        assert time.time() - t0 < timeout
+        time.sleep(0.01)
+
+
+def test_full_group_runs_once(monkeypatch):
+    monkeypatch.setattr(shared.opts, 'api_coalesce_max_batch', 3, raising=False)
+    coalescer = coalesce.Coalescer()
+    runs, results = [], {}
+    members = [member('a', seed=1), member('b', batch_size=2, seed=2)]
+    key = coalesce.request_key(members[0].args)
+    leader = threading.Thread(target=submit, args=(coalescer, key, members[0], run_group(runs), results))
+    leader.start()
+    wait_for(lambda: key in coalescer.groups)
+    submit(coalescer, key, members[1], run_group(runs), results)
+    leader.join()
+    assert runs == [['a', 'b']]
+    assert results['a'][0] == ['image-a-1']
+    assert results['b'][0] == ['image-b-2', 'image-b-3']
+    assert coalescer.stats()['coalesced'] == 2
+
+
+def test_cancel_waiting_member():
+    coalescer = coalesce.Coalescer()
+    runs, results = [], {}
+    members = [member('a', id_job='job-a'), member('b', id_job='job-b')]
+    key = coalesce.request_key(members[0].args)
+    threads = []
+    for m in members:
+        threads.append(threading.Thread(target=submit, args=(coalescer, key, m, run_group(runs), results)))
+        threads[-1].start()
+        wait_for(lambda m=m: key in coalescer.groups and m in coalescer.groups[key].members)
+    assert coalescer.cancel('job-b')
+    threads[1].join(timeout=1)
+    assert isinstance(results['b'], JobCancelled)
+    assert runs == [] # member is released without waiting for leader
+    threads[0].join()
+    assert runs == [['a']]
+    assert not coalescer.cancel('job-missing')
+
+
+def test_cancelled_member_is_rejected():
+    coalescer = coalesce.Coalescer()
+    m = member('a')
+    m.cancel = threading.Event()
+    m.cancel.set()
+    with pytest.raises(JobCancelled):
+        coalescer.submit('key', m, run_group([]))
+    assert coalescer.requests == 0
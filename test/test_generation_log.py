@@ -0,0 +1,86 @@
+import json
+import datetime
+import pytest
+from modules import shared, paths, generation_log
+
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    monkeypatch.setattr(paths, 'data_path', str(tmp_path))
+    monkeypatch.setattr(shared.opts, 'save_log_fn', 'log.json', raising=False)
+    instance = generation_log.GenerationLog()
+    yield instance
+    instance.close()
+
+
+def read_lines(fn):
+    with open(fn, 'r', encoding='utf8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_parse_entry():
+    assert generation_log.parse_entry('prompt\nSteps: 20, Seed: 42, Model hash: abcd1234, Model: sd15') == { 'seed': 42, 'model': 'sd15', 'model_hash': 'abcd1234' }
+    assert generation_log.parse_entry('') == { 'seed': None, 'model': None, 'model_hash': None }
+
+
+def test_log_filename(monkeypatch, tmp_path):
+    monkeypatch.setattr(paths, 'data_path', str(tmp_path))
+    monkeypatch.setattr(shared.opts, 'save_log_fn', 'log.json', raising=False)
+    assert generation_log.log_filename() == str(tmp_path / 'log.jsonl')
+    monkeypatch.setattr(shared.opts, 'save_log_fn', '', raising=False)
+    assert generation_log.log_filename() is None
+
+
+def test_append_assigns_ids(log, tmp_path):
+    log.append('a.png', 'Seed: 1, Model: one')
+    log.append('b.png', 'Seed: 2, Model: two')
+    log.close()
+    log.append('c.png', 'Seed: 3, Model: three') # reopen continues numbering
+    log.close()
+    entries = read_lines(tmp_path / 'log.jsonl')
+    assert [e['id'] for e in entries] == [0, 1, 2]
+    assert [e['seed'] for e in entries] == [1, 2, 3]
+
+
+def test_migrate_legacy_log(log, tmp_path):
+    legacy = [{ 'filename': 'a.png', 'time': '2023-09-18T10:00:00', 'info': 'Seed: 5, Model: old' }, { 'filename': 'b.png', 'time': '2023-09-19T10:00:00', 'info': 'Seed: 6' }]
+    (tmp_path / 'log.json').write_text(json.dumps(legacy), encoding='utf8')
+    log.append('c.png', 'Seed: 7')
+    log.close()
+    entries = read_lines(tmp_path / 'log.jsonl')
+    assert [e['filename'] for e in entries] == ['a.png', 'b.png', 'c.png']
+    assert [e['id'] for e in entries] == [0, 1, 2]
+    assert entries[0]['seed'] == 5
+    assert entries[0]['model'] == 'old'
+
+
+def test_query_filters(log, tmp_path):
+    legacy = [
+        { 'filename': 'a.png', 'time': '2023-09-18T10:00:00', 'info': 'Seed: 5, Model hash: aaaa, Model: sd15-base' },
+        { 'filename': 'b.png', 'time': '2023-09-19T10:00:00', 'info': 'Seed: 6, Model hash: bbbb, Model: sdxl' },
+        { 'filename': 'c.png', 'time': '2023-09-20T10:00:00', 'info': 'Seed: 5, Model hash: cccc, Model: sd15-other' },
+    ]
+    (tmp_path / 'log.json').write_text(json.dumps(legacy), encoding='utf8')
+    names = lambda entries: [e['filename'] for e in entries] # pylint: disable=unnecessary-lambda-assignment
+    assert names(log.query()) == ['c.png', 'b.png', 'a.png']
+    assert names(log.query(limit=2)) == ['c.png', 'b.png']
+    assert names(log.query(seed=5)) == ['c.png', 'a.png']
+    assert names(log.query(model='SD15')) == ['c.png', 'a.png']
+    assert names(log.query(model='bbbb')) == ['b.png']
+    assert names(log.query(since='2023-09-19')) == ['c.png', 'b.png']
+    assert names(log.query(until='2023-09-19')) == ['b.png', 'a.png'] # date only includes whole day
+    assert names(log.query(since='2023-09-19T10:00:00', until='2023-09-19T10:00:00')) == ['b.png']
+    timestamp = datetime.datetime(2023, 9, 19, 12).timestamp()
+    assert names(log.query(since=str(timestamp))) == ['c.png']
+    assert names(log.query(until=timestamp)) == ['b.png', 'a.png']
+    with pytest.raises(ValueError):
+        log.query(since='yesterday')
+
+
+def test_parse_time():
+    assert generation_log.parse_time('2023-09-19') == datetime.datetime(2023, 9, 19)
+    assert generation_log.parse_time('2023-09-19', end=True) == datetime.datetime(2023, 9, 19, 23, 59, 59, 999999)
+    assert generation_log.parse_time('2023-09-19 10:00:00') == datetime.datetime(2023, 9, 19, 10)
+    assert generation_log.parse_time('2023-09-19T10:00:00Z') == datetime.datetime(2023, 9, 19, 10, tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+    assert generation_log.parse_time('0') == datetime.datetime.fromtimestamp(0)
+    assert generation_log.parse_time(None) is None
@@ -0,0 +1,116 @@
+import time
+import threading
+import pytest
+from modules import shared
+from modules.scheduler import Scheduler, JobCancelled, INTERACTIVE, BATCH, current_cancel
+
+
+def wait_for(condition, timeout=5):
+    t0 = time.time()
+    while not condition():
+        assert time.time() - t0 < timeout
+        time.sleep(0.01)
+
+
+class Runner:
+    """queues jobs from separate threads while blocker job holds scheduler so that dispatch order can be checked"""
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.order = []
+        self.errors = {}
+        self.threads = []
+
+    def queue(self, name, priority=INTERACTIVE, client='local'):
+        def run():
+            try:
+                with self.scheduler.job(name, priority=priority, client=client, id_job=name):
+                    self.order.append(name)
+            except JobCancelled as e:
+                self.errors[name] = e
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+        wait_for(lambda: self.scheduler.get(name) is not None)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+
+def test_priority_and_round_robin_order():
+    scheduler = Scheduler()
+    runner = Runner(scheduler)
+    with scheduler.job('blocker', id_job='blocker'):
+        runner.queue('batch-a1', priority=BATCH, client='a')
+        runner.queue('a1', client='a')
+        runner.queue('a2', client='a')
+        runner.queue('b1', client='b')
+        runner.queue('a3', client='a')
+        assert scheduler.depth() == { 'interactive': 4, 'batch': 1 }
+        assert [scheduler.position(name) for name in ['a1', 'b1', 'a2', 'a3', 'batch-a1']] == [0, 1, 2, 3, 4]
+        assert scheduler.position('blocker') is None
+    runner.join()
+    assert runner.order == ['a1', 'b1', 'a2', 'a3', 'batch-a1']
+    assert scheduler.stats()['completed'] == 6
+
+
+def test_cancel_queued_job():
+    scheduler = Scheduler()
+    runner = Runner(scheduler)
+    with scheduler.job('blocker', id_job='blocker'):
+        runner.queue('a1')
+        runner.queue('a2')
+        assert scheduler.cancel('a1')
+        wait_for(lambda: 'a1' in runner.errors)
+        assert scheduler.get('a1').status == 'cancelled'
+        assert scheduler.position('a2') == 0
+    runner.join()
+    assert runner.order == ['a2']
+    assert scheduler.stats()['cancelled'] == 1
+    assert not scheduler.cancel('a1')
+    assert not scheduler.cancel('missing')
+
+
+def test_cancel_running_job(monkeypatch):
+    monkeypatch.setattr(shared.state, 'interrupted', False)
+    scheduler = Scheduler()
+    with scheduler.job('running', id_job='running') as job:
+        assert scheduler.cancel('running')
+        assert shared.state.interrupted
+    assert job.status == 'cancelled'
+
+
+def test_failed_job_releases_scheduler():
+    scheduler = Scheduler()
+    with pytest.raises(RuntimeError):
+        with scheduler.job('failing', id_job='failing'):
+            raise RuntimeError('failed')
+    assert scheduler.get('failing').status == 'failed'
+    assert scheduler.running is None
+    with scheduler.job('next', id_job='next'):
+        pass
+    assert scheduler.get('next').status == 'done'
+
+
+def test_nested_job_runs_inline():
+    scheduler = Scheduler()
+    with scheduler.job('outer', id_job='outer') as outer:
+        with scheduler.job('inner') as inner:
+            assert inner is outer
+        with scheduler: # used as lock from same thread
+            pass
+    assert scheduler.stats()['submitted'] == 1
+
+
+def test_cancel_before_enter():
+    scheduler = Scheduler()
+    cancel = threading.Event()
+    cancel.set()
+    token = current_cancel.set(cancel)
+    try:
+        with pytest.raises(JobCancelled):
+            with scheduler.job('cancelled'):
+                pass
+    finally:
+        current_cancel.reset(token)
+    assert scheduler.stats()['submitted'] == 0
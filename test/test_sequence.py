@@ -0,0 +1,73 @@
+import os
+import threading
+import pytest
+
+
+pytest.importorskip('torch')
+pytest.importorskip('PIL')
+pytest.importorskip('piexif')
+from modules import images # pylint: disable=wrong-import-position
+
+
+def filename_for(path, basename=''):
+    prefix = f'{basename}-' if basename != '' else ''
+    return lambda number: os.path.join(path, f'{prefix}{number:05}-image.png')
+
+
+def claim(allocator, path, basename=''):
+    fullfn, ok = allocator.claim(path, basename, filename_for(path, basename))
+    assert ok
+    return os.path.basename(fullfn)
+
+
+def test_continues_after_existing_files(tmp_path):
+    (tmp_path / '00007-old.png').write_bytes(b'x')
+    allocator = images.SequenceAllocator()
+    assert claim(allocator, str(tmp_path)) == '00008-image.png'
+    assert claim(allocator, str(tmp_path)) == '00009-image.png'
+    assert os.path.getsize(tmp_path / '00008-image.png') == 0 # claimed as empty placeholder
+
+
+def test_folder_is_scanned_once(tmp_path, monkeypatch):
+    allocator = images.SequenceAllocator()
+    scans = []
+    scan = images.get_next_sequence_number
+    monkeypatch.setattr(images, 'get_next_sequence_number', lambda path, basename: scans.append(path) or scan(path, basename))
+    for i in range(5):
+        assert claim(allocator, str(tmp_path)) == f'{i:05}-image.png'
+        (tmp_path / f'{i:05}-image.png').write_bytes(b'image') # own writes must not trigger rescan
+        (tmp_path / f'{i:05}-image.txt').write_text('info', encoding='utf8')
+    assert len(scans) == 1
+
+
+def test_rescan_on_external_files(tmp_path):
+    allocator = images.SequenceAllocator()
+    assert claim(allocator, str(tmp_path)) == '00000-image.png'
+    for i in range(1, 4): # written by another process
+        (tmp_path / f'{i:05}-image.png').write_bytes(b'x')
+    assert claim(allocator, str(tmp_path)) == '00004-image.png'
+
+
+def test_basename_counters_are_separate(tmp_path):
+    allocator = images.SequenceAllocator()
+    assert claim(allocator, str(tmp_path), 'grid') == 'grid-00000-image.png'
+    assert claim(allocator, str(tmp_path)) == '00000-image.png'
+    assert claim(allocator, str(tmp_path), 'grid') == 'grid-00001-image.png'
+
+
+def test_concurrent_claims_are_unique(tmp_path):
+    allocator = images.SequenceAllocator()
+    names = []
+    lock = threading.Lock()
+    def worker():
+        for _i in range(25):
+            name = claim(allocator, str(tmp_path))
+            with lock:
+                names.append(name)
+    threads = [threading.Thread(target=worker) for _i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(names)) == 100
+    assert sorted(names) == [f'{i:05}-image.png' for i in range(100)]